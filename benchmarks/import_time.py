@@ -0,0 +1,60 @@
+"""
+Import time benchmark for the modelmorph package.
+
+Each statement from ``import_budget.json`` is executed in a fresh interpreter and the median
+time it takes is compared with its budget (milliseconds).
+
+Usage:
+    python benchmarks/import_time.py [--runs 7] [--budget benchmarks/import_budget.json]
+
+Exits with status 1 if any statement goes over its budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budget.json')
+
+
+def measure(statement: str) -> float:
+    """
+    Runs ``statement`` in a new interpreter and returns its wall clock time in milliseconds.
+    ``-X importtime`` is not used because it does not account for ``importlib.import_module``,
+    which is how the lazy package attributes are resolved.
+    """
+    timer = (
+        "import time; start = time.perf_counter(); "
+        f"exec({statement!r}); "
+        "print((time.perf_counter() - start) * 1000)"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', timer],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget', default=DEFAULT_BUDGET)
+    args = parser.parse_args()
+
+    with open(args.budget, 'r') as budget_file:
+        budget = json.load(budget_file)
+
+    failed = False
+    for statement, limit_ms in budget.items():
+        median_ms = statistics.median(measure(statement) for _ in range(args.runs))
+        status = 'OK' if median_ms <= limit_ms else 'OVER BUDGET'
+        failed = failed or median_ms > limit_ms
+        print(f"{statement:<40} {median_ms:8.2f} ms  (budget {limit_ms} ms)  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
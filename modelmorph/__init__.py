@@ -1,2 +1,14 @@
-from .chatbot import *
-from .logger import *
\ No newline at end of file
+from ._lazy import attach
+
+# Heavy backends (openai, pymongo, dotenv...) are only imported when the attribute is first used
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['chatbot', 'db', 'deadline', 'evaluation', 'logger', 'pipeline', 'retrieval', 'settings', 'tracing'],
+    attributes={
+        'chatbot': ['Chat', 'ChatCompletionAssistant', 'CompletionAssistant', 'NlpToSql', 'Prompt'],
+        'deadline': ['Deadline', 'use_deadline'],
+        'logger': ['Logger'],
+        'pipeline': ['Pipeline'],
+        'settings': ['Settings', 'load_settings'],
+    },
+)
@@ -0,0 +1,41 @@
+import importlib
+import sys
+
+
+def attach(package_name: str, submodules=(), attributes: dict = None, eager=()):
+    """
+    Builds the module level ``__getattr__`` and ``__dir__`` hooks (PEP 562) used by the package
+    ``__init__`` files, so submodules and the names they export are only imported on first access.
+
+    Input:
+        - package_name (str): ``__name__`` of the package installing the hooks.
+        - submodules (iterable of str): Submodules exposed as attributes of the package.
+        - attributes (dict): Maps a relative submodule name to the list of names it exports.
+        - eager (iterable of str): Names already bound in the package namespace, listed in ``__all__``.
+
+    Output:
+        - Returns a tuple ``(__getattr__, __dir__, __all__)`` to be assigned in the package namespace.
+    """
+    submodules = set(submodules)
+    name_to_module = {
+        name: module
+        for module, names in (attributes or {}).items()
+        for name in names
+    }
+    __all__ = list(eager) + sorted(submodules | set(name_to_module))
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module(f".{name}", package_name)
+        if name in name_to_module:
+            module = importlib.import_module(f".{name_to_module[name]}", package_name)
+            value = getattr(module, name)
+            # Cache the resolved attribute so __getattr__ is not hit again for this name
+            setattr(sys.modules[package_name], name, value)
+            return value
+        raise AttributeError(f"module '{package_name}' has no attribute '{name}'")
+
+    def __dir__():
+        return list(__all__)
+
+    return __getattr__, __dir__, __all__
@@ -1,2 +1,10 @@
-from .assistant import *
-from .plugins import *
\ No newline at end of file
+from modelmorph._lazy import attach
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['assistant', 'domain', 'plugins', 'repository'],
+    attributes={
+        'assistant': ['Chat', 'ChatCompletionAssistant', 'CompletionAssistant', 'Prompt'],
+        'plugins': ['NlpToSql'],
+    },
+)
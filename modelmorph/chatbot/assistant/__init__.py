@@ -1,3 +1,14 @@
-from .chat_assistant import *
-from .assitant import *
-from .promt import *
\ No newline at end of file
+from modelmorph._lazy import attach
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['assitant', 'chat', 'chat_assistant', 'promt', 'sessions', 'structured_output'],
+    attributes={
+        'assitant': ['CompletionAssistant'],
+        'chat': ['Chat'],
+        'chat_assistant': ['ChatCompletionAssistant'],
+        'promt': ['Prompt'],
+        'sessions': ['ChatSessions'],
+        'structured_output': ['StructuredOutputParser', 'get_output_validators'],
+    },
+)
@@ -1,8 +1,11 @@
 import modelmorph.chatbot.repository as completion_repository
-import configparser
+from modelmorph.chatbot.domain import Llm
+from modelmorph.settings import Settings, load_settings
+from modelmorph.deadline import Deadline, use_deadline
+from modelmorph.tracing import span
+from pydantic import BaseModel
 from .promt import Prompt
-import os
-from dotenv import load_dotenv
+from .structured_output import StructuredOutputParser, get_output_validators
 
 class CompletionAssistant:
     """
@@ -14,13 +17,13 @@ class CompletionAssistant:
         api_key (str): API key for authentication.
         deployment_id (str): Model identifier.
         api_version (str): API version.
-        config (ConfigParser): Configuration object for loading settings.
+        settings (Settings): Shared immutable settings loaded from the environment and configuration file.
         llm (OpenAILlm): Instance of OpenAILlm for generating language model completions.
         initial_prompt (str): Initial prompt for model interaction.
         error_response (str): Default error response.
     """
 
-    def __init__(self, endpoint=None, api_key=None, deployment_id=None, api_version=None, config_path: str = ''):
+    def __init__(self, endpoint=None, api_key=None, deployment_id=None, api_version=None, config_path: str = '', settings: Settings = None, llm: Llm = None):
         """
         Initializes CompletionAssistant by loading configuration from environment variables and a config file.
 
@@ -30,50 +33,45 @@ class CompletionAssistant:
             deployment_id (str, optional): Model identifier, defaults to environment variable 'DEPLOYMENT_ID'.
             api_version (str, optional): API version, defaults to environment variable 'API_VERSION'.
             config_path (str): Path to the configuration file.
+            settings (Settings, optional): Already loaded settings, takes precedence over config_path.
+            llm (Llm, optional): Language model to use instead of the Azure OpenAI one (e.g. `MockLlm`).
         
         Raises:
-            KeyError: If configuration file or required key is missing.
+            ValidationError: If a value of the configuration file has an invalid type.
         """
-        load_dotenv()
-        self.endpoint = endpoint or os.getenv('ENDPOINT')
-        self.api_key = api_key or os.getenv('API_KEY')
-        self.deployment_id = deployment_id or os.getenv('DEPLOYMENT_ID')
-        self.api_version = api_version or os.getenv('API_VERSION')
-
-        self.load_completion_config(config_path)
- 
+        self.load_completion_config(config_path, settings)
+        self.endpoint = endpoint or self.settings.endpoint
+        self.api_key = api_key or self.settings.api_key
+        self.deployment_id = deployment_id or self.settings.deployment_id
+        self.api_version = api_version or self.settings.api_version
 
         # Initialize LLM for completion, not chat
-        self.llm = completion_repository.OpenAILlm(
+        self.llm = llm or completion_repository.OpenAILlm(
             api_key=self.api_key,
             api_url=self.endpoint,
             api_version=self.api_version,
             model_name=self.deployment_id
         )
 
-    def load_completion_config(self, config_path=''):
+    def load_completion_config(self, config_path='', settings: Settings = None):
         """
-        Loads completion settings from the provided configuration file path.
+        Loads completion settings from the provided configuration file path. The file is parsed
+        once per process and shared between assistants, see `load_settings`.
 
         Args:
             config_path (str): Path to the configuration file.
+            settings (Settings, optional): Already loaded settings, takes precedence over config_path.
         
         Attributes set:
+            settings (Settings): Settings in use by the assistant.
             initial_prompt (str): Initial prompt used by the model.
             error_response (str): Default response in case of errors.
         """
-        self.config = configparser.ConfigParser()
-        self.config.read(config_path)
-        self.initial_prompt = self.config.get(
-            'LLM_COMPLETATION', 'INITIAL_PROMPT',
-            fallback=self.config.get('DEFAULT', 'INITIAL_PROMPT', fallback='Default initial prompt')
-        )
-        self.error_response = self.config.get(
-            'LLM_COMPLETATION', 'ERROR_RESPONSE',
-            fallback=self.config.get('DEFAULT', 'ERROR_RESPONSE', fallback='Default error response')
-        )
+        self.settings = settings or load_settings(config_path)
+        self.initial_prompt = self.settings.completion.initial_prompt or 'Default initial prompt'
+        self.error_response = self.settings.completion.error_response or 'Default error response'
 
-    def generate_completion(self, prompt: str | Prompt, option: int = 0, response_type: str = "json_object", max_tokens=200, temp=0.0, top_p=0.1) -> str:
+    def generate_completion(self, prompt: str | Prompt, option: int = 0, response_type: str = "json_object", max_tokens=200, temp=0.0, top_p=0.1, deadline: Deadline | float = None) -> str:
         """
         Generates a completion response from the language model based on a given prompt.
 
@@ -84,35 +82,130 @@ class CompletionAssistant:
             max_tokens (int): Maximum number of tokens to generate.
             temp (float): Temperature parameter for sampling (0-1 range).
             top_p (float): Nucleus sampling probability threshold.
+            deadline (Deadline | float, optional): Deadline of the request, or its timeout in seconds,
+                defaults to the current one (see `use_deadline`).
 
         Returns:
             str: Generated response text from the language model.
 
         Raises:
             Exception: If prompt is not a valid type (str or Prompt) or other error occurs.
+            DeadlineExceeded: If the deadline is exhausted (RequestCancelled when the request is cancelled).
         """
-        # Configure settings for completion generation
-        self.max_tokens = int(self.config.get('LLM_COMPLETATION', 'MAX_TOKENS', fallback=max_tokens))
-        self.temp = float(self.config.get('LLM_COMPLETATION', 'TEMP', fallback=temp))
-        self.top_p = float(self.config.get('LLM_COMPLETATION', 'TOP_P', fallback=top_p))
-        self.type_object = self.config.get('LLM_COMPLETATION', 'TYPE', fallback=response_type)
+        with span('completion.generate', response_type=response_type), use_deadline(deadline):
+            self._configure_generation(max_tokens, temp, top_p, response_type)
+            with span('completion.prompt'):
+                message = self._prompt_text(prompt)
 
-        # Process the prompt input
-        if type(prompt) == str:
-            prompt_final = prompt
-        elif type(prompt) == Prompt:
-            prompt_final = prompt.generate_prompt('')
-        else:
-            raise Exception('Not Valid Prompt Type')
-
-    # Generate response from the language model
-        response = self.llm.get_response_message(
-            message=prompt_final,
-            sytem_message=self.initial_prompt,
+            # Generate response from the language model
+            with span('completion.model') as model_span:
+                response = self.llm.get_response_message(
+                    message=message,
+                    system_message=self.initial_prompt,
+                    type_object=self.type_object,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temp,
+                    top_p=self.top_p
+                )
+                model_span.record_usage(response)
+            return response.choices[option].message.content
+
+    def generate_structured(self, prompt: str | Prompt, output_model: type[BaseModel], option: int = 0, max_tokens=200, temp=0.0, top_p=0.1, deadline: Deadline | float = None) -> BaseModel:
+        """
+        Generates a JSON completion and validates it into an instance of the given pydantic model.
+
+        Args:
+            prompt (str | Prompt): Input prompt for the language model. Can be a string or an instance of the Prompt class.
+            output_model (type[BaseModel]): Pydantic model describing the expected JSON object.
+            option (int): Choice index from the response to return.
+            max_tokens (int): Maximum number of tokens to generate.
+            temp (float): Temperature parameter for sampling (0-1 range).
+            top_p (float): Nucleus sampling probability threshold.
+            deadline (Deadline | float, optional): Deadline of the request, or its timeout in seconds.
+
+        Returns:
+            BaseModel: Validated instance of output_model.
+
+        Raises:
+            ValidationError: If the response does not match the output model.
+            DeadlineExceeded: If the deadline is exhausted (RequestCancelled when the request is cancelled).
+        """
+        self._configure_generation(max_tokens, temp, top_p, 'json_object')
+        self.type_object = 'json_object'
+        validators = get_output_validators(output_model)
+
+        with use_deadline(deadline):
+            response = self.llm.get_response_message(
+                message=self._prompt_text(prompt),
+                system_message=self._structured_system_message(validators.schema),
+                type_object=self.type_object,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p
+            )
+        return validators.adapter.validate_json(response.choices[option].message.content)
+
+    def stream_structured(self, prompt: str | Prompt, output_model: type[BaseModel], max_tokens=200, temp=0.0, top_p=0.1):
+        """
+        Streams a JSON completion, yielding validated partial objects as soon as their top level fields are complete.
+
+        Args:
+            prompt (str | Prompt): Input prompt for the language model. Can be a string or an instance of the Prompt class.
+            output_model (type[BaseModel]): Pydantic model describing the expected JSON object.
+            max_tokens (int): Maximum number of tokens to generate.
+            temp (float): Temperature parameter for sampling (0-1 range).
+            top_p (float): Nucleus sampling probability threshold.
+
+        Yields:
+            BaseModel: Instances of the partial model (every field optional) while the response is generated,
+            then a final, fully validated instance of output_model.
+
+        Raises:
+            ValidationError: If a completed field or the final response does not match the output model.
+        """
+        self._configure_generation(max_tokens, temp, top_p, 'json_object')
+        self.type_object = 'json_object'
+        parser = StructuredOutputParser(output_model)
+
+        chunks = self.llm.stream_response_message(
+            message=self._prompt_text(prompt),
+            system_message=self._structured_system_message(parser.validators.schema),
             type_object=self.type_object,
             max_tokens=self.max_tokens,
             temperature=self.temp,
             top_p=self.top_p
         )
-        return response.choices[option].message.content
-    
+        for chunk in chunks:
+            partial = parser.feed(chunk)
+            if partial is not None:
+                yield partial
+        yield parser.result()
+
+    def _configure_generation(self, max_tokens, temp, top_p, response_type):
+        """
+        Sets the generation parameters, values from the configuration file take precedence over the arguments.
+        """
+        completion = self.settings.completion
+        self.max_tokens = max_tokens if completion.max_tokens is None else completion.max_tokens
+        self.temp = temp if completion.temp is None else completion.temp
+        self.top_p = top_p if completion.top_p is None else completion.top_p
+        self.type_object = response_type if completion.type is None else completion.type
+
+    def _prompt_text(self, prompt: str | Prompt) -> str:
+        """
+        Returns the text to send for a prompt given as a string or a Prompt instance.
+
+        Raises:
+            Exception: If prompt is not a valid type (str or Prompt).
+        """
+        if type(prompt) == str:
+            return prompt
+        elif type(prompt) == Prompt:
+            return prompt.generate_prompt('')
+        raise Exception('Not Valid Prompt Type')
+
+    def _structured_system_message(self, schema: str) -> str:
+        """
+        Appends the JSON schema of the expected output to the initial prompt.
+        """
+        return f"{self.initial_prompt}\nRespond only with a JSON object that follows this JSON schema: {schema}"
@@ -1,12 +1,19 @@
-from modelmorph.db.repository import MongoDBRepository
+from modelmorph.db.domain import VERSION_CONFLICT, DBRepository
 from modelmorph.chatbot.domain.llm import Llm
+from modelmorph.chatbot.domain.messages import MessageStore, MessageView
+from modelmorph.deadline import Deadline, DeadlineExceeded, current_deadline, use_deadline
+from modelmorph.tracing import span
 import os
 from .promt import Prompt
 
+_END = object()
+
 class Chat(object):
 
+    # Attempts to merge the chat with the stored one when another writer saved it first
+    save_retries = 3
 
-    def __init__(self, chat_id: int, llm:Llm ,initial_prompt:str | Prompt):
+    def __init__(self, chat_id: int, llm:Llm ,initial_prompt:str | Prompt, db_connection: DBRepository = None, history_window: int = None):
         """
         Initializes the Chat class with a chat ID, language model (Llm), and initial system prompt.
         
@@ -14,9 +21,15 @@ class Chat(object):
             - chat_id (int): Unique identifier for the chat session.
             - llm (Llm): Language model instance for handling responses.
             - initial_prompt (str): Initial system prompt for the chatbot.
+            - db_connection (DBRepository, optional): Chat storage, defaults to the MongoDB clusters of 'CHAT_SHARDS' (see
+              `ShardedDBRepository.from_env`) or else the MongoDBRepository of 'CONNECTION_STRING'.
+            - history_window (int, optional): Number of previous messages loaded and sent to the model. With a window
+              only the last messages are read from the storage and new messages are appended to it, so the cost of
+              a turn does not grow with the length of the chat. None loads and saves the whole chat.
             
         Output:
-            Initializes the chat dictionary with the initial prompt and connects to the MongoDBRepository.
+            Initializes the chat dictionary with the initial prompt and connects to the chat storage.
+            The messages are kept in a `MessageStore`, which behaves like a list of message dicts.
         """
         self._initialize_prompt = ''
         if type(initial_prompt) == str:
@@ -27,8 +40,16 @@ class Chat(object):
         
         self.chat_id = chat_id
         self.chatbot = llm
-        self.chat = {"messages":[{"role":"system","content":initial_prompt}], "_id":chat_id}
-        self.db_connection = MongoDBRepository(os.getenv('CONNECTION_STRING'))
+        self.chat = {"messages":MessageStore([{"role":"system","content":self._initialize_prompt}]), "_id":chat_id}
+        self.history_window = history_window
+        # Number of messages of self.chat already in the storage, None until the chat is loaded
+        self._persisted = None
+        # Version of the stored chat the messages in memory are based on, see `DBRepository.save_chat_if_version`
+        self._version = 0
+        if db_connection is None:
+            from modelmorph.db.repository import MongoDBRepository, ShardedDBRepository
+            db_connection = ShardedDBRepository.from_env() or MongoDBRepository(os.getenv('CONNECTION_STRING'))
+        self.db_connection = db_connection
 
 
     def save_chat(self):
@@ -40,9 +61,16 @@ class Chat(object):
             
         Output:
             - Calls the save_chat function in the database repository to save the chat data.
+            - Skipped when the deadline of the current request is exhausted, the messages stay in
+              memory and are written by the next save.
         """
         # Save the chat to the database
-        self.db_connection.save_chat(self.chat_id, self.chat)
+        with span('chat.save', chat_id=str(self.chat_id)) as save_span:
+            deadline = current_deadline()
+            if deadline is not None and deadline.expired:
+                save_span.set_attribute('chat.skipped', 'deadline')
+                return
+            self._persist()
 
     
     def __del__(self):
@@ -56,7 +84,82 @@ class Chat(object):
             Automatically saves the current chat state to the database upon object deletion.
         """
         # Save the chat when the object is deleted
-        self.db_connection.save_chat(self.chat_id, self.chat)
+        self._persist()
+
+    def _persist(self):
+        """
+        Writes the chat to the storage. With a history window only the messages added since the last
+        load or save are appended, and the messages in memory are trimmed back to the window.
+        """
+        if self.history_window is None:
+            self._save_versioned()
+            return
+        if self._persisted is None:
+            # Never loaded: the stored history is unknown, appending could duplicate the system message
+            return
+        messages = self.chat["messages"]
+        new_messages = list(messages[self._persisted:])
+        if new_messages:
+            result = self.db_connection.append_messages(self.chat_id, new_messages)
+            if result.error:
+                print(f"Error saving chat: {result.error}")
+                return
+        if len(messages) > self.history_window + 1:
+            self.chat["messages"] = MessageStore([messages[0]] + messages[-self.history_window:])
+            messages.release()
+        self._persisted = len(self.chat["messages"])
+
+    def _save_versioned(self):
+        """
+        Saves the whole chat if nobody saved it since it was loaded (compare-and-set on its version), so
+        any process can serve any turn of a chat. When another process saved it first, the stored chat is
+        loaded again and the messages added here since the last load or save are appended to it, up to
+        `save_retries` times.
+        """
+        for attempt in range(self.save_retries + 1):
+            result = self.db_connection.save_chat_if_version(self.chat_id, self._document(), self._version)
+            if not result.error:
+                self._version = self.chat["version"] = result.data[0]["version"]
+                self._persisted = len(self.chat["messages"])
+                return
+            if result.error != VERSION_CONFLICT or attempt == self.save_retries or not self._merge_stored():
+                break
+        print(f"Error saving chat: {result.error}")
+
+    def _merge_stored(self) -> bool:
+        """
+        Replaces the messages in memory by the stored ones followed by the messages not saved yet.
+        """
+        result = self.db_connection.find_chat_by_id(self.chat_id)
+        if result.error == 400:
+            # Removed meanwhile, saved again as a new chat
+            self._version = 0
+            return True
+        if result.error:
+            return False
+        stored = result.data[0]
+        # The system message was saved with the chat, even when it was never loaded
+        new_messages = list(self.chat["messages"][max(self._persisted or 0, 1):])
+        stored_messages = list(stored.get("messages", []))
+        self._release_messages()
+        self.chat = {**stored, "messages": MessageStore(stored_messages + new_messages)}
+        self._version = stored.get("version", 0)
+        self._persisted = len(stored_messages)
+        return True
+
+    def _release_messages(self):
+        """
+        Frees the messages in memory (or spilled) before self.chat is replaced.
+        """
+        messages = self.chat.get("messages")
+        if isinstance(messages, MessageStore):
+            messages.release()
+
+    def _document(self) -> dict:
+        """
+        Returns the chat as stored in the database, with the messages as a list of dicts.
+        """
+        return {**self.chat, "messages": list(self.chat["messages"])}
         
 
 
@@ -76,44 +179,138 @@ class Chat(object):
         if self.chat_id is None:
             pass
         
-        result = self.db_connection.find_chat_by_id(self.chat_id)
+        if self.history_window is None:
+            result = self.db_connection.find_chat_by_id(self.chat_id)
+        else:
+            result = self.db_connection.find_chat_tail(self.chat_id, self.history_window)
         if result.error:
             if result.error == 400:
                 # If the chat does not exist, start with an empty chat
-                self.chat = {"messages":[{"role":"system","content":self.initial_prompt}], "_id":self.chat_id}
+                self._release_messages()
+                self.chat = {"messages":MessageStore([{"role":"system","content":self._initialize_prompt}]), "_id":self.chat_id}
+                self._persisted = 0
+                self._version = 0
             else:
                 # Handle other errors (e.g., database connection issues)
                 print(f"Error retrieving chat: {result.error}")
-        else:
+        elif self.history_window is None:
             # If the chat exists, load the existing messages
+            self._release_messages()
             self.chat = result.data[0]
+            self.chat["messages"] = MessageStore(self.chat["messages"])
+            self._version = self.chat.get("version", 0)
+            self._persisted = len(self.chat["messages"])
+        else:
+            # The tail has the system message only for short chats, the current one is always sent first
+            tail = [message for message in result.data[0]["messages"] if message.get("role") != "system"]
+            self._release_messages()
+            self.chat = {**result.data[0], "messages": MessageStore([{"role":"system","content":self._initialize_prompt}] + tail)}
+            self._persisted = len(self.chat["messages"])
 
-    def send(self,message:str):
+    def _context(self):
+        """
+        Returns the messages sent to the model: all of them, or the system message and the last
+        `history_window` ones.
+        """
+        messages = self.chat['messages']
+        if self.history_window is None or len(messages) <= self.history_window + 1:
+            return messages
+        return MessageView([messages[0]], messages[-self.history_window:])
+
+    def send(self,message:str, deadline: Deadline | float = None):
         """
         Adds a user message to the chat, gets a response from the chatbot, and adds it to the chat.
         
         Input:
             - message (str): The user’s message to be sent to the chatbot.
+            - deadline (Deadline or float, optional): Deadline of the request, or its timeout in seconds,
+              defaults to the current one (see `use_deadline`).
             
         Output:
             - Appends the user’s message and the chatbot’s response to the chat messages.
             - Returns the raw response from the chatbot API and the content of the assistant’s message.
             - Handles and prints any errors encountered when retrieving a chatbot response.
+            - Raises DeadlineExceeded (RequestCancelled when cancelled) once the deadline is exhausted,
+              without the user’s message in the chat.
         """
         # Implement functionality for adding messages to the chat or other chat-related operations
+        with span('chat.send', chat_id=str(self.chat_id)), use_deadline(deadline) as request_deadline:
+            if request_deadline is not None:
+                request_deadline.check('chat load')
+            if len(self.chat['messages']) <= 1:
+                with span('chat.load'):
+                    self._initialize_chat()
+            self.chat['messages'].append({"role":"user","content":message})
+            try:
+                with span('chat.model') as model_span:
+                    response = self.chatbot.get_response_chat(self._context())
+                    model_span.record_usage(response)
+                message = response.choices[0].message.content
+                self.chat['messages'].append({"role":"assistant","content":message})
+                return response,message
+
+            except DeadlineExceeded:
+                # Nobody gets the answer, the turn is dropped
+                self.chat['messages'].pop()
+                raise
+            except Exception as e:
+
+                print(f"Error getting response: {e}")
+
+    def send_stream(self, message: str, deadline: Deadline | float = None):
+        """
+        Adds a user message to the chat and streams the chatbot's answer as it is generated.
         
-        if len(self.chat['messages']) <= 1:
-            self._initialize_chat()
-        self.chat['messages'].append({"role":"user","content":message})
+        Input:
+            - message (str): The user’s message to be sent to the chatbot.
+            - deadline (Deadline or float, optional): Deadline of the request, or its timeout in seconds,
+              defaults to the current one (see `use_deadline`).
+            
+        Output:
+            - Generator of str with the content deltas of the answer.
+            - Appends the user’s message, and the full answer once the stream ends, to the chat messages.
+            - Raises DeadlineExceeded (RequestCancelled when cancelled) once the deadline is exhausted, the
+              model stream is closed and the user’s message removed from the chat. Closing the generator
+              also closes the model stream.
+        """
+        # Spans and the deadline are not made current across the yields, the consumer runs between them
+        request_deadline = Deadline.coerce(deadline) or current_deadline()
+        stream_span = span('chat.send_stream', chat_id=str(self.chat_id))
         try:
-            response = self.chatbot.get_response_chat(self.chat['messages'])
-            self.chat['messages'].append({"role":"assistant","content":response['choices'][0]['message']['content']})
-            message = response['choices'][0]['message']['content']
-            return response,message
-        
-        except Exception as e:
+            if request_deadline is not None:
+                request_deadline.check('chat load')
+            with use_deadline(request_deadline):
+                if len(self.chat['messages']) <= 1:
+                    with stream_span.child('chat.load'):
+                        self._initialize_chat()
+            self.chat['messages'].append({"role":"user","content":message})
 
-            print(f"Error getting response: {e}")
+            parts = []
+            model_span = stream_span.child('chat.model')
+            deltas = self.chatbot.stream_response_chat(self._context())
+            try:
+                while True:
+                    # The model stream takes the deadline when it starts, on the first item
+                    with use_deadline(request_deadline):
+                        delta = next(deltas, _END)
+                    if delta is _END:
+                        break
+                    parts.append(delta)
+                    yield delta
+            except DeadlineExceeded as e:
+                model_span.record_exception(e)
+                self.chat['messages'].pop()
+                raise
+            except Exception as e:
+                model_span.record_exception(e)
+                raise
+            finally:
+                # Stops the model request when the consumer closes this generator early
+                deltas.close()
+                model_span.end()
+            self.chat['messages'].append({"role":"assistant","content":"".join(parts)})
+        finally:
+            stream_span.end()
 
         
 
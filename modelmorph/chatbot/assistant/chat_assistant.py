@@ -1,7 +1,9 @@
 import modelmorph.chatbot.repository as chatbot_repository
-from dotenv import load_dotenv
-import os
-import configparser
+from modelmorph.chatbot.domain import Llm
+from modelmorph.db.domain import DBRepository
+from modelmorph.settings import Settings, load_settings
+from modelmorph.chatbot.plugins import Plugin, ToolExecutor
+from modelmorph.tracing import span
 from .chat import Chat
 
 class ChatCompletionAssistant:
@@ -14,12 +16,16 @@ class ChatCompletionAssistant:
         api_key (str): API key for authentication.
         deployment_id (str): Deployment identifier for the language model.
         api_version (str): API version being used.
+        settings (Settings): Shared immutable settings loaded from the environment and configuration file.
         initial_prompt (str): Initial prompt for the language model interaction.
         error_response (str): Default error response if an issue occurs.
         llm (OpenAILlm): Instance for managing API interactions with the language model.
+        tool_executor (ToolExecutor): Bounded pool running the plugin tool calls requested by the model.
+        db_connection (DBRepository): Chat storage given to the chats, None to use MongoDB.
+        history_window (int): Previous messages loaded and sent to the model by the chats, None for all of them.
     """
 
-    def __init__(self, endpoint=None, api_key=None, deployment_id=None, api_version=None, config_path=''):
+    def __init__(self, endpoint=None, api_key=None, deployment_id=None, api_version=None, config_path='', settings: Settings = None, max_tool_workers: int = 4, tool_timeout: float = 30.0, llm: Llm = None, db_connection: DBRepository = None, history_window: int = None):
         """
         Initializes ChatCompletionAssistant by loading configuration settings and setting up API access.
 
@@ -29,45 +35,49 @@ class ChatCompletionAssistant:
             deployment_id (str, optional): Deployment identifier, defaults to environment variable 'DEPLOYMENT_ID'.
             api_version (str, optional): API version, defaults to environment variable 'API_VERSION'.
             config_path (str): Path to the configuration file.
+            settings (Settings, optional): Already loaded settings, takes precedence over config_path.
+            max_tool_workers (int): Maximum number of plugin tool calls running at the same time.
+            tool_timeout (float): Default timeout in seconds of a plugin tool call.
+            llm (Llm, optional): Language model to use instead of the Azure OpenAI one (e.g. `MockLlm`).
+            db_connection (DBRepository, optional): Chat storage, defaults to MongoDB with 'CONNECTION_STRING'.
+            history_window (int, optional): Previous messages loaded and sent to the model by the chats, see `Chat`.
         
         Raises:
-            KeyError: If the configuration file is missing or incomplete.
+            ValidationError: If a value of the configuration file has an invalid type.
         """
-        load_dotenv()
-        self.endpoint = endpoint or os.getenv('ENDPOINT')
-        self.api_key = api_key or os.getenv('API_KEY')
-        self.deployment_id = deployment_id or os.getenv('DEPLOYMENT_ID')
-        self.api_version = api_version or os.getenv('API_VERSION')
-        self.load_chat_config(config_path)
-
-        self.llm = chatbot_repository.OpenAILlm(
+        self.load_chat_config(config_path, settings)
+        self.tool_executor = ToolExecutor(max_workers=max_tool_workers, default_timeout=tool_timeout)
+        self.db_connection = db_connection
+        self.history_window = history_window
+        self.endpoint = endpoint or self.settings.endpoint
+        self.api_key = api_key or self.settings.api_key
+        self.deployment_id = deployment_id or self.settings.deployment_id
+        self.api_version = api_version or self.settings.api_version
+
+        self.llm = llm or chatbot_repository.OpenAILlm(
             api_key=self.api_key,
             api_url=self.endpoint,
             api_version=self.api_version,
             model_name=self.deployment_id
         )
 
-    def load_chat_config(self, config_path=''):
+    def load_chat_config(self, config_path='', settings: Settings = None):
         """
-        Loads chat-specific configuration settings from a provided file.
+        Loads chat-specific configuration settings from a provided file. The file is parsed
+        once per process and shared between assistants, see `load_settings`.
 
         Args:
             config_path (str): Path to the configuration file.
+            settings (Settings, optional): Already loaded settings, takes precedence over config_path.
         
         Sets:
+            settings (Settings): Settings in use by the assistant.
             initial_prompt (str): Initial message sent by the assistant.
             error_response (str): Fallback message in case of errors.
         """
-        config = configparser.ConfigParser()
-        config.read(config_path)
-        self.initial_prompt = config.get(
-            'LLM_CHAT', 'INITIAL_PROMPT',
-            fallback='Default initial prompt'
-        )
-        self.error_response = config.get(
-            'LLM_CHAT', 'ERROR_RESPONSE',
-            fallback='Default error response'
-        )
+        self.settings = settings or load_settings(config_path)
+        self.initial_prompt = self.settings.chat.initial_prompt or 'Default initial prompt'
+        self.error_response = self.settings.chat.error_response or 'Default error response'
 
     def plugin_run(self, chat: Chat, message: str, plugin, choice: int = 0):
         """
@@ -79,9 +89,45 @@ class ChatCompletionAssistant:
             plugin (function): Plugin function to process the message.
             choice (int): Index of the response choice to use.
         """
-        response = plugin(message)
-        response_text = response['choices'][choice]['text']
-        chat.chat["messages"].append({'role': 'assistant', 'message': response_text})
+        with span('chat.plugin_run', chat_id=str(chat.chat_id), plugin=getattr(plugin, '__name__', type(plugin).__name__)):
+            response = plugin(message)
+            response_text = response['choices'][choice]['text']
+            chat.chat["messages"].append({'role': 'assistant', 'message': response_text})
+
+    def plugin_tools_run(self, chat: Chat, message: str, plugin: Plugin, choice: int = 0):
+        """
+        Sends a user message with the loaded plugins exposed as tools. When the model requests tool calls,
+        all of them run concurrently and their results are sent back in a single follow-up request.
+
+        Args:
+            chat (Chat): An instance of the Chat class.
+            message (str): Message from the user.
+            plugin (Plugin): Plugin manager whose plugins are offered to the model as tools.
+            choice (int): Index of the response choice to use.
+
+        Returns:
+            tuple: The raw response of the last request and the content of the assistant's answer.
+        """
+        messages = chat.chat["messages"]
+        messages.append({"role": "user", "content": message})
+
+        response = self.llm.get_response_chat(messages, tools=plugin.tool_definitions())
+        answer = response.choices[choice].message
+        if answer.tool_calls:
+            messages.append({
+                "role": "assistant",
+                "content": answer.content,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in answer.tool_calls
+                ]
+            })
+            messages.extend(self.tool_executor.execute(plugin, answer.tool_calls))
+            response = self.llm.get_response_chat(messages)
+            answer = response.choices[choice].message
+
+        messages.append({"role": "assistant", "content": answer.content})
+        return response, answer.content
 
     def init_chat(self, _id=None) -> Chat:
         """
@@ -93,6 +139,6 @@ class ChatCompletionAssistant:
         Returns:
             Chat: An initialized Chat instance.
         """
-        chat = Chat(_id, self.llm, self.initial_prompt)
+        chat = Chat(_id, self.llm, self.initial_prompt, self.db_connection, self.history_window)
         chat.save_chat()
         return chat
@@ -1,73 +1,137 @@
-import configparser
+from difflib import SequenceMatcher
+from typing import NamedTuple
 import re
 
+SECTIONS = ('role', 'intro', 'objectives', 'parameters', 'how', 'restrictions', 'format', 'content')
+
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+_SPACES_PATTERN = re.compile(r"[ \t\r\f\v]+")
+_BLANK_LINES_PATTERN = re.compile(r"\n\s*\n+")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text: words are counted in pieces of up to 4 characters
+    and every punctuation sign as one token, which is close to the BPE tokenizers of the models.
+    """
+    return len(_TOKEN_PATTERN.findall(text or ''))
+
+
+def normalize_whitespace(text: str) -> str:
+    """
+    Collapses runs of spaces and tabs, strips every line and removes blank lines.
+    """
+    lines = (_SPACES_PATTERN.sub(' ', line).strip() for line in (text or '').split('\n'))
+    return _BLANK_LINES_PATTERN.sub('\n', '\n'.join(lines)).strip()
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    """
+    Cuts a text after the given number of estimated tokens, see `count_tokens`.
+    """
+    if budget <= 0:
+        return ''
+    matches = list(_TOKEN_PATTERN.finditer(text))
+    if len(matches) <= budget:
+        return text
+    return text[:matches[budget - 1].end()].rstrip() + '…'
+
+
+class PromptCompaction(NamedTuple):
+    """
+    Result of `Prompt.compact`: the compacted prompt, its estimated tokens before and after,
+    and the (section, text, reason) of every item removed, reason being 'duplicate' or 'budget'.
+    """
+    prompt: str
+    tokens_before: int
+    tokens_after: int
+    removed: list
+
+    @property
+    def saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
 class Prompt:
-    def __init__(self, config_path: str = None, role: str = "", output_format: str = None):
+    def __init__(self, config_path: str = None, role: str = "", output_format: str = None, settings=None, budgets: dict = None, compact: bool = False, retriever=None):
         """
         Initializes the Prompt class with configuration settings.
         
         Input:
-            - config_path (str, optional): Path to the configuration file.
+            - config_path (str, optional): Path to the configuration file, loaded once per process with `load_settings`.
             - role (str): Role of the user or assistant, used as a fallback for role description if not specified in config.
             - output_format (str, optional): Template for the prompt format. Defaults to a pre-defined format.
+            - settings (Settings, optional): Already loaded settings, takes precedence over config_path.
+            - budgets (dict, optional): Maximum estimated tokens per section ('role', 'intro', 'objectives', 'parameters',
+              'how', 'restrictions', 'format', 'content') applied by `compact`.
+            - compact (bool): Compact the prompt on every `generate_prompt`, see `compact`.
+            - retriever (Retriever, optional): Adds the documents relevant to the text of `generate_prompt` to the content.
             
         Output: 
             Initializes the object with prompt configuration and section connectors.
         """
-        # Default configuration as a fallback if config file is not provided or has missing values
-        default_config = {
-            'LLM_COMPLETATION': {
-                'INITIAL_PROMPT': '',
-                'INTRO': '',
-                'HOW': '',
-                'FORMAT': '',
-                'ERROR_RESPONSE': 'Lo siento, no puedo ayudarte con eso'
-            },
-            'CONNECTORS': {
-                'ROLE': 'Rol:',
-                'INTRO': 'Introducción:',
-                'OBJECTIVES': 'Objetivos:',
-                'HOW': 'Enfoque:',
-                'RESTRICTIONS': 'Condiciones:',
-                'FORMAT': 'Formato de salida:',
-                'PARAMETERS': 'Parametros:'
-            }
-        }
-        
-        # Load configuration from file if provided; otherwise, use default
-        config = configparser.ConfigParser()
-        if config_path:
-            config.read(config_path)
+        self.settings = settings
+        if config_path and settings is None:
+            # Imported here so a Prompt without configuration does not pay for pydantic at import time
+            from modelmorph.settings import load_settings
+            self.settings = load_settings(config_path)
+
+        if self.settings is not None:
+            completion = self.settings.completion
+            connectors = self.settings.connectors
+
+            # Load prompt sections from the role configuration
+            self.role_description = completion.initial_prompt or role
+            self.intro = completion.intro
+            self.how = completion.how
+            self.format = completion.format
+            self.error_response = completion.error_response or "Lo siento, no puedo ayudarte con eso"
+
+            # Load connectors and delimiters from the CONNECTORS section
+            self.role_connector = connectors.role
+            self.intro_connector = connectors.intro
+            self.objectives_connector = connectors.objectives
+            self.how_connector = connectors.how
+            self.restrictions_connector = connectors.restrictions
+            self.format_connector = connectors.format
+            self.parameter_connector = connectors.parameters
+            self.objective_delimiter = completion.objective_delimiter
+            self.restriction_delimiter = completion.restriction_delimiter
+            self.parameter_delimiter = completion.parameter_delimiter
         else:
-            config.read_dict(default_config)
+            # Default configuration as a fallback if config file is not provided
+            self.role_description = role
+            self.intro = ''
+            self.how = ''
+            self.format = ''
+            self.error_response = 'Lo siento, no puedo ayudarte con eso'
 
-        self.config = config
+            self.role_connector = 'Rol:'
+            self.intro_connector = 'Introducción:'
+            self.objectives_connector = 'Objetivos:'
+            self.how_connector = 'Enfoque:'
+            self.restrictions_connector = 'Condiciones:'
+            self.format_connector = 'Formato de salida:'
+            self.parameter_connector = 'Parametros:'
+            self.objective_delimiter = "\n"
+            self.restriction_delimiter = "\n"
+            self.parameter_delimiter = "\n"
 
-        # Load prompt sections from the role configuration
-        self.role_description = config['LLM_COMPLETATION'].get('INITIAL_PROMPT', "") or role
-        self.intro = config['LLM_COMPLETATION'].get('INTRO', "")
-        self.how = config['LLM_COMPLETATION'].get('HOW', "")
-        self.format = config['LLM_COMPLETATION'].get('FORMAT', "")
-        self.error_response = config['LLM_COMPLETATION'].get('ERROR_RESPONSE', "Lo siento, no puedo ayudarte con eso")
         self.content = ''
 
-        # Load connectors and delimiters from the CONNECTORS section
-        self.role_connector = config['CONNECTORS'].get('ROLE', "Role:")
-        self.intro_connector = config['CONNECTORS'].get('INTRO', "Introduction:")
-        self.objectives_connector = config['CONNECTORS'].get('OBJECTIVES', "Objectives:")
-        self.how_connector = config['CONNECTORS'].get('HOW', "Approach:")
-        self.restrictions_connector = config['CONNECTORS'].get('RESTRICTIONS', "Conditions:")
-        self.format_connector = config['CONNECTORS'].get('FORMAT', "Output Format:")
-        self.parameter_connector = config['CONNECTORS'].get('PARAMETERS', "Parametros:")
-        self.objective_delimiter = config['LLM_COMPLETATION'].get('OBJECTIVE_DELIMITER', "\n")
-        self.restriction_delimiter = config['LLM_COMPLETATION'].get('RESTRICTION_DELIMITER', "\n")
-        self.parameter_delimiter = config['LLM_COMPLETATION'].get('PARAMETER_DELIMITER', "\n")
-
         # Initialize lists for objectives, parameters, and restrictions
         self.objectives = []
         self.parameters = []
         self.restrictions = []
 
+        # Priority of the items added with a non default one, higher is kept first by the compaction
+        self.priorities = {'objectives': {}, 'parameters': {}, 'restrictions': {}}
+        self.budgets = dict(budgets or {})
+        self.auto_compact = compact
+        self.similarity = 0.9
+        self.last_compaction = None
+        self.retriever = retriever
+
         # Set the output format or default format if none provided
         self.output_format = output_format or "{role}\n{intro}\n{objectives}\n{parameters}\n{how}\n{restrictions}\n{format}\n{content}"
 
@@ -92,13 +156,14 @@ class Prompt:
                     template = template.replace(f"{{{{{placeholder}}}}}", str(value))
         return template
 
-    def add_objective(self, objective: str, params=None):
+    def add_objective(self, objective: str, params=None, priority: int = 0):
         """
         Adds an objective to the objectives list, with optional parameters to replace placeholders.
         
         Input:
             - objective (str): Objective text, potentially containing placeholders.
             - params (dict or list, optional): Values to fill in placeholders within the objective text.
+            - priority (int): Objectives with a higher priority are the last removed by `compact`.
             
         Output:
             - Updates the objectives list with the formatted objective.
@@ -106,32 +171,47 @@ class Prompt:
         if params:
             objective = self._fill_placeholders(objective, params)
         self.objectives.append(objective)
+        self._set_priority('objectives', objective, priority)
 
-    def add_param(self, param_description: str, param):
+    def add_param(self, param_description: str, param, priority: int = 0):
         """
         Adds a parameter description and value to the parameters list.
         
         Input:
             - param_description (str): Description or name of the parameter.
             - param: Value of the parameter to be added.
+            - priority (int): Parameters with a higher priority are the last removed by `compact`.
             
         Output:
             - Updates the parameters list with the formatted parameter description and value.
         """
         if param:
             self.parameters.append(f"\n{param_description}: {param}")
+            self._set_priority('parameters', self.parameters[-1], priority)
 
-    def add_restriction(self, restriction: str):
+    def add_restriction(self, restriction: str, priority: int = 0):
         """
         Adds a restriction to the list of restrictions.
         
         Input:
             - restriction (str): Text describing a restriction.
+            - priority (int): Restrictions with a higher priority are the last removed by `compact`.
         
         Output:
             - Updates the restrictions list with the specified restriction.
         """
         self.restrictions.append(restriction)
+        self._set_priority('restrictions', restriction, priority)
+
+    def _set_priority(self, section: str, item: str, priority: int):
+        # Copies of an item have the highest of their priorities, adding one with the default priority keeps it
+        if priority:
+            self.priorities[section][item] = max(priority, self.priorities[section].get(item, priority))
+
+    def _prune_priorities(self, section: str):
+        # Forgets the priorities of the items removed, an item added again starts from its own priority
+        items = set(getattr(self, section))
+        self.priorities[section] = {item: priority for item, priority in self.priorities[section].items() if item in items}
 
     def clean_objectives(self, n=None):
         """
@@ -147,6 +227,7 @@ class Prompt:
             self.objectives.clear()
         elif isinstance(n, int):
             self.objectives = self.objectives[:-n]
+        self._prune_priorities('objectives')
 
     def clean_restrictions(self, n=None):
         """
@@ -162,6 +243,7 @@ class Prompt:
             self.restrictions.clear()
         elif isinstance(n, int):
             self.restrictions = self.restrictions[:-n]
+        self._prune_priorities('restrictions')
 
     def clean_parameters(self, n=None):
         """
@@ -177,6 +259,7 @@ class Prompt:
             self.parameters.clear()
         elif isinstance(n, int):
             self.parameters = self.parameters[:-n]
+        self._prune_priorities('parameters')
 
     def clear_all(self):
         """
@@ -188,6 +271,8 @@ class Prompt:
         self.objectives.clear()
         self.parameters.clear()
         self.restrictions.clear()
+        for section in self.priorities:
+            self.priorities[section].clear()
 
     def _format_section(self, connector, content):
         """
@@ -202,24 +287,135 @@ class Prompt:
         """
         return f"{connector} {content}" if content else ""
 
-    def generate_prompt(self, text: str = None) -> str:
+    def generate_prompt(self, text: str = None, compact: bool = None) -> str:
         """
         Generates the final structured prompt string, including all formatted sections.
         
         Input:
-            - text (str, optional): Additional text to append to the prompt content.
+            - text (str, optional): Additional text to append to the prompt content, followed by the relevant
+              documents when the prompt has a retriever.
+            - compact (bool, optional): Compact the prompt, see `compact`. Defaults to the `compact` argument of the constructor.
             
         Output:
             - Returns a formatted string containing the full prompt with sections, objectives, parameters, and restrictions.
         """
+        if compact if compact is not None else self.auto_compact:
+            self.last_compaction = self.compact(text)
+            return self.last_compaction.prompt
+        return self._render_full(self._content(text))
+
+    def _content(self, text):
+        if text and self.retriever is not None:
+            return self.retriever.augment(text)
+        return text
+
+    def _render_full(self, text) -> str:
+        return self._render(
+            self.role_description, self.intro, self.objective_delimiter.join(self.objectives),
+            self.parameter_delimiter.join(self.parameters), self.how,
+            self.restriction_delimiter.join(self.restrictions), self.format, text
+        )
+
+    def compact(self, text: str = None, budgets: dict = None, similarity: float = None) -> PromptCompaction:
+        """
+        Generates the prompt with fewer tokens: the whitespace of the template sections is normalized,
+        near-identical objectives, restrictions and parameters are removed, and every section is cut to
+        its token budget. List sections drop their lowest priority items first (the latest added among
+        equal priorities), other sections are truncated. The content (text and retrieved documents) is
+        only cut to its budget, and the list items are joined with their configured delimiters. The
+        objectives, restrictions and parameters lists are not modified.
+        
+        Input:
+            - text (str, optional): Additional text to append to the prompt content.
+            - budgets (dict, optional): Token budgets per section, merged over the ones of the constructor.
+            - similarity (float, optional): Ratio from 0 to 1 above which two items are duplicates, defaults to 0.9.
+            
+        Output:
+            - Returns a PromptCompaction with the prompt and the tokens saved.
+        """
+        budgets = {**self.budgets, **(budgets or {})}
+        unknown = set(budgets) - set(SECTIONS)
+        if unknown:
+            raise ValueError(f"Unknown prompt sections {sorted(unknown)}, expected some of {list(SECTIONS)}")
+        similarity = self.similarity if similarity is None else similarity
+        text = self._content(text)
+        removed = []
+
+        values = {}
+        for section, items, delimiter in (('objectives', self.objectives, self.objective_delimiter),
+                                          ('parameters', self.parameters, self.parameter_delimiter),
+                                          ('restrictions', self.restrictions, self.restriction_delimiter)):
+            priorities = self.priorities[section]
+            entries = [(normalize_whitespace(item), priorities.get(item, 0)) for item in items]
+            entries = self._dedupe(section, [entry for entry in entries if entry[0]], similarity, removed)
+            values[section] = delimiter.join(self._fit(section, entries, budgets.get(section), removed))
+        for section, value in (('role', self.role_description), ('intro', self.intro), ('how', self.how), ('format', self.format)):
+            values[section] = normalize_whitespace(value)
+        values['content'] = text or ''
+        for section in ('role', 'intro', 'how', 'format', 'content'):
+            if budgets.get(section) is not None:
+                values[section] = truncate_tokens(values[section], budgets[section])
+
+        # The whitespace of the template is normalized around markers, replaced by the sections afterwards
+        markers = {section: f"\x00{section}\x00" for section in SECTIONS}
+        skeleton = self._render(*(markers[section] if values[section] else '' for section in SECTIONS))
+        prompt = normalize_whitespace(skeleton)
+        for section in SECTIONS:
+            prompt = prompt.replace(markers[section], values[section])
+        prompt += '\n'
+        return PromptCompaction(prompt, count_tokens(self._render_full(text)), count_tokens(prompt), removed)
+
+    @staticmethod
+    def _dedupe(section: str, entries: list, similarity: float, removed: list) -> list:
+        kept = []
+        keys = []
+        for text, priority in entries:
+            key = re.sub(r"[^\w\s]", '', text.casefold())
+            for index, other in enumerate(keys):
+                matcher = SequenceMatcher(None, key, other, autojunk=False)
+                # quick_ratio bounds ratio from above and is much cheaper
+                if key == other or (matcher.quick_ratio() >= similarity and matcher.ratio() >= similarity):
+                    if priority > kept[index][1]:
+                        removed.append((section, kept[index][0], 'duplicate'))
+                        kept[index] = (text, priority)
+                        keys[index] = key
+                    else:
+                        removed.append((section, text, 'duplicate'))
+                    break
+            else:
+                kept.append((text, priority))
+                keys.append(key)
+        return kept
+
+    @staticmethod
+    def _fit(section: str, entries: list, budget: int | None, removed: list) -> list[str]:
+        if budget is None:
+            return [text for text, _ in entries]
+        order = sorted(range(len(entries)), key=lambda index: (-entries[index][1], index))
+        kept = {}
+        used = 0
+        for position, index in enumerate(order):
+            text = entries[index][0]
+            tokens = count_tokens(text)
+            if used + tokens > budget:
+                if not kept and budget > 0:
+                    # Not even the most important item fits, keep its beginning
+                    kept[index] = truncate_tokens(text, budget)
+                removed.extend((section, entries[other][0], 'budget') for other in order[position:] if other not in kept)
+                break
+            kept[index] = text
+            used += tokens
+        return [kept[index] for index in sorted(kept)]
+
+    def _render(self, role, intro, objectives, parameters, how, restrictions, output_format, text) -> str:
         # Construct each section using the helper method
-        role_text = self._format_section(self.role_connector, self.role_description)
-        intro_text = self._format_section(self.intro_connector, self.intro)
-        objectives_text = self._format_section(self.objectives_connector, self.objective_delimiter.join(self.objectives))
-        how_text = self._format_section(self.how_connector, self.how)
-        restrictions_text = self._format_section(self.restrictions_connector, self.restriction_delimiter.join(self.restrictions))
-        parameters_text = self._format_section(self.parameter_connector, self.parameter_delimiter.join(self.parameters))
-        format_text = self._format_section(self.format_connector, self.format)
+        role_text = self._format_section(self.role_connector, role)
+        intro_text = self._format_section(self.intro_connector, intro)
+        objectives_text = self._format_section(self.objectives_connector, objectives)
+        how_text = self._format_section(self.how_connector, how)
+        restrictions_text = self._format_section(self.restrictions_connector, restrictions)
+        parameters_text = self._format_section(self.parameter_connector, parameters)
+        format_text = self._format_section(self.format_connector, output_format)
         content_text = f"Content to perform the objective: {text}" if text else ""
 
         # Populate the output format with the formatted sections
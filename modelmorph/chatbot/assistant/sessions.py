@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+from typing import Callable
+from modelmorph.chatbot.domain.messages import MessageStore, SpillFile
+from modelmorph.deadline import Deadline, use_deadline
+from .chat import Chat
+
+
+class ChatSessions:
+    """
+    In-memory chats of a process, by chat id. The least recently used chats are saved and dropped
+    beyond max_sessions, and the messages of chats idle for more than idle_seconds are spilled to a
+    local file with `spill_idle`, they are paged back in when the chat is used again. Chats taken
+    with `use` are neither dropped nor spilled until the block ends.
+    """
+
+    def __init__(self, factory: Callable[[object], Chat], max_sessions: int = 10000, idle_seconds: float = 300.0, spill_path: str = None):
+        """
+        Initializes the sessions.
+
+        Args:
+            factory (Callable): Builds the Chat of a chat id not in memory.
+            max_sessions (int): Chats kept in memory.
+            idle_seconds (float): Time without use after which the messages of a chat are spilled.
+            spill_path (str, optional): File receiving the spilled messages, defaults to one in the temp directory.
+        """
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.spill_path = spill_path or os.path.join(tempfile.gettempdir(), f'modelmorph-sessions-{os.getpid()}.spill')
+        self._spill_file = None
+        self._sessions = OrderedDict()
+        self._last_used = {}
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    def get(self, chat_id) -> Chat:
+        """
+        Returns the chat of chat_id, building it with the factory when it is not in memory.
+
+        Args:
+            chat_id: Identifier of the chat.
+
+        Returns:
+            Chat: The chat, marked as used now.
+        """
+        evicted = []
+        with self._lock:
+            chat = self._sessions.get(chat_id)
+            if chat is None:
+                chat = self.factory(chat_id)
+                self._sessions[chat_id] = chat
+            self._sessions.move_to_end(chat_id)
+            self._last_used[chat_id] = time.monotonic()
+            if len(self._sessions) > self.max_sessions:
+                # Least recently used first, the chats in use stay (beyond max_sessions if needed)
+                for evicted_id in list(self._sessions):
+                    if len(self._sessions) <= self.max_sessions:
+                        break
+                    if evicted_id == chat_id or evicted_id in self._in_use:
+                        continue
+                    evicted.append(self._sessions.pop(evicted_id))
+                    self._last_used.pop(evicted_id, None)
+        if evicted:
+            # Saved even when the request evicting them has no time left, under no deadline
+            with use_deadline(Deadline()):
+                for evicted_chat in evicted:
+                    evicted_chat._persist()
+        return chat
+
+    @contextmanager
+    def use(self, chat_id):
+        """
+        Returns the chat of chat_id, as `get`, for the block: it is not dropped nor spilled before the block ends.
+
+        Args:
+            chat_id: Identifier of the chat.
+
+        Yields:
+            Chat: The chat.
+        """
+        with self._lock:
+            self._in_use[chat_id] = self._in_use.get(chat_id, 0) + 1
+        try:
+            yield self.get(chat_id)
+        finally:
+            with self._lock:
+                count = self._in_use.pop(chat_id) - 1
+                if count:
+                    self._in_use[chat_id] = count
+
+    def spill_idle(self, now: float = None, busy=()) -> int:
+        """
+        Spills the messages of the chats not used for idle_seconds. The file is written outside of
+        the lock of the sessions, each store holding its own lock while it is spilled.
+
+        Args:
+            now (float, optional): Current `time.monotonic()` value.
+            busy (Container, optional): Ids of the chats with a request running, they are not spilled
+                even when their last `get` is older than idle_seconds (e.g. a long streamed answer).
+
+        Returns:
+            int: Number of chats spilled by this call.
+        """
+        now = time.monotonic() if now is None else now
+        idle = []
+        with self._lock:
+            for chat_id, chat in self._sessions.items():
+                if now - self._last_used[chat_id] < self.idle_seconds:
+                    # Sessions are in use order, the remaining ones are more recent
+                    break
+                messages = chat.chat["messages"]
+                if chat_id not in busy and chat_id not in self._in_use and isinstance(messages, MessageStore) and not messages.spilled:
+                    idle.append(messages)
+            if idle and self._spill_file is None:
+                self._spill_file = SpillFile(self.spill_path)
+            spill_file = self._spill_file
+        for messages in idle:
+            messages.spill(spill_file)
+        return len(idle)
+
+    def pop(self, chat_id) -> Chat | None:
+        """
+        Removes a chat from memory without saving it.
+        """
+        with self._lock:
+            self._last_used.pop(chat_id, None)
+            return self._sessions.pop(chat_id, None)
+
+    def values(self) -> list[Chat]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def close(self):
+        """
+        Saves every chat in memory and removes the spill file.
+        """
+        for chat in self.values():
+            chat.save_chat()
+        with self._lock:
+            self._sessions.clear()
+            self._last_used.clear()
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
@@ -0,0 +1,100 @@
+import functools
+import json
+from typing import NamedTuple, Optional
+
+import jiter
+from pydantic import BaseModel, Field, TypeAdapter, create_model
+
+
+class OutputValidators(NamedTuple):
+    """
+    Validators compiled once per output model, see `get_output_validators`.
+
+    Attributes:
+        adapter (TypeAdapter): Validates the complete JSON document into the output model.
+        partial_model (type[BaseModel]): Copy of the output model with every field optional, used for partial objects.
+        schema (str): Compact JSON schema of the output model, sent to the language model.
+    """
+    adapter: TypeAdapter
+    partial_model: type
+    schema: str
+
+
+@functools.lru_cache(maxsize=None)
+def get_output_validators(output_model: type[BaseModel]) -> OutputValidators:
+    """
+    Builds the validators of a structured output model. The result is cached per model type,
+    so the pydantic core schemas are only compiled the first time a model is used.
+
+    Input:
+        - output_model (type[BaseModel]): Pydantic model describing the expected JSON object.
+
+    Output:
+        - Returns the OutputValidators of the model.
+    """
+    partial_fields = {
+        name: (Optional[field.annotation], Field(None, alias=field.alias))
+        for name, field in output_model.model_fields.items()
+    }
+    return OutputValidators(
+        adapter=TypeAdapter(output_model),
+        partial_model=create_model(f'Partial{output_model.__name__}', **partial_fields),
+        schema=json.dumps(output_model.model_json_schema(), separators=(',', ':')),
+    )
+
+
+class StructuredOutputParser:
+    """
+    Incremental parser of a streamed JSON object. Chunks are accumulated and parsed with jiter in
+    partial mode, and a validated partial object is produced each time a top level field completes.
+
+    Attributes:
+        output_model (type[BaseModel]): Pydantic model of the expected JSON object.
+        validators (OutputValidators): Cached validators of the output model.
+    """
+
+    def __init__(self, output_model: type[BaseModel]):
+        self.output_model = output_model
+        self.validators = get_output_validators(output_model)
+        self._buffer = bytearray()
+        self._completed_fields = 0
+
+    def feed(self, chunk: str):
+        """
+        Adds a chunk of the streamed response.
+
+        Input:
+            - chunk (str): Next piece of the JSON text.
+
+        Output:
+            - Returns a validated instance of the partial model when new top level fields completed, otherwise None.
+        """
+        self._buffer += chunk.encode()
+        # A top level field can only complete when a separator or the closing brace arrives
+        if ',' not in chunk and '}' not in chunk:
+            return None
+        try:
+            data = jiter.from_json(bytes(self._buffer), partial_mode='on')
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        # Fields are written in order, so every key but the last one already has its final value
+        keys = list(data)[:-1]
+        if len(keys) <= self._completed_fields:
+            return None
+        self._completed_fields = len(keys)
+        return self.validators.partial_model.model_validate({key: data[key] for key in keys})
+
+    def result(self):
+        """
+        Validates the complete response.
+
+        Output:
+            - Returns the instance of the output model.
+
+        Raises:
+            ValidationError: If the response is not valid JSON or does not match the output model.
+        """
+        return self.validators.adapter.validate_json(bytes(self._buffer))
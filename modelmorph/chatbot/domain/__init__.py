@@ -1 +1 @@
-from .llm import Llm
\ No newline at end of file
+from .llm import Llm
@@ -1,8 +1,12 @@
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import json
-from modelmorph.db.repository import DBRepository
+import threading
 
 class Llm(metaclass=ABCMeta):
+
+    # Embeddings kept in memory by get_embeddings, per model instance
+    embedding_cache_size = 10000
     
     @abstractmethod
     def get_response_message(self, message: str, option: str):
@@ -36,3 +40,107 @@ class Llm(metaclass=ABCMeta):
             Must be implemented in any subclass of Llm.
         """
         raise NotImplementedError
+
+    def stream_response_message(self, message: str, system_message: str, **kwargs):
+        """
+        Streams the response to a single prompt message as text deltas.
+        
+        Input:
+            - message (str): The input message or prompt for which a response is needed.
+            - system_message (str): Optional system message sent before the prompt.
+            - kwargs: Generation options supported by the implementation (max_tokens, temperature...).
+            
+        Output:
+            - Returns an iterator of str with the generated text as it arrives.
+            
+        Note:
+            Optional; implementations without streaming support raise NotImplementedError.
+        """
+        raise NotImplementedError
+
+    def stream_response_chat(self, chat: list, **kwargs):
+        """
+        Streams the response to a chat history as text deltas.
+        
+        Input:
+            - chat (list): Messages of the conversation, with roles and content.
+            - kwargs: Generation options supported by the implementation (max_tokens, temperature...).
+            
+        Output:
+            - Returns an iterator of str with the generated text as it arrives.
+            
+        Note:
+            Optional; implementations without streaming support raise NotImplementedError.
+        """
+        raise NotImplementedError
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Computes the embeddings of a batch of texts with a single request to the model.
+        
+        Input:
+            - texts (list of str): Texts to embed.
+            
+        Output:
+            - Returns one vector (list of float) per text, in the same order.
+            
+        Note:
+            Optional; implementations without embeddings support raise NotImplementedError.
+            Callers use `get_embeddings`, which adds batching and caching.
+        """
+        raise NotImplementedError
+
+    def get_embeddings(self, texts: list[str], batch_size: int = 64) -> list[list[float]]:
+        """
+        Returns the embeddings of the texts. Texts already embedded by this model are served from an
+        in-memory LRU cache, the others are sent to `embed_batch` in batches of batch_size.
+        
+        Input:
+            - texts (list of str): Texts to embed, duplicates are embedded once.
+            - batch_size (int): Maximum number of texts per request.
+            
+        Output:
+            - Returns one vector (list of float) per text, in the same order.
+        """
+        cache = self.__dict__.get('_embedding_cache')
+        if cache is None:
+            cache = self.__dict__.setdefault('_embedding_cache', _EmbeddingCache(self.embedding_cache_size))
+        vectors = {}
+        missing = []
+        for text in texts:
+            if text in vectors:
+                continue
+            vector = cache.get(text)
+            if vector is None:
+                missing.append(text)
+                vectors[text] = None
+            else:
+                vectors[text] = vector
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            for text, vector in zip(batch, self.embed_batch(batch)):
+                vectors[text] = vector
+                cache.set(text, vector)
+        return [vectors[text] for text in texts]
+
+
+class _EmbeddingCache:
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str):
+        with self._lock:
+            vector = self._entries.get(text)
+            if vector is not None:
+                self._entries.move_to_end(text)
+            return vector
+
+    def set(self, text: str, vector):
+        with self._lock:
+            self._entries[text] = vector
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
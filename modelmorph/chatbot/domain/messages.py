@@ -0,0 +1,343 @@
+from array import array
+from collections.abc import MutableSequence, Sequence
+import json
+import mmap
+import os
+import sys
+import threading
+
+# Role names are stored once, messages keep a one byte index into this list
+ROLES = ['system', 'user', 'assistant', 'tool']
+_ROLE_IDS = {role: index for index, role in enumerate(ROLES)}
+_roles_lock = threading.Lock()
+
+
+def role_id(role: str) -> int:
+    """
+    Returns the index of an interned role name, registering new roles on first use.
+    """
+    index = _ROLE_IDS.get(role)
+    if index is None:
+        with _roles_lock:
+            index = _ROLE_IDS.get(role)
+            if index is None:
+                if len(ROLES) >= 256:
+                    raise ValueError("Too many distinct message roles")
+                index = len(ROLES)
+                ROLES.append(sys.intern(role))
+                _ROLE_IDS[ROLES[index]] = index
+    return index
+
+
+class MessageStore(MutableSequence):
+    """
+    Compact list of chat messages. Roles are kept as one byte each in an array and contents in a
+    plain list, instead of one dict per message with repeated 'role'/'content' keys. Reading an item
+    builds the usual {'role', 'content', ...} dict, so the store can be used wherever a list of
+    messages was expected.
+
+    The messages can be spilled to a `SpillFile` with `spill`; any later access pages them back in.
+    Spilling, paging in and every access hold the lock of the store, so a store can be spilled from
+    another thread than the one adding messages.
+    """
+
+    __slots__ = ('_roles', '_contents', '_extras', '_spilled', '_spill_file', '_released', '_lock')
+
+    def __init__(self, messages=()):
+        """
+        Initializes the store.
+
+        Input:
+            - messages (iterable of dict): Initial messages with 'role' and 'content' keys, other keys are kept too.
+        """
+        self._roles = array('B')
+        self._contents = []
+        self._extras = []
+        self._spilled = None
+        self._spill_file = None
+        self._released = False
+        self._lock = threading.RLock()
+        for message in messages:
+            self.append(message)
+
+    def __len__(self):
+        with self._lock:
+            self._page_in()
+            return len(self._contents)
+
+    def __getitem__(self, index):
+        with self._lock:
+            self._page_in()
+            if isinstance(index, slice):
+                return [self._message(i) for i in range(len(self._contents))[index]]
+            if index < 0:
+                index += len(self._contents)
+            if not 0 <= index < len(self._contents):
+                raise IndexError('message index out of range')
+            return self._message(index)
+
+    def __setitem__(self, index, message):
+        if isinstance(index, slice):
+            raise TypeError('MessageStore does not support slice assignment')
+        role, content, extra = self._split(message)
+        with self._lock:
+            self._page_in()
+            self._roles[index] = role
+            self._contents[index] = content
+            self._extras[index] = extra
+
+    def __delitem__(self, index):
+        with self._lock:
+            self._page_in()
+            del self._roles[index]
+            del self._contents[index]
+            del self._extras[index]
+
+    def insert(self, index, message):
+        role, content, extra = self._split(message)
+        with self._lock:
+            self._page_in()
+            self._roles.insert(index, role)
+            self._contents.insert(index, content)
+            self._extras.insert(index, extra)
+
+    def append(self, message):
+        role, content, extra = self._split(message)
+        with self._lock:
+            self._page_in()
+            self._roles.append(role)
+            self._contents.append(content)
+            self._extras.append(extra)
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageStore, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"MessageStore({self.to_list()!r})"
+
+    def to_list(self) -> list[dict]:
+        """
+        Returns the messages as a list of dicts, e.g. to store them in the database.
+        """
+        with self._lock:
+            self._page_in()
+            return [self._message(i) for i in range(len(self._contents))]
+
+    def view(self, head=()) -> 'MessageView':
+        """
+        Returns a read-only view of head followed by the stored messages, without copying them.
+        """
+        return MessageView(list(head), self)
+
+    @property
+    def spilled(self) -> bool:
+        return self._spilled is not None
+
+    def spill(self, spill_file: 'SpillFile'):
+        """
+        Writes the messages to the spill file and releases them from memory. They are read back
+        transparently on the next access.
+
+        Input:
+            - spill_file (SpillFile): File receiving the serialized messages.
+        """
+        with self._lock:
+            if self._spilled is not None or self._released:
+                return
+            payload = json.dumps([list(self._roles), self._contents, self._extras], separators=(',', ':')).encode()
+            self._spilled = spill_file.write(payload)
+            self._spill_file = spill_file
+            self._roles = array('B')
+            self._contents = []
+            self._extras = []
+
+    def release(self):
+        """
+        Empties the store, freeing its spilled messages without reading them back, when the store is
+        replaced (e.g. by a trimmed copy). A released store is not spilled anymore.
+        """
+        with self._lock:
+            if self._spilled is not None:
+                self._spill_file.free(self._spilled)
+                self._spilled = None
+                self._spill_file = None
+            self._roles = array('B')
+            self._contents = []
+            self._extras = []
+            self._released = True
+
+    def __del__(self):
+        # A store dropped while spilled frees its segment
+        spill_file = getattr(self, '_spill_file', None)
+        if spill_file is not None:
+            try:
+                spill_file.free(self._spilled)
+            except (ValueError, OSError):
+                # The spill file was closed first
+                pass
+
+    def _page_in(self):
+        # Called with the lock held
+        if self._spilled is None:
+            return
+        roles, contents, extras = json.loads(self._spill_file.read(self._spilled))
+        self._spill_file.free(self._spilled)
+        self._roles = array('B', roles)
+        self._contents = contents
+        self._extras = extras
+        self._spilled = None
+        self._spill_file = None
+
+    def _message(self, index: int) -> dict:
+        message = {'role': ROLES[self._roles[index]], 'content': self._contents[index]}
+        extra = self._extras[index]
+        if extra:
+            message.update(extra)
+        return message
+
+    @staticmethod
+    def _split(message: dict):
+        extra = {key: value for key, value in message.items() if key not in ('role', 'content')} or None
+        return role_id(message['role']), message.get('content'), extra
+
+
+class MessageView(Sequence):
+    """
+    Read-only sequence of head messages followed by a message list, given to the model APIs
+    so the system prompt is not inserted into the stored chat history on every turn.
+    """
+
+    __slots__ = ('_head', '_messages')
+
+    def __init__(self, head: list, messages: Sequence):
+        self._head = head
+        self._messages = messages
+
+    def __len__(self):
+        return len(self._head) + len(self._messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if index < len(self._head):
+            return self._head[index]
+        return self._messages[index - len(self._head)]
+
+    def __iter__(self):
+        yield from self._head
+        yield from self._messages
+
+
+class SpillFile:
+    """
+    File holding spilled message stores, read back through a memory map. Each store is written to a
+    segment of its own, identified by the key returned by `write`. Freed segments are reclaimed: the
+    file is cut after its last used segment, and compacted, the used segments moved to its start,
+    once more than half of it is free.
+    """
+
+    def __init__(self, path: str, min_compact_bytes: int = 1024 * 1024):
+        """
+        Opens (and empties) the spill file.
+
+        Input:
+            - path (str): Path of the spill file.
+            - min_compact_bytes (int): Size below which the file is not compacted.
+        """
+        self.path = path
+        self.min_compact_bytes = min_compact_bytes
+        self._file = open(path, 'w+b')
+        self._map = None
+        self._size = 0
+        self._used = 0
+        self._segments = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes) -> int:
+        """
+        Appends data to the file.
+
+        Output:
+            - Returns the key of the segment holding data.
+        """
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._used += len(data)
+            key = self._next_key
+            self._next_key += 1
+            self._segments[key] = (offset, len(data))
+            return key
+
+    def read(self, key: int) -> bytes:
+        """
+        Reads the data of a segment.
+        """
+        with self._lock:
+            offset, length = self._segments[key]
+            if self._map is None or len(self._map) < offset + length:
+                self._close_map()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length]
+
+    def free(self, key: int):
+        """
+        Marks a segment as no longer used, reclaiming its space when it ends the file, or by a compaction.
+        """
+        with self._lock:
+            segment = self._segments.pop(key, None)
+            if segment is None:
+                return
+            self._used -= segment[1]
+            if sum(segment) == self._size:
+                self._truncate(max((sum(other) for other in self._segments.values()), default=0))
+            elif self._size >= self.min_compact_bytes and self._used * 2 < self._size:
+                self._compact()
+
+    def _compact(self):
+        # Called with the lock held: moves the used segments to the start of the file, in place
+        self._close_map()
+        position = 0
+        for key, (offset, length) in sorted(self._segments.items(), key=lambda item: item[1][0]):
+            if offset != position:
+                self._file.seek(offset)
+                data = self._file.read(length)
+                self._file.seek(position)
+                self._file.write(data)
+                self._segments[key] = (position, length)
+            position += length
+        self._file.flush()
+        self._truncate(position)
+
+    def _truncate(self, size: int):
+        # Called with the lock held
+        self._close_map()
+        self._file.truncate(size)
+        self._size = size
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def close(self, remove: bool = True):
+        """
+        Closes the file, removing it from disk by default.
+        """
+        with self._lock:
+            self._close_map()
+            self._file.close()
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
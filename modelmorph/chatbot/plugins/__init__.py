@@ -1 +1,12 @@
-from .nlpToSql import NlpToSql
\ No newline at end of file
+from modelmorph._lazy import attach
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['nlpToSql', 'plugin', 'sql_validator', 'tools'],
+    attributes={
+        'nlpToSql': ['NlpToSql'],
+        'plugin': ['Plugin'],
+        'sql_validator': ['SqlValidator'],
+        'tools': ['ToolExecutor'],
+    },
+)
@@ -1,5 +1,17 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from .plugin import Plugin
+from .sql_validator import SqlValidator, clean_sql, parse_prompt_schema, replace_prompt_schema
 from modelmorph.chatbot.domain import Llm
+from modelmorph.db.domain import DBRepository
+from modelmorph.db.schema_catalog import SchemaCatalog
+from modelmorph.settings import Settings
+from modelmorph.deadline import Deadline, use_deadline
+from modelmorph.tracing import span
+
+# Validators kept per plugin, the least recently used are dropped beyond
+MAX_VALIDATORS = 32
 
 class NlpToSql(Plugin):
     """
@@ -13,9 +25,13 @@ class NlpToSql(Plugin):
         The data of the loaded plugin.
     prompt_template : str
         The prompt template of the loaded plugin.
+    schema_text : str
+        Default tables of the '{{$schema}}' placeholder, from the 'schema.txt' file of the plugin.
+    schema : dict[str, list[str]]
+        Tables described in the schema file or the prompt template, used to validate the generated queries.
     """
 
-    def __init__(self, plugin_directory, plugin_name, llm: Llm):
+    def __init__(self, plugin_directory, plugin_name, llm: Llm, settings: Settings = None, validation_workers: int = 4):
         """
         Initializes the NlpToSql class with the specified directory, plugin name, and Llm instance.
 
@@ -27,21 +43,33 @@ class NlpToSql(Plugin):
             The name of the plugin to use.
         llm : Llm
             An instance of the Llm class.
+        settings : Settings, optional
+            Shared settings of the assistants using the plugin.
+        validation_workers : int
+            Threads validating the SQL candidates, kept for the life of the plugin so each one reuses
+            its SQLite stand-ins.
         
         Raises:
         ------
         ValueError:
             If the specified plugin is not found in the directory.
         """
-        super().__init__(plugin_directory, llm)
+        super().__init__(plugin_directory, llm, settings)
         self.plugin_name = plugin_name
         self.plugin_data = self.get_plugin(plugin_name)
         if self.plugin_data:
             self.prompt_template = self.plugin_data['prompt_template']
+            self.schema_text = self.plugin_data.get('schema', '')
+            self.schema = parse_prompt_schema(self.schema_text or self.prompt_template)
+            self._validators = OrderedDict()
+            self._validators_lock = threading.Lock()
+            self.validation_workers = validation_workers
+            self._pool = None
+            self._pool_lock = threading.Lock()
         else:
             raise ValueError(f"Plugin '{plugin_name}' not found in directory '{plugin_directory}'.")
 
-    def generate_sql(self, input_data):
+    def generate_sql(self, input_data, catalog: SchemaCatalog = None, top_k: int = 5, deadline: Deadline | float = None):
         """
         Generates an SQL query from the given natural language input using the loaded plugin.
 
@@ -49,6 +77,12 @@ class NlpToSql(Plugin):
         ----------
         input_data : str
             The natural language input to convert to an SQL query.
+        catalog : SchemaCatalog, optional
+            Catalog of the target database, only the top_k tables relevant to the input are added to the prompt.
+        top_k : int
+            Number of tables taken from the catalog.
+        deadline : Deadline or float, optional
+            Deadline of the request, or its timeout in seconds, defaults to the current one (see `use_deadline`).
 
         Returns:
         -------
@@ -59,17 +93,140 @@ class NlpToSql(Plugin):
         ------
         ValueError:
             If the plugin is not loaded properly.
+        DeadlineExceeded:
+            If the deadline is exhausted (RequestCancelled when the request is cancelled).
         """
         if not self.plugin_data:
             raise ValueError(f"Plugin '{self.plugin_name}' is not loaded properly.")
         
-        prompt = self.prompt_template.replace("{{$input}}", input_data)
+        with span('nlp_to_sql.generate', plugin=self.plugin_name), use_deadline(deadline) as request_deadline:
+            with span('nlp_to_sql.prompt'):
+                prompt, _ = self._render_prompt(input_data, catalog, top_k)
+
+            settings = self.plugin_data['settings']
+            if request_deadline is not None:
+                request_deadline.check('model request')
+            with span('nlp_to_sql.model') as model_span:
+                response = self.llm.get_response_message(prompt, max_tokens=settings.max_tokens, temperature=settings.temperature, top_p=settings.top_p, n=settings.n, stop=settings.stop, type_object='text')
+                model_span.record_usage(response)
+            return response
+
+    def generate_valid_sql(self, input_data, n=None, schema: dict = None, repository: DBRepository = None, catalog: SchemaCatalog = None, top_k: int = 5, deadline: Deadline | float = None):
+        """
+        Requests several SQL candidates in a single call and validates them in parallel,
+        returning the first valid one in the order of the choices. Avoids a second round trip
+        to the model when the first query does not parse or references unknown tables.
+
+        Parameters:
+        ----------
+        input_data : str
+            The natural language input to convert to an SQL query.
+        n : int, optional
+            Number of candidates, defaults to the 'n' of the plugin config.
+            Use a temperature above 0 in the plugin config to get different candidates.
+        schema : dict[str, list[str]], optional
+            Columns by table name, defaults to the catalog tables, or the tables described in the plugin prompt.
+        repository : DBRepository, optional
+            Target repository, validates with its 'EXPLAIN' instead of the in-memory SQLite stand-in.
+            Needed when the queries are not in the SQLite dialect (e.g. SQL Server), see `SqlValidator`.
+        catalog : SchemaCatalog, optional
+            Catalog of the target database, only the top_k tables relevant to the input are added to the prompt.
+        top_k : int
+            Number of tables taken from the catalog.
+        deadline : Deadline or float, optional
+            Deadline of the request, or its timeout in seconds. The validation is skipped once it is exhausted.
+
+        Returns:
+        -------
+        str:
+            The first valid SQL query.
+
+        Raises:
+        ------
+        ValueError:
+            If the plugin is not loaded properly or no candidate is valid.
+        DeadlineExceeded:
+            If the deadline is exhausted (RequestCancelled when the request is cancelled).
+        """
+        if not self.plugin_data:
+            raise ValueError(f"Plugin '{self.plugin_name}' is not loaded properly.")
+
+        settings = self.plugin_data['settings']
+        prompt, _ = self._render_prompt(input_data, catalog, top_k)
+        with use_deadline(deadline) as request_deadline:
+            response = self.llm.get_response_message(prompt, max_tokens=settings.max_tokens, temperature=settings.temperature, top_p=settings.top_p, n=n or settings.n, stop=settings.stop, type_object='text')
+            if request_deadline is not None:
+                request_deadline.check('SQL validation')
+
+        # Identical candidates are only validated once
+        candidates = list(dict.fromkeys(clean_sql(choice.message.content or '') for choice in response.choices))
+        validator = self._get_validator(schema or (catalog.tables if catalog else self.schema), repository)
+
+        futures = [self._validation_pool().submit(validator.validate, candidate) for candidate in candidates]
+        errors = []
+        try:
+            for candidate, future in zip(candidates, futures):
+                error = future.result()
+                if not error:
+                    return candidate
+                errors.append(f"{candidate!r}: {error}")
+        finally:
+            # The candidates after the valid one are not validated
+            for future in futures:
+                future.cancel()
+
+        raise ValueError(f"No valid SQL candidate for '{input_data}': " + "; ".join(errors))
+
+    def _render_prompt(self, input_data, catalog: SchemaCatalog = None, top_k: int = 5):
+        """
+        Fills the plugin prompt. The '{{$schema}}' placeholder gets the relevant tables of the catalog,
+        or the default tables of the plugin without a catalog. With a catalog and a prompt pasting its
+        tables instead of the placeholder, the pasted tables are replaced by the relevant ones.
+
+        Returns:
+        -------
+        tuple[str, dict or None]:
+            The prompt and the tables taken from the catalog.
+        """
+        if catalog is None:
+            return self.prompt_template.replace("{{$schema}}", self.schema_text).replace("{{$input}}", input_data), None
+
+        tables = catalog.select(input_data, top_k)
+        schema_text = catalog.render(tables)
+        if "{{$schema}}" in self.prompt_template:
+            prompt = self.prompt_template.replace("{{$schema}}", schema_text)
+        elif parse_prompt_schema(self.prompt_template):
+            prompt = replace_prompt_schema(self.prompt_template, schema_text)
+        else:
+            return self.prompt_template.replace("{{$input}}", f"{input_data} using the tables:\n{schema_text}\n"), tables
+        return prompt.replace("{{$input}}", input_data), tables
+
+    def close(self):
+        """
+        Stops the threads validating the SQL candidates.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
 
-        max_tokens = self.plugin_data['config'].get('max_tokens', 100)
-        temperature = self.plugin_data['config'].get('temperature', 0)
-        top_p = self.plugin_data['config'].get('top_p', 1.0)
-        n = self.plugin_data['config'].get('n', 1)
-        stop = self.plugin_data['config'].get('stop', ["\n"])
+    def _validation_pool(self) -> ThreadPoolExecutor:
+        # Long lived: the SQLite stand-ins of the validators are kept per thread
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.validation_workers, thread_name_prefix='modelmorph-sql-validation')
+            return self._pool
 
-        response = self.llm.get_response_message(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stop=stop)
-        return response
\ No newline at end of file
+    def _get_validator(self, schema: dict, repository: DBRepository) -> SqlValidator:
+        # Validators keep their SQLite stand-ins, so they are reused for the same schema and repository.
+        # A kept validator references its repository, whose id can not be reused meanwhile
+        key = (tuple((table, tuple(columns)) for table, columns in schema.items()), id(repository))
+        with self._validators_lock:
+            validator = self._validators.get(key)
+            if validator is None:
+                validator = self._validators[key] = SqlValidator(schema, repository)
+                if len(self._validators) > MAX_VALIDATORS:
+                    self._validators.popitem(last=False)
+            else:
+                self._validators.move_to_end(key)
+            return validator
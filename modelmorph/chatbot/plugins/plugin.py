@@ -1,6 +1,7 @@
 import os
-import json
-from modelmorph.chatbot.repository import Llm
+from modelmorph.chatbot.domain import Llm
+from modelmorph.settings import Settings, load_plugin_settings, load_settings
+from modelmorph.tracing import span
 
 class Plugin:
     """
@@ -14,9 +15,11 @@ class Plugin:
         A dictionary to store loaded plugins.
     llm : Llm
         An instance of the Llm class.
+    settings : Settings
+        Shared settings of the assistants using the plugin.
     """
 
-    def __init__(self, plugin_directory, llm: Llm):
+    def __init__(self, plugin_directory, llm: Llm, settings: Settings = None):
         """
         Initializes the Plugin class with the specified directory and Llm instance.
 
@@ -26,17 +29,22 @@ class Plugin:
             The directory where plugins are stored.
         llm : Llm
             An instance of the Llm class.
+        settings : Settings, optional
+            Shared settings, defaults to the environment only settings from `load_settings`.
         """
         self.plugin_directory = plugin_directory
         self.plugins = {}
         self.llm = llm
+        self.settings = settings or load_settings()
 
         self.load_plugins()
 
     def load_plugins(self):
         """
         Loads plugins from the specified directory. Each plugin must have a 'config.json' 
-        and 'skprompt.txt' file. The plugins are stored in the 'plugins' dictionary.
+        and 'skprompt.txt' file, and can have a 'schema.txt' file filling the '{{$schema}}'
+        placeholder of the prompt by default. The plugins are stored in the 'plugins' dictionary.
+        The 'config.json' files are parsed once per process into `PluginSettings`, see `load_plugin_settings`.
         
         Raises:
         ------
@@ -53,19 +61,26 @@ class Plugin:
             if os.path.isdir(plugin_path):
                 config_path = os.path.join(plugin_path, "config.json")
                 prompt_path = os.path.join(plugin_path, "skprompt.txt")
+                schema_path = os.path.join(plugin_path, "schema.txt")
 
                 if os.path.exists(config_path) and os.path.exists(prompt_path):
-                    with open(config_path, 'r') as config_file:
-                        config = json.load(config_file)
+                    settings = load_plugin_settings(config_path)
 
                     with open(prompt_path, 'r') as prompt_file:
                         prompt_template = prompt_file.read()
                         prompt_template = prompt_template.replace("\n", " ")
 
+                    schema = ""
+                    if os.path.exists(schema_path):
+                        with open(schema_path, 'r') as schema_file:
+                            schema = schema_file.read().strip().replace("\n", " ")
+
                     # Store the loaded plugin in the plugins dictionary
                     self.plugins[plugin_name] = {
-                        "config": config,
-                        "prompt_template": prompt_template
+                        "config": settings.model_dump(),
+                        "settings": settings,
+                        "prompt_template": prompt_template,
+                        "schema": schema
                     }
                 else:
                     raise ValueError(f"Plugin '{plugin_name}' is missing a required file.")
@@ -85,3 +100,63 @@ class Plugin:
             The plugin data if found, otherwise None.
         """
         return self.plugins.get(plugin_name, None)
+
+    def tool_definitions(self):
+        """
+        Describes the loaded plugins as function tools the model can call. Each tool receives
+        a single 'input' string that replaces the '{{$input}}' placeholder of the plugin prompt.
+
+        Returns:
+        -------
+        list[dict]:
+            Tool definitions in the chat completions 'tools' format.
+        """
+        return [
+            {
+                "type": "function",
+                "function": {
+                    "name": plugin_name,
+                    "description": plugin["settings"].description or plugin_name,
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "input": {"type": "string", "description": "Input text for the plugin prompt."}
+                        },
+                        "required": ["input"]
+                    }
+                }
+            }
+            for plugin_name, plugin in self.plugins.items()
+        ]
+
+    def run(self, plugin_name, input_data):
+        """
+        Renders the prompt of a plugin with the given input and returns the model answer.
+
+        Parameters:
+        ----------
+        plugin_name : str
+            The name of the plugin to run.
+        input_data : str
+            Text replacing the '{{$input}}' placeholder of the plugin prompt.
+
+        Returns:
+        -------
+        str:
+            Content of the first choice of the response.
+
+        Raises:
+        ------
+        ValueError:
+            If the plugin is not loaded.
+        """
+        plugin = self.get_plugin(plugin_name)
+        if not plugin:
+            raise ValueError(f"Plugin '{plugin_name}' is not loaded.")
+
+        settings = plugin['settings']
+        with span('plugin.run', plugin=plugin_name) as run_span:
+            prompt = plugin['prompt_template'].replace("{{$schema}}", plugin.get('schema', '')).replace("{{$input}}", input_data)
+            response = self.llm.get_response_message(prompt, max_tokens=settings.max_tokens, temperature=settings.temperature, top_p=settings.top_p, stop=settings.stop, type_object='text')
+            run_span.record_usage(response)
+        return response.choices[0].message.content
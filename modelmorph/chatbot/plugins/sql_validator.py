@@ -0,0 +1,130 @@
+import re
+import sqlite3
+import threading
+from modelmorph.db.domain import DBRepository
+from modelmorph.db.query_cache import is_read_only
+
+# Tables described in a prompt as "# TableName (Column1, Column2, ...)"
+_PROMPT_TABLE = re.compile(r"#\s*([A-Za-z_][\w.]*)\s*\(([^)]*)\)")
+_CODE_FENCE = re.compile(r"^```(?:sql)?|```$", re.IGNORECASE)
+# String literals, quoted identifiers and comments, a ';' inside them does not end the statement
+_NOT_CODE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?\*/""", re.S)
+
+
+def parse_prompt_schema(prompt_template: str) -> dict:
+    """
+    Extracts the tables listed in a plugin prompt.
+
+    Parameters:
+    ----------
+    prompt_template : str
+        Prompt describing tables as '# TableName (Column1, Column2, ...)'.
+
+    Returns:
+    -------
+    dict[str, list[str]]:
+        Columns of every table by table name.
+    """
+    return {
+        table: [column.strip() for column in columns.split(',') if column.strip()]
+        for table, columns in _PROMPT_TABLE.findall(prompt_template)
+    }
+
+
+def replace_prompt_schema(prompt_template: str, schema_text: str) -> str:
+    """
+    Replaces the tables listed in a plugin prompt by schema_text, placed where the first table was.
+    """
+    first = _PROMPT_TABLE.search(prompt_template)
+    if first is None:
+        return prompt_template
+    return prompt_template[:first.start()] + schema_text + _PROMPT_TABLE.sub('', prompt_template[first.end():])
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def clean_sql(candidate: str) -> str:
+    """
+    Removes code fences, surrounding whitespace and the trailing semicolon of a generated query.
+    """
+    return _CODE_FENCE.sub('', candidate.strip()).strip().rstrip(';').strip()
+
+
+class SqlValidator:
+    """
+    Validates generated SQL before it reaches the database. A query is valid when it is a single complete
+    read-only statement and `EXPLAIN` succeeds, either on an in-memory SQLite stand-in built from
+    the schema or on the target repository.
+
+    The stand-in parses SQLite SQL: queries in another dialect (e.g. SQL Server 'TOP n' or 'GETDATE()')
+    are rejected by it, give the target repository to validate them with its own 'EXPLAIN'.
+
+    Attributes:
+    ----------
+    schema : dict[str, list[str]]
+        Columns of every table by table name.
+    repository : DBRepository
+        Optional target repository used for `EXPLAIN` instead of the SQLite stand-in.
+    """
+
+    def __init__(self, schema: dict, repository: DBRepository = None):
+        """
+        Initializes the validator.
+
+        Parameters:
+        ----------
+        schema : dict[str, list[str]]
+            Columns of every table by table name.
+        repository : DBRepository, optional
+            Repository of the target database.
+        """
+        self.schema = schema
+        self.repository = repository
+        self._ddl = ";".join(
+            f"CREATE TABLE {_quote(table)} ({', '.join(_quote(column) for column in columns)})"
+            for table, columns in schema.items() if columns
+        )
+        self._local = threading.local()
+
+    def validate(self, sql: str) -> str:
+        """
+        Validates a query.
+
+        Parameters:
+        ----------
+        sql : str
+            Query to validate, already cleaned with `clean_sql`.
+
+        Returns:
+        -------
+        str:
+            The validation error, empty if the query is valid.
+        """
+        if not sql:
+            return "Empty query"
+        # Checked here, not left to the EXPLAIN of a repository whose driver may run several statements
+        if ';' in _NOT_CODE.sub(' ', sql).strip().rstrip(';'):
+            return "Query must be one statement"
+        if not is_read_only(sql):
+            return "Only SELECT queries are allowed"
+        if not sqlite3.complete_statement(sql + ';'):
+            return "Query must be one complete statement"
+
+        if self.repository is not None:
+            return self.repository.execute_query(f"EXPLAIN {sql}").error or ""
+        try:
+            self._connection().execute(f"EXPLAIN {sql}")
+        except sqlite3.Error as e:
+            return str(e)
+        return ""
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, each validating thread gets its own stand-in
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(':memory:')
+            connection.executescript(self._ddl)
+            self._local.connection = connection
+        return connection
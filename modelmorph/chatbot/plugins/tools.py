@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from modelmorph.deadline import Deadline, current_deadline, use_deadline
+from modelmorph.tracing import wrap
+from .plugin import Plugin
+
+
+class ToolExecutor:
+    """
+    Runs the tool calls requested by the model concurrently on a bounded thread pool.
+
+    The timeout of a call starts when a worker picks it up, not while it waits for one. The call runs
+    under its own `Deadline` (also cancelled with the request): model requests of the plugin get the
+    time left as their timeout and are aborted when it passes, so a timed out tool frees its worker.
+
+    Attributes:
+    ----------
+    max_workers : int
+        Maximum number of plugins running at the same time.
+    default_timeout : float
+        Seconds a tool call may take when its plugin config does not define a 'timeout'.
+    queue_timeout : float
+        Seconds a tool call may wait for a free worker.
+    """
+
+    def __init__(self, max_workers: int = 4, default_timeout: float = 30.0, queue_timeout: float = None):
+        """
+        Initializes the ToolExecutor and its thread pool.
+
+        Parameters:
+        ----------
+        max_workers : int
+            Maximum number of plugins running at the same time.
+        default_timeout : float
+            Default per tool timeout in seconds.
+        queue_timeout : float, optional
+            Seconds a tool call may wait for a free worker, defaults to default_timeout.
+        """
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self.queue_timeout = default_timeout if queue_timeout is None else queue_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='modelmorph-tool')
+
+    def execute(self, plugin: Plugin, tool_calls) -> list[dict]:
+        """
+        Executes every tool call of a model turn at once and waits for all of them, so the turn
+        costs the latency of the slowest tool instead of the sum of all of them.
+
+        Parameters:
+        ----------
+        plugin : Plugin
+            Plugin manager holding the plugins exposed as tools.
+        tool_calls : list
+            Tool calls of the assistant message (objects with 'id' and 'function.name'/'function.arguments').
+
+        Returns:
+        -------
+        list[dict]:
+            One 'tool' message per call, in the same order. Failures and timeouts are reported in the content.
+        """
+        request_deadline = current_deadline()
+        runs = []
+        for call in tool_calls:
+            plugin_data = plugin.get_plugin(call.function.name)
+            timeout = (plugin_data and plugin_data['settings'].timeout) or self.default_timeout
+            run = _ToolRun(timeout, request_deadline)
+            runs.append((call, run, self._pool.submit(wrap(self._run_call), plugin, call, run)))
+
+        queued_until = time.monotonic() + (self.queue_timeout if request_deadline is None else request_deadline.timeout(self.queue_timeout))
+        messages = []
+        for call, run, future in runs:
+            name = call.function.name
+            if not run.started.wait(max(0.0, queued_until - time.monotonic())) and future.cancel():
+                content = f"Error: tool '{name}' did not start within {self.queue_timeout} seconds, every tool worker is busy."
+            else:
+                run.started.wait()
+                try:
+                    content = future.result(timeout=run.deadline.remaining())
+                except FutureTimeoutError:
+                    # The model request of the tool is aborted, its worker is released
+                    run.deadline.cancel('timed out')
+                    content = f"Error: tool '{name}' timed out after {run.timeout} seconds."
+                except Exception as e:
+                    content = f"Error: tool '{name}' failed: {e}"
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": content})
+        return messages
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the thread pool.
+        """
+        self._pool.shutdown(wait=wait)
+
+    @staticmethod
+    def _run_call(plugin: Plugin, call, run: '_ToolRun') -> str:
+        run.start()
+        try:
+            with use_deadline(run.deadline):
+                run.deadline.check(f"tool '{call.function.name}'")
+                arguments = json.loads(call.function.arguments or '{}')
+                return plugin.run(call.function.name, arguments.get('input', ''))
+        finally:
+            run.finish()
+
+
+class _ToolRun:
+    """
+    Deadline of a tool call, created when a worker starts it.
+    """
+
+    __slots__ = ('timeout', 'request_deadline', 'deadline', 'started', '_unregister')
+
+    def __init__(self, timeout: float, request_deadline: Deadline = None):
+        self.timeout = timeout
+        self.request_deadline = request_deadline
+        self.deadline = None
+        self.started = threading.Event()
+        self._unregister = None
+
+    def start(self):
+        request = self.request_deadline
+        self.deadline = Deadline(self.timeout if request is None else request.timeout(self.timeout))
+        if request is not None:
+            self._unregister = request.on_cancel(lambda: self.deadline.cancel(request.reason or 'cancelled'))
+        self.started.set()
+
+    def finish(self):
+        if self._unregister is not None:
+            self._unregister()
@@ -1 +1,14 @@
-from .openai_repository import *
\ No newline at end of file
+from modelmorph._lazy import attach
+from modelmorph.chatbot.domain import Llm
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['cassette', 'mock_repository', 'openai_repository', 'scheduler'],
+    attributes={
+        'cassette': ['CassetteLlm', 'CassetteMiss'],
+        'mock_repository': ['MockLlm'],
+        'openai_repository': ['OpenAILlm'],
+        'scheduler': ['DeadlineExceeded', 'LlmScheduler', 'ScheduledLlm'],
+    },
+    eager=['Llm'],
+)
@@ -0,0 +1,207 @@
+from modelmorph.chatbot.domain import Llm
+from modelmorph.deadline import current_deadline, sleep
+from types import SimpleNamespace
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(KeyError):
+    """
+    Raised in replay mode when the cassette has no recording for a request.
+    """
+
+
+class CassetteLlm(Llm):
+    """
+    Record/replay wrapper of a language model. In 'record' mode the requests are sent to the wrapped
+    model and stored with their response and latency; in 'replay' mode they are answered from the
+    cassette without any network access; 'auto' replays what is recorded and records the rest.
+
+    Requests are matched by method and arguments. Identical requests recorded several times are
+    replayed in the recorded order. The cassette is a gzip compressed JSON lines file, written by
+    `save` (or when leaving the `with` block).
+    """
+
+    def __init__(self, path: str, llm: Llm = None, mode: str = 'replay', timing: str = 'instant', time_scale: float = 1.0):
+        """
+        Initializes the cassette.
+
+        Input:
+            - path (str): Cassette file, conventionally '*.jsonl.gz'. Loaded when it exists.
+            - llm (Llm, optional): Model answering the requests that are recorded, required unless mode is 'replay'.
+            - mode (str): 'record', 'replay' or 'auto'.
+            - timing (str): 'instant' answers right away, 'recorded' waits the recorded latency (and chunk timings for streams).
+            - time_scale (float): Factor applied to the recorded timings.
+        """
+        if mode not in ('record', 'replay', 'auto'):
+            raise ValueError(f"Unknown cassette mode '{mode}', expected 'record', 'replay' or 'auto'")
+        if timing not in ('instant', 'recorded'):
+            raise ValueError(f"Unknown timing '{timing}', expected 'instant' or 'recorded'")
+        if llm is None and mode != 'replay':
+            raise ValueError(f"A model is required to record requests in '{mode}' mode")
+        self.path = path
+        self.llm = llm
+        self.mode = mode
+        self.timing = timing
+        self.time_scale = time_scale
+        self.model_name = getattr(llm, 'model_name', 'cassette')
+        self.stats = {'replayed': 0, 'recorded': 0}
+        self._entries = {}
+        self._positions = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if mode != 'record' and os.path.exists(path):
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.save()
+        return False
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def get_response_message(self, message: str, system_message: str = '', **kwargs):
+        """
+        Returns the recorded response to a single prompt, see `OpenAILlm.get_response_message`.
+        """
+        request = {'message': message, 'system_message': system_message, **kwargs}
+        return self._respond('get_response_message', request, lambda: self.llm.get_response_message(message, system_message=system_message, **kwargs))
+
+    def get_response_chat(self, chat: list[dict], **kwargs):
+        """
+        Returns the recorded response to a chat history, see `OpenAILlm.get_response_chat`.
+        """
+        request = {'chat': chat, **kwargs}
+        return self._respond('get_response_chat', request, lambda: self.llm.get_response_chat(chat, **kwargs))
+
+    def stream_response_message(self, message: str, system_message: str = '', **kwargs):
+        request = {'message': message, 'system_message': system_message, **kwargs}
+        yield from self._stream('stream_response_message', request, lambda: self.llm.stream_response_message(message, system_message=system_message, **kwargs))
+
+    def stream_response_chat(self, chat: list, **kwargs):
+        request = {'chat': chat, **kwargs}
+        yield from self._stream('stream_response_chat', request, lambda: self.llm.stream_response_chat(chat, **kwargs))
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Returns the recorded embeddings of a batch of texts.
+        """
+        return self._respond('embed_batch', {'texts': texts}, lambda: self.llm.embed_batch(texts))
+
+    def save(self):
+        """
+        Writes the cassette file when new requests were recorded.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            temporary = f'{self.path}.tmp'
+            with gzip.open(temporary, 'wt', encoding='utf-8') as file:
+                file.write(json.dumps({'version': CASSETTE_VERSION}) + '\n')
+                for key, entries in self._entries.items():
+                    for entry in entries:
+                        file.write(json.dumps({'key': key, **entry}, separators=(',', ':')) + '\n')
+            os.replace(temporary, self.path)
+            self._dirty = False
+
+    def _load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            header = json.loads(file.readline())
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError(f"Unsupported cassette version {header.get('version')} in {self.path}")
+            for line in file:
+                entry = json.loads(line)
+                self._entries.setdefault(entry.pop('key'), []).append(entry)
+
+    def _respond(self, method: str, request: dict, call):
+        key, normalized = _request_key(method, request)
+        entry = self._next_entry(key)
+        if entry is None:
+            started = time.perf_counter()
+            response = call()
+            latency = time.perf_counter() - started
+            self._record(key, {'method': method, 'request': normalized, 'latency': latency, 'response': _to_json(response)})
+            return response
+        if self.timing == 'recorded':
+            sleep(entry['latency'] * self.time_scale)
+        return _to_namespace(entry['response'])
+
+    def _stream(self, method: str, request: dict, call):
+        key, normalized = _request_key(method, request)
+        entry = self._next_entry(key)
+        if entry is None:
+            started = time.perf_counter()
+            chunks = []
+            for delta in call():
+                chunks.append([delta, time.perf_counter() - started])
+                yield delta
+            self._record(key, {'method': method, 'request': normalized, 'latency': time.perf_counter() - started, 'chunks': chunks})
+            return
+        started = time.perf_counter()
+        deadline = current_deadline()
+        for delta, offset in entry['chunks']:
+            if self.timing == 'recorded':
+                delay = offset * self.time_scale - (time.perf_counter() - started)
+                if delay > 0:
+                    sleep(delay, deadline)
+            yield delta
+
+    def _next_entry(self, key: str):
+        with self._lock:
+            entries = self._entries.get(key)
+            if self.mode == 'record' or (self.mode == 'auto' and not entries):
+                return None
+            if not entries:
+                raise CassetteMiss(f"No recording for request {key} in {self.path}")
+            # Repeated requests are replayed in the recorded order, starting over at the end
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            self.stats['replayed'] += 1
+            return entries[position % len(entries)]
+
+    def _record(self, key: str, entry: dict):
+        with self._lock:
+            self._entries.setdefault(key, []).append(entry)
+            self.stats['recorded'] += 1
+            self._dirty = True
+
+
+def _request_key(method: str, request: dict):
+    normalized = _to_json(request)
+    encoded = json.dumps([method, normalized], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode()).hexdigest()[:32], normalized
+
+
+def _to_json(value):
+    # Plain JSON data of responses (OpenAI pydantic models, SimpleNamespace) and requests (message stores, views)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode='json')
+    if isinstance(value, SimpleNamespace):
+        return {key: _to_json(item) for key, item in vars(value).items()}
+    if isinstance(value, (list, tuple)) or hasattr(value, '__iter__'):
+        return [_to_json(item) for item in value]
+    return str(value)
+
+
+def _to_namespace(value):
+    # Replayed responses support the attribute access of the OpenAI objects (response.choices[0].message.content)
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _to_namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(item) for item in value]
+    return value
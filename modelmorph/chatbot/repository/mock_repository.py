@@ -0,0 +1,111 @@
+from modelmorph.chatbot.domain import Llm
+from modelmorph.deadline import current_deadline, sleep
+from types import SimpleNamespace
+import json
+import math
+import re
+import zlib
+
+
+class MockLlm(Llm):
+    """
+    Local language model returning canned answers after a simulated latency. Responses have the same
+    shape as the OpenAI ones (choices, message, usage), so it can replace OpenAILlm in load tests.
+    The latency is cut short, raising, when the deadline of the request passes or it is cancelled.
+    """
+
+    def __init__(self, latency: float = 0.05, chunk_delay: float = 0.005, chunk_size: int = 8, response=None, embedding_dim: int = 64):
+        """
+        Initializes the mock model.
+
+        Input:
+            - latency (float): Seconds before the answer (or the first streamed chunk) is returned.
+            - chunk_delay (float): Seconds between two streamed chunks.
+            - chunk_size (int): Number of characters per streamed chunk.
+            - response (str or callable, optional): Fixed answer, or function receiving the messages and returning it.
+              Defaults to echoing the last user message.
+            - embedding_dim (int): Size of the vectors returned by `embed_batch`.
+
+        Output:
+            - None
+        """
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.response = response
+        self.model_name = 'mock'
+        self.embedding_dim = embedding_dim
+
+    def get_response_message(self, message: str, system_message: str = '', max_tokens: int = 400, temperature: float = 0.0, top_p: float = 1.0, type_object: str = 'json_object', n: int = 1, stop: list[str] = None):
+        """
+        Returns a canned answer to a single prompt after the simulated latency.
+        """
+        messages = [{"role": "system", "content": system_message}, {"role": "user", "content": message}]
+        sleep(self.latency)
+        return self._completion(messages, type_object, n)
+
+    def get_response_chat(self, chat: list[dict], max_tokens: int = 200, temperature: float = 0.5, type_object: str = '', tools: list[dict] = None):
+        """
+        Returns a canned answer to a chat history after the simulated latency.
+        """
+        sleep(self.latency)
+        return self._completion(chat, type_object, 1)
+
+    def stream_response_message(self, message: str, system_message: str = '', type_object: str = 'json_object', **kwargs):
+        """
+        Streams the canned answer to a single prompt in chunks.
+        """
+        messages = [{"role": "system", "content": system_message}, {"role": "user", "content": message}]
+        yield from self._stream(self._answer(messages, type_object))
+
+    def stream_response_chat(self, chat: list[dict], **kwargs):
+        """
+        Streams the canned answer to a chat history in chunks.
+        """
+        yield from self._stream(self._answer(chat, ''))
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Returns normalized bag of words vectors (each word hashed to a dimension), so texts sharing
+        words are close, after the simulated latency.
+        """
+        sleep(self.latency)
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.embedding_dim
+            for word in re.findall(r"\w+", text.casefold()):
+                vector[zlib.crc32(word.encode()) % self.embedding_dim] += 1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+    def _answer(self, messages: list[dict], type_object: str) -> str:
+        if callable(self.response):
+            return self.response(messages)
+        if self.response is not None:
+            return self.response
+        last = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+        if type_object == 'json_object':
+            return json.dumps({"answer": last})
+        return f"Mock answer to: {last}"
+
+    def _completion(self, messages: list[dict], type_object: str, n: int):
+        content = self._answer(messages, type_object)
+        prompt_tokens = sum(len(str(m.get("content") or "").split()) for m in messages)
+        return SimpleNamespace(
+            model=self.model_name,
+            choices=[
+                SimpleNamespace(index=i, finish_reason="stop", message=SimpleNamespace(role="assistant", content=content, tool_calls=None))
+                for i in range(n)
+            ],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content.split()) * n, total_tokens=prompt_tokens + len(content.split()) * n)
+        )
+
+    def _stream(self, content: str):
+        # Cancelling the request stops the stream like closing the HTTP response of a real model
+        deadline = current_deadline()
+        sleep(self.latency, deadline)
+        for start in range(0, len(content), self.chunk_size):
+            if start:
+                sleep(self.chunk_delay, deadline)
+            yield content[start:start + self.chunk_size]
@@ -1,12 +1,14 @@
 from modelmorph.chatbot.domain import Llm
+from modelmorph.deadline import DeadlineExceeded, current_deadline
+from modelmorph.chatbot.domain.messages import MessageView
 from dotenv import load_dotenv
 import os
-from openai import AzureOpenAI
+from openai import APITimeoutError, AzureOpenAI, NOT_GIVEN
 import json
 
 class OpenAILlm(Llm):
 
-    def __init__(self, api_key: str, api_url: str, api_version: str, model_name: str):
+    def __init__(self, api_key: str, api_url: str, api_version: str, model_name: str, embedding_model: str = None):
         """
         Initializes an instance of OpenAILlm with Azure OpenAI configuration.
 
@@ -15,6 +17,8 @@ class OpenAILlm(Llm):
             - api_url (str): URL endpoint for the API.
             - api_version (str): API version to be used.
             - model_name (str): Name of the language model.
+            - embedding_model (str, optional): Deployment used by `get_embeddings`, defaults to the
+              'EMBEDDING_DEPLOYMENT_ID' environment variable or 'text-embedding-3-small'.
 
         Output:
             - None; sets up the AzureOpenAI client.
@@ -25,8 +29,9 @@ class OpenAILlm(Llm):
             api_version=api_version
         )
         self.model_name = model_name
+        self.embedding_model = embedding_model or os.getenv('EMBEDDING_DEPLOYMENT_ID', 'text-embedding-3-small')
 
-    def get_response_message(self, message: str, system_message: str, max_tokens: int = 400, temperature: float = 0.0, top_p: float = 1.0, type_object: str = 'json_object'):
+    def get_response_message(self, message: str, system_message: str = '', max_tokens: int = 400, temperature: float = 0.0, top_p: float = 1.0, type_object: str = 'json_object', n: int = 1, stop: list[str] = None):
         """
         Sends a message to the model and receives a structured response.
 
@@ -37,34 +42,118 @@ class OpenAILlm(Llm):
             - temperature (float): Sampling temperature for creativity in responses.
             - top_p (float): Probability for nucleus sampling.
             - type_object (str): Specifies the response format, default is 'json_object'.
+            - n (int): Number of choices to generate.
+            - stop (list of str, optional): Sequences where the generation stops.
 
         Output:
             - response (object): The response from the language model.
         """
-        chat_input = [{"role": "user", "content": message}]
-        if system_message:
-            chat_input.insert(0, {'role': 'system', 'content': system_message})
-
-        response = self.client.chat.completions.create(
+        response = self._create(
             model=self.model_name,
             response_format={"type": type_object},
-            messages=chat_input,
+            messages=self._message_input(message, system_message),
             max_tokens=max_tokens,
             temperature=temperature,
-            top_p=top_p
+            top_p=top_p,
+            n=n,
+            stop=stop or NOT_GIVEN
         )
 
         return response
 
-    def get_response_chat(self, chat: list[dict], max_tokens: int = 200, temperature: float = 0.5, type_object: str = ''):
+    def stream_response_message(self, message: str, system_message: str, max_tokens: int = 400, temperature: float = 0.0, top_p: float = 1.0, type_object: str = 'json_object'):
+        """
+        Sends a message to the model and streams the generated text as it arrives.
+
+        Input:
+            - message (str): The message content to send to the model.
+            - system_message (str): Optional system message to include at the start of the conversation.
+            - max_tokens (int): Maximum number of tokens in the response.
+            - temperature (float): Sampling temperature for creativity in responses.
+            - top_p (float): Probability for nucleus sampling.
+            - type_object (str): Specifies the response format, default is 'json_object'.
+
+        Output:
+            - Generator of str with the content deltas of the first choice.
+        """
+        stream = self._create(
+            model=self.model_name,
+            response_format={"type": type_object},
+            messages=self._message_input(message, system_message),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True
+        )
+
+        yield from self._deltas(stream)
+
+    def _create(self, **kwargs):
+        """
+        Sends a chat completions request within the time left to the current request, see `use_deadline`.
+        """
+        return self._call('chat', **kwargs)
+
+    def _call(self, resource: str, **kwargs):
+        client = self.client
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check('model request')
+            remaining = deadline.remaining()
+            if remaining is not None:
+                # A retry of a timed out request cannot finish in time either
+                client = client.with_options(timeout=remaining, max_retries=0)
+        create = client.embeddings.create if resource == 'embeddings' else client.chat.completions.create
+        try:
+            return create(**kwargs)
+        except APITimeoutError as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded("Deadline exceeded during model request") from e
+            raise
+
+    def _deltas(self, stream):
+        """
+        Yields the content deltas of the first choice of a response stream. The stream is closed when the
+        consumer stops, or from another thread as soon as the current request is cancelled.
+        """
+        deadline = current_deadline()
+        unregister = deadline.on_cancel(stream.close) if deadline is not None else None
+        try:
+            for chunk in stream:
+                if deadline is not None:
+                    deadline.check('end of model stream')
+                # Azure sends an initial chunk without choices with the content filter results
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            if deadline is not None:
+                # Reading a stream closed by the cancellation fails with a network error
+                deadline.check('end of model stream')
+            raise
+        finally:
+            if unregister is not None:
+                unregister()
+            stream.close()
+
+    def _message_input(self, message: str, system_message: str) -> list[dict]:
+        """
+        Builds the list of messages for a single prompt, with the optional system message first.
+        """
+        chat_input = [{"role": "user", "content": message}]
+        if system_message:
+            chat_input.insert(0, {'role': 'system', 'content': system_message})
+        return chat_input
+
+    def get_response_chat(self, chat: list[dict], max_tokens: int = 200, temperature: float = 0.5, type_object: str = '', tools: list[dict] = None):
         """
         Sends a chat history to the model and receives a JSON-only response.
 
         Input:
-            - chat (list of dict): List of messages representing the chat history.
+            - chat (list of dict): List of messages representing the chat history, it is not modified.
             - max_tokens (int): Maximum number of tokens in the response.
             - temperature (float): Sampling temperature for creativity in responses.
             - type_object (str): Response format for the model output.
+            - tools (list of dict, optional): Function definitions the model can call, see `Plugin.tool_definitions`.
 
         Output:
             - response (object): The response from the language model.
@@ -73,14 +162,52 @@ class OpenAILlm(Llm):
             "role": "system",
             "content": "You are a helpful assistant designed to output JSON."
         }
-        chat.insert(0, system_message)
+        # A view keeps the caller's history untouched, it used to get one more system message per call
+        messages = MessageView([system_message], chat)
 
-        response = self.client.chat.completions.create(
+        response = self._create(
             model=self.model_name,
-            messages=chat,
+            messages=messages,
             max_tokens=max_tokens,
             temperature=temperature,
-            top_p=1.0
+            top_p=1.0,
+            tools=tools or NOT_GIVEN
         )
 
         return response
+
+    def stream_response_chat(self, chat: list[dict], max_tokens: int = 200, temperature: float = 0.5):
+        """
+        Sends a chat history to the model and streams the answer as it is generated.
+
+        Input:
+            - chat (list of dict): List of messages representing the chat history.
+            - max_tokens (int): Maximum number of tokens in the response.
+            - temperature (float): Sampling temperature for creativity in responses.
+
+        Output:
+            - Generator of str with the content deltas of the first choice.
+        """
+        stream = self._create(
+            model=self.model_name,
+            messages=chat,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=1.0,
+            stream=True
+        )
+
+        yield from self._deltas(stream)
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Computes the embeddings of a batch of texts with the embedding deployment.
+
+        Input:
+            - texts (list of str): Texts to embed.
+
+        Output:
+            - Returns one vector (list of float) per text, in the same order.
+        """
+        response = self._call('embeddings', model=self.embedding_model, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
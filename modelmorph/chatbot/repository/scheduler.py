@@ -0,0 +1,300 @@
+from modelmorph.chatbot.domain import Llm
+from modelmorph.deadline import DeadlineExceeded, current_deadline
+import heapq
+import itertools
+import threading
+import time
+
+# Lower value, higher priority: queued interactive requests always go before batch ones
+PRIORITIES = {'interactive': 0, 'batch': 1}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of a text (about 4 characters per token), used to reserve quota before a request is sent.
+    """
+    return len(text or '') // 4 + 1
+
+
+class _Ticket:
+
+    __slots__ = ('priority', 'tenant', 'cost', 'deadline', 'start', 'finish', 'seq', 'state', 'queued_at')
+
+    def __init__(self, priority, tenant, cost, deadline, seq, queued_at):
+        self.priority = priority
+        self.tenant = tenant
+        self.cost = cost
+        self.deadline = deadline
+        self.seq = seq
+        self.queued_at = queued_at
+        self.state = 'waiting'
+
+
+class LlmScheduler:
+    """
+    Admission control for a language model quota shared by several tenants and kinds of traffic.
+
+    Requests are queued by priority class and strictly served in class order. Inside a class, tenants
+    share the capacity by weighted fair queuing on the estimated tokens of their requests. A request
+    starts when a concurrency slot is free and the token bucket, refilled at tokens_per_minute, holds
+    its estimated tokens; the estimate is corrected with the actual usage once the answer arrives.
+
+    Batch requests leave batch_reserve of the bucket and interactive_slots of the slots untouched,
+    so interactive requests find capacity right away while batch work uses whatever remains.
+    """
+
+    def __init__(self, tokens_per_minute: int = 90000, max_concurrency: int = 8, weights: dict = None, batch_reserve: float = 0.2, interactive_slots: int = 1):
+        """
+        Initializes the scheduler.
+
+        Input:
+            - tokens_per_minute (int): Token quota of the deployment.
+            - max_concurrency (int): Requests running at the same time.
+            - weights (dict, optional): Share of each tenant inside a priority class, 1 by default.
+            - batch_reserve (float): Fraction of the token bucket batch requests cannot use.
+            - interactive_slots (int): Concurrency slots batch requests cannot use.
+        """
+        if tokens_per_minute <= 0 or max_concurrency <= 0:
+            raise ValueError("tokens_per_minute and max_concurrency must be positive")
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.weights = dict(weights or {})
+        self.batch_reserve = batch_reserve
+        self.interactive_slots = min(interactive_slots, max_concurrency - 1)
+
+        self._rate = tokens_per_minute / 60.0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._running = 0
+        self._queues = {priority: [] for priority in PRIORITIES.values()}
+        self._virtual = dict.fromkeys(PRIORITIES.values(), 0.0)
+        self._last_finish = {}
+        self._refill_wait = None
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._stats = {name: {'granted': 0, 'expired': 0, 'wait': 0.0} for name in PRIORITIES}
+
+    def client(self, llm: Llm, tenant: str = 'default', priority: str = 'interactive', timeout: float = None) -> 'ScheduledLlm':
+        """
+        Returns an Llm sending the requests of one tenant and priority class through this scheduler.
+
+        Input:
+            - llm (Llm): Model answering the requests.
+            - tenant (str): Tenant the requests are accounted to.
+            - priority (str): 'interactive' or 'batch'.
+            - timeout (float, optional): Maximum seconds a request waits in the queue.
+        """
+        return ScheduledLlm(self, llm, tenant, priority, timeout)
+
+    def set_weight(self, tenant: str, weight: float):
+        with self._condition:
+            self.weights[tenant] = weight
+
+    def acquire(self, cost: int, tenant: str = 'default', priority: str = 'interactive', deadline: float = None) -> _Ticket:
+        """
+        Waits until a request may be sent.
+
+        Input:
+            - cost (int): Estimated tokens of the request (prompt and answer).
+            - tenant (str): Tenant the request is accounted to.
+            - priority (str): 'interactive' or 'batch'.
+            - deadline (float, optional): `time.monotonic()` value after which the request is dropped.
+              The deadline of the running request (see `use_deadline`) also applies.
+
+        Output:
+            - Returns the ticket to give back to `release` once the request is done.
+            - Raises DeadlineExceeded when the deadline passes first, RequestCancelled when the request is cancelled.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {list(PRIORITIES)}")
+        level = PRIORITIES[priority]
+        request_deadline = current_deadline()
+        if request_deadline is not None:
+            request_deadline.check('scheduling')
+            if request_deadline.at is not None:
+                deadline = request_deadline.at if deadline is None else min(deadline, request_deadline.at)
+            unregister = request_deadline.on_cancel(self._wake)
+        try:
+            return self._acquire(cost, tenant, priority, level, deadline, request_deadline)
+        finally:
+            if request_deadline is not None:
+                unregister()
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _acquire(self, cost, tenant, priority, level, deadline, request_deadline):
+        with self._condition:
+            now = time.monotonic()
+            ticket = _Ticket(level, tenant, cost, deadline, next(self._seq), now)
+            ticket.start = max(self._virtual[level], self._last_finish.get((level, tenant), 0.0))
+            ticket.finish = ticket.start + cost / self.weights.get(tenant, 1.0)
+            self._last_finish[(level, tenant)] = ticket.finish
+            heapq.heappush(self._queues[level], (ticket.finish, ticket.seq, ticket))
+            self._dispatch(now)
+
+            while ticket.state == 'waiting':
+                cancelled = request_deadline is not None and request_deadline.cancelled
+                if cancelled or (deadline is not None and now >= deadline):
+                    ticket.state = 'expired'
+                    self._stats[priority]['expired'] += 1
+                    # Later tickets of the tenant may now go first
+                    self._dispatch(now)
+                    if cancelled:
+                        request_deadline.check('scheduling')
+                    raise DeadlineExceeded(f"Request of tenant '{tenant}' not started before its deadline")
+                timeout = self._refill_wait
+                if deadline is not None:
+                    timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+                self._condition.wait(timeout)
+                now = time.monotonic()
+                self._dispatch(now)
+
+            self._stats[priority]['wait'] += now - ticket.queued_at
+            return ticket
+
+    def release(self, ticket: _Ticket, used_tokens: int = None):
+        """
+        Gives back the slot of a finished request.
+
+        Input:
+            - ticket: Ticket returned by `acquire`.
+            - used_tokens (int, optional): Actual tokens of the request, replacing its estimate in the bucket.
+        """
+        with self._condition:
+            self._running -= 1
+            if used_tokens is not None:
+                self._tokens -= used_tokens - ticket.cost
+            self._dispatch(time.monotonic())
+            # Waiters blocked on a slot may now be blocked on tokens and need a timed wait
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Returns the requests granted and expired and the total queue wait in seconds per priority class,
+        with the requests currently queued and running and the tokens available.
+        """
+        with self._condition:
+            self._refill(time.monotonic())
+            queued = {name: sum(entry[2].state == 'waiting' for entry in self._queues[level]) for name, level in PRIORITIES.items()}
+            return {
+                'classes': {name: dict(values, queued=queued[name]) for name, values in self._stats.items()},
+                'running': self._running,
+                'tokens': self._tokens,
+            }
+
+    def _refill(self, now: float):
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+
+    def _dispatch(self, now: float):
+        # Called with the condition held, starts the queued requests that fit in the quota
+        self._refill(now)
+        self._refill_wait = None
+        granted = False
+        for level in sorted(self._queues):
+            queue = self._queues[level]
+            reserve_tokens = self.batch_reserve * self.tokens_per_minute if level else 0.0
+            max_running = self.max_concurrency - (self.interactive_slots if level else 0)
+            while queue:
+                ticket = queue[0][2]
+                if ticket.state != 'waiting':
+                    heapq.heappop(queue)
+                    continue
+                if self._running >= max_running:
+                    break
+                needed = min(ticket.cost, self.tokens_per_minute - reserve_tokens) + reserve_tokens
+                if self._tokens < needed:
+                    self._refill_wait = (needed - self._tokens) / self._rate
+                    break
+                heapq.heappop(queue)
+                ticket.state = 'granted'
+                self._virtual[level] = ticket.start
+                self._tokens -= ticket.cost
+                self._running += 1
+                self._stats[_PRIORITY_NAMES[level]]['granted'] += 1
+                granted = True
+            if queue:
+                # Strict priority: lower classes wait while this one has queued requests
+                break
+        if granted:
+            self._condition.notify_all()
+
+
+_PRIORITY_NAMES = {level: name for name, level in PRIORITIES.items()}
+
+
+class ScheduledLlm(Llm):
+    """
+    Llm sending every request of a tenant and priority class through an `LlmScheduler`
+    before calling the wrapped model.
+    """
+
+    def __init__(self, scheduler: LlmScheduler, llm: Llm, tenant: str = 'default', priority: str = 'interactive', timeout: float = None):
+        """
+        Initializes the scheduled model, see `LlmScheduler.client`.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {list(PRIORITIES)}")
+        self.scheduler = scheduler
+        self.llm = llm
+        self.tenant = tenant
+        self.priority = priority
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        # model_name and other attributes of the wrapped model
+        if name == 'llm':
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def get_response_message(self, message: str, system_message: str = '', **kwargs):
+        """
+        Waits for the scheduler, then returns the response of the wrapped model to a single prompt.
+        """
+        cost = estimate_tokens(message) + estimate_tokens(system_message) + kwargs.get('max_tokens', 400) * kwargs.get('n', 1)
+        return self._call(cost, self.llm.get_response_message, message, system_message=system_message, **kwargs)
+
+    def get_response_chat(self, chat: list[dict], **kwargs):
+        """
+        Waits for the scheduler, then returns the response of the wrapped model to a chat history.
+        """
+        return self._call(self._chat_cost(chat, kwargs), self.llm.get_response_chat, chat, **kwargs)
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Waits for the scheduler, then returns the embeddings of the wrapped model.
+        """
+        return self._call(sum(estimate_tokens(text) for text in texts), self.llm.embed_batch, texts)
+
+    def stream_response_message(self, message: str, system_message: str = '', **kwargs):
+        cost = estimate_tokens(message) + estimate_tokens(system_message) + kwargs.get('max_tokens', 400)
+        yield from self._stream(cost, self.llm.stream_response_message, message, system_message=system_message, **kwargs)
+
+    def stream_response_chat(self, chat: list, **kwargs):
+        yield from self._stream(self._chat_cost(chat, kwargs), self.llm.stream_response_chat, chat, **kwargs)
+
+    def _deadline(self):
+        return None if self.timeout is None else time.monotonic() + self.timeout
+
+    def _call(self, cost: int, method, *args, **kwargs):
+        ticket = self.scheduler.acquire(cost, self.tenant, self.priority, self._deadline())
+        used_tokens = None
+        try:
+            response = method(*args, **kwargs)
+            used_tokens = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+            return response
+        finally:
+            self.scheduler.release(ticket, used_tokens)
+
+    def _stream(self, cost: int, method, *args, **kwargs):
+        ticket = self.scheduler.acquire(cost, self.tenant, self.priority, self._deadline())
+        try:
+            yield from method(*args, **kwargs)
+        finally:
+            self.scheduler.release(ticket)
+
+    @staticmethod
+    def _chat_cost(chat: list, kwargs: dict) -> int:
+        return sum(estimate_tokens(str(m.get('content') or '')) + 4 for m in chat) + kwargs.get('max_tokens', 200)
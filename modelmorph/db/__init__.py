@@ -1,2 +1,13 @@
-from .repository import *
-from .domain import *
\ No newline at end of file
+from modelmorph._lazy import attach
+from .domain import DBRepository, QueryAnswere
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['domain', 'query_cache', 'repository', 'schema_catalog'],
+    attributes={
+        'query_cache': ['CachedRepository', 'QueryCache'],
+        'repository': ['AzureDBRepository', 'InMemoryDBRepository', 'MongoDBRepository', 'ShardedDBRepository'],
+        'schema_catalog': ['SchemaCatalog'],
+    },
+    eager=['DBRepository', 'QueryAnswere'],
+)
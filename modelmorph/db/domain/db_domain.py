@@ -1,5 +1,10 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+import random
+import time
+
+# Error of `save_chat_if_version` when the stored chat has changed since it was read
+VERSION_CONFLICT = 409
 
 @dataclass
 class QueryAnswere:
@@ -24,9 +29,12 @@ class DBRepository(ABC):
     ----------
     connection_string : str
         The connection string for the database.
+    version_retries : int
+        Retries of `append_messages` when the chat changes between its read and its write.
     """
 
     _instances = {}
+    version_retries = 5
 
     def __new__(cls, *args, **kwargs):
         """
@@ -104,7 +112,7 @@ class DBRepository(ABC):
     @abstractmethod
     def save_chat(self, chat_id: int, chat: list) -> QueryAnswere:
         """
-        Saves a chat to the database. Must be implemented by subclasses.
+        Saves a chat to the database, unconditionally, incrementing its 'version'. Must be implemented by subclasses.
 
         Parameters:
         ----------
@@ -118,4 +126,174 @@ class DBRepository(ABC):
         QueryAnswere:
             The result of the query.
         """
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        """
+        Saves a chat only if the stored one is still at version (compare-and-set), so writers that read
+        the same chat cannot overwrite each other. Chats are stored with a 'version' incremented by every
+        save; a chat not stored yet, or stored without version, is at version 0.
+
+        The default implementation reads then writes, it is not atomic: repositories override it with
+        a conditional update.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to save.
+        chat : dict
+            The chat data to save, its 'version' is ignored.
+        version : int
+            Version of the chat when it was read.
+
+        Returns:
+        -------
+        QueryAnswere:
+            [{'version': int}] with the new version, or a `VERSION_CONFLICT` (409) error if the chat changed.
+        """
+        current = self.find_chat_by_id(chat_id)
+        if current.error and current.error != 400:
+            return current
+        stored = current.data[0].get('version', 0) if current.data else 0
+        if stored != version:
+            return QueryAnswere(data=[], error=VERSION_CONFLICT)
+        result = self.save_chat(chat_id, {**chat, 'version': version + 1})
+        if result.error:
+            return result
+        return QueryAnswere(data=[{'version': version + 1}], error="")
+
+    def copy_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Inserts a chat read from another repository, keeping its 'version', unless the chat already exists.
+        Used by `ShardedDBRepository` to move chats: a writer still holding an older version of the chat gets a
+        `VERSION_CONFLICT` on the copy as it would have on the source.
+
+        The default implementation reads then writes, it is not atomic: repositories override it with
+        an insert failing on the ID.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to insert.
+        chat : dict
+            The chat data, with its 'version'.
+
+        Returns:
+        -------
+        QueryAnswere:
+            [{'version': int}] with the kept version, or a `VERSION_CONFLICT` (409) error if the chat exists.
+        """
+        current = self.find_chat_by_id(chat_id)
+        if current.error and current.error != 400:
+            return current
+        if current.data:
+            return QueryAnswere(data=[], error=VERSION_CONFLICT)
+        version = chat.get('version', 0)
+        result = self.save_chat(chat_id, {**chat, 'version': version})
+        if result.error:
+            return result
+        return QueryAnswere(data=[{'version': version}], error="")
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        """
+        Deletes a chat. Optional, used by `ShardedDBRepository` to remove the chats moved to another shard.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to delete.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The result of the deletion, with a `400` error if the chat does not exist.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def standalone(cls, *args, **kwargs) -> 'DBRepository':
+        """
+        Creates an instance outside of the singleton, e.g. one per database of a `ShardedDBRepository`.
+        """
+        instance = object.__new__(cls)
+        instance.__init__(*args, **kwargs)
+        return instance
+
+    def find_chat_tail(self, chat_id: int, n: int) -> QueryAnswere:
+        """
+        Finds a chat by its ID with only its last n messages. Repositories able to project the
+        messages (MongoDB $slice) override it so the size of the read does not grow with the chat.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to find.
+        n : int
+            Number of messages to load, from the end of the chat.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The chat, with a `400` error if it does not exist.
+        """
+        result = self.find_chat_by_id(chat_id)
+        if not result.error:
+            for chat in result.data:
+                chat['messages'] = chat.get('messages', [])[-n:] if n > 0 else []
+        return result
+
+    def append_messages(self, chat_id: int, messages: list[dict]) -> QueryAnswere:
+        """
+        Appends messages to a chat, creating it if needed, without rewriting the messages already stored.
+        The default implementation rewrites the chat with `save_chat_if_version`, retried when it changed.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat.
+        messages : list[dict]
+            The new messages.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The result of the update.
+        """
+        for attempt in range(self.version_retries + 1):
+            if attempt:
+                # Spreads the writers of a busy chat so they do not conflict again
+                time.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+            result = self.find_chat_by_id(chat_id)
+            if result.error and result.error != 400:
+                return result
+            chat = result.data[0] if result.data else {"_id": chat_id, "messages": []}
+            chat['messages'] = list(chat.get('messages', [])) + list(messages)
+            # Messages appended by another writer in between are read again and kept
+            result = self.save_chat_if_version(chat_id, chat, chat.get('version', 0))
+            if result.error != VERSION_CONFLICT:
+                return result
+        return result
+
+    def get_schema(self) -> QueryAnswere:
+        """
+        Lists the tables (or collections) of the database with their columns. Optional,
+        used by `SchemaCatalog` to build the schema given to the NlpToSql prompts.
+
+        Returns:
+        -------
+        QueryAnswere:
+            Data with one {'table': str, 'columns': list[str]} dict per table.
+        """
+        raise NotImplementedError
+
+    def get_schema_version(self) -> str:
+        """
+        Returns a cheap fingerprint of the schema that changes when tables or columns change.
+        Optional, used by `SchemaCatalog` to invalidate its cache.
+
+        Returns:
+        -------
+        str:
+            The schema version.
+        """
+        raise NotImplementedError
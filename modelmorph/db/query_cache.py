@@ -0,0 +1,483 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from modelmorph.db.domain import DBRepository, QueryAnswere
+
+# String literals, quoted identifiers and comments, kept (literals) or dropped (comments) by the normalization
+_TOKENS = re.compile(r"""('(?:[^']|'')*')|("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|(--[^\n]*|/\*.*?\*/)|(\s+)|([^'"`\[\s-]+|-)""", re.S)
+# Names, possibly schema qualified and quoted, parentheses and commas of a query without its literals
+_NAME = r"""(?:[\w$]+|"[^"]+"|`[^`]+`|\[[^\]]+\])"""
+_REFERENCE_TOKENS = re.compile(rf"""{_NAME}(?:\s*\.\s*{_NAME})*|[(),]""")
+# A table follows these keywords, the FROM clause has a list of them
+_TABLE_KEYWORDS = frozenset(('join', 'into', 'update', 'table', 'exists'))
+_JOINS = frozenset(('join', 'straight_join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural'))
+# Words ending a FROM list, they are not table aliases
+_CLAUSES = frozenset(('where', 'group', 'order', 'having', 'limit', 'offset', 'fetch', 'join', 'inner', 'left', 'right', 'full',
+                      'outer', 'cross', 'natural', 'straight_join', 'on', 'using', 'union', 'intersect', 'except', 'window',
+                      'for', 'with', 'set', 'values', 'select', 'returning', 'into', 'partition', 'qualify', 'if'))
+_WRITES = frozenset(('insert', 'update', 'delete', 'replace', 'merge', 'upsert', 'create', 'drop', 'alter', 'truncate', 'rename'))
+# Results of these change between two runs of the same query
+_VOLATILE = re.compile(r"\b(?:now|rand|random|uuid|sysdate|sysdatetime|current_timestamp|current_date|current_time|curdate|curtime|"
+                       r"localtime|localtimestamp|utc_timestamp|utc_date|utc_time|getdate|getutcdate|newid)\b", re.I)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Returns sql without comments, with single spaces, lowercase outside of the literals and quoted
+    identifiers, and without a trailing ';', so the same query written differently has one cache key.
+    """
+    parts = []
+    for literal, quoted, comment, space, word in _TOKENS.findall(sql):
+        if comment:
+            continue
+        if space:
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+            continue
+        parts.append(literal or quoted or word.lower())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def is_read_only(sql: str) -> bool:
+    """
+    True when sql is a single SELECT (or WITH ... SELECT) statement without a writing keyword, so it
+    can be run without changing the database.
+    """
+    text = _without_literals(sql)
+    if _first_keyword(sql) not in ('select', 'with') or ';' in text.strip().rstrip(';'):
+        return False
+    return not set(re.findall(r'\w+', text.lower())) & _WRITES
+
+
+def referenced_tables(sql: str) -> frozenset:
+    """
+    Returns the lowercase unqualified names of the tables read or written by sql.
+    """
+    return _table_references(sql)[0]
+
+
+def _table_references(sql: str) -> tuple:
+    # The tables of sql, and False when some could not be found (e.g. a table-valued function in a FROM list)
+    tables = set()
+    resolved = _scan_tables(_REFERENCE_TOKENS.findall(_without_literals(sql)), tables)
+    return frozenset(tables), resolved
+
+
+def _scan_tables(tokens: list, tables: set) -> bool:
+    resolved = True
+    i = 0
+    while i < len(tokens):
+        word = tokens[i].lower()
+        i += 1
+        if word in _TABLE_KEYWORDS:
+            if i < len(tokens) and _is_name(tokens[i]) and tokens[i].lower() not in _CLAUSES:
+                tables.add(_unqualified(tokens[i]))
+        elif word == 'from':
+            i, listed = _scan_from(tokens, i, tables)
+            resolved = resolved and listed
+        elif word == '(':
+            # Subquery, or parenthesized expression
+            end = _closing(tokens, i - 1)
+            resolved = _scan_tables(tokens[i:end], tables) and resolved
+            i = end + 1
+    return resolved
+
+
+def _scan_from(tokens: list, i: int, tables: set) -> tuple:
+    # FROM a [AS] x, b JOIN c ON ..., (SELECT ...) y ... up to the next clause, returns the index after it
+    resolved = True
+    while True:
+        if i < len(tokens) and tokens[i].lower() in ('lateral', 'only'):
+            i += 1
+        if i < len(tokens) and tokens[i] == '(':
+            end = _closing(tokens, i)
+            resolved = _scan_tables(tokens[i + 1:end], tables) and resolved
+            i = end + 1
+        elif i < len(tokens) and _is_name(tokens[i]) and tokens[i].lower() not in _CLAUSES:
+            i += 1
+            if i < len(tokens) and tokens[i] == '(':
+                # Table-valued function, what it reads is unknown
+                end = _closing(tokens, i)
+                _scan_tables(tokens[i + 1:end], tables)
+                resolved = False
+                i = end + 1
+            else:
+                tables.add(_unqualified(tokens[i - 1]))
+        else:
+            return i, False
+        if i < len(tokens) and tokens[i].lower() == 'as':
+            i += 1
+        if i < len(tokens) and _is_name(tokens[i]) and tokens[i].lower() not in _CLAUSES:
+            i += 1
+        # Join conditions, up to the next item of the list
+        while i < len(tokens) and tokens[i].lower() in ('on', 'using'):
+            i += 1
+            while i < len(tokens) and tokens[i] != ',' and tokens[i].lower() not in _CLAUSES:
+                if tokens[i] == '(':
+                    end = _closing(tokens, i)
+                    resolved = _scan_tables(tokens[i + 1:end], tables) and resolved
+                    i = end
+                i += 1
+        if i < len(tokens) and tokens[i] == ',':
+            i += 1
+            continue
+        while i < len(tokens) and tokens[i].lower() in _JOINS:
+            joined = tokens[i].lower() in ('join', 'straight_join')
+            i += 1
+            if joined:
+                break
+        else:
+            return i, resolved
+
+
+def _is_name(token: str) -> bool:
+    return token not in ('(', ')', ',')
+
+
+def _unqualified(name: str) -> str:
+    return re.split(r'\s*\.\s*(?=(?:[^"`\]]*["`\]][^"`\]]*["`\]])*[^"`\]]*$)', name)[-1].strip('"`[]').lower()
+
+
+def _closing(tokens: list, start: int) -> int:
+    depth = 0
+    for i in range(start, len(tokens)):
+        depth += {'(': 1, ')': -1}.get(tokens[i], 0)
+        if depth == 0:
+            return i
+    return len(tokens)
+
+
+def _without_literals(sql: str) -> str:
+    return ''.join(quoted or word or ' ' for literal, quoted, comment, space, word in _TOKENS.findall(sql))
+
+
+def _first_keyword(sql: str) -> str:
+    match = re.match(r"\s*(?:\(\s*)*(\w+)", _without_literals(sql))
+    return match.group(1).lower() if match else ''
+
+
+class QueryCache:
+    """
+    Thread-safe cache of query results, keyed by the normalized query and its parameters. Entries
+    expire after a time to live and the least recently used are evicted when the estimated size of
+    the cached rows goes over max_bytes. Each entry records the tables its query reads, so a write
+    (or `invalidate(table)`) evicts only the results depending on the written tables.
+
+    Only SELECT (and WITH ... SELECT) queries without volatile functions (NOW(), RAND()...), whose tables
+    can all be found, are cached.
+
+    Attributes:
+    ----------
+    max_bytes : int
+        Maximum estimated size of the cached results.
+    ttl : float
+        Seconds a result stays valid.
+    max_entry_bytes : int
+        Results estimated larger than this are not cached.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300.0, max_entry_bytes: int = None):
+        """
+        Initializes an empty cache.
+
+        Parameters:
+        ----------
+        max_bytes : int
+            Maximum estimated size of the cached results.
+        ttl : float
+            Seconds a result stays valid.
+        max_entry_bytes : int, optional
+            Largest result cached, defaults to an eighth of max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_bytes // 8 if max_entry_bytes is None else max_entry_bytes
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._generations = {}
+        self._generation = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def cacheable(query: str) -> bool:
+        """
+        True for the read-only queries whose results can be cached.
+        """
+        if not is_read_only(query) or _VOLATILE.search(_without_literals(query)):
+            return False
+        # A result is only cached when every table it depends on is known, for the writes to evict it
+        return _table_references(query)[1]
+
+    def key(self, query: str, params=None) -> tuple:
+        """
+        Returns the cache key of a query and its parameters.
+        """
+        if params is None:
+            return (normalize_sql(query), None)
+        return (normalize_sql(query), json.dumps(params, sort_keys=True, default=repr))
+
+    def get(self, query: str, params=None) -> QueryAnswere:
+        """
+        Returns a copy of the cached result of query, or None.
+        """
+        key = self.key(query, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            data = entry[1]
+        # Rows are copied so the caller cannot change the cached ones
+        return QueryAnswere(data=[dict(row) for row in data], error="")
+
+    def generation(self, query: str) -> tuple:
+        """
+        Returns the version of the tables of query, to give to `put`: a result read while one of them
+        was written is not cached.
+        """
+        tables = referenced_tables(query)
+        with self._lock:
+            return (self._generation,) + tuple(self._generations.get(table, 0) for table in sorted(tables))
+
+    def put(self, query: str, params, answer: QueryAnswere, generation: tuple = None) -> bool:
+        """
+        Caches the result of query.
+
+        Parameters:
+        ----------
+        query : str
+            The query.
+        params : sequence or dict, optional
+            Its parameters.
+        answer : QueryAnswere
+            Its result, only cached without error.
+        generation : tuple, optional
+            Value of `generation(query)` before the query was run.
+
+        Returns:
+        -------
+        bool:
+            True if the result was cached.
+        """
+        if answer.error or not self.cacheable(query):
+            return False
+        size = _estimate_size(answer.data)
+        if size > self.max_entry_bytes:
+            return False
+        tables = referenced_tables(query)
+        key = self.key(query, params)
+        data = [dict(row) for row in answer.data]
+        with self._lock:
+            current = (self._generation,) + tuple(self._generations.get(table, 0) for table in sorted(tables))
+            if generation is not None and generation != current:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, data, size, tables)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+        return True
+
+    def invalidate(self, table: str = None) -> int:
+        """
+        Evicts the results depending on table, or every result when table is None.
+
+        Returns:
+        -------
+        int:
+            Number of results evicted.
+        """
+        with self._lock:
+            self._stats['invalidations'] += 1
+            if table is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._by_table.clear()
+                self._bytes = 0
+                self._generation += 1
+                return count
+            table = table.strip('"`[]').split('.')[-1].lower()
+            self._generations[table] = self._generations.get(table, 0) + 1
+            keys = self._by_table.pop(table, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def observe(self, query: str) -> int:
+        """
+        Evicts the results made stale by a query that writes: those of the tables it writes, or every
+        result when they cannot be found. Does nothing for read-only queries.
+        """
+        if _first_keyword(query) in ('select', 'explain', 'show', 'describe') or self.cacheable(query):
+            return 0
+        tables, resolved = _table_references(query)
+        if not tables or not resolved:
+            return self.invalidate()
+        return sum(self.invalidate(table) for table in tables)
+
+    def stats(self) -> dict:
+        """
+        Returns the hits, misses, evictions and invalidations, with the number and estimated size of the cached results.
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
+    def clear(self):
+        """
+        Removes every result.
+        """
+        self.invalidate()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _remove(self, key):
+        # Called with the lock held
+        _, _, size, tables = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+
+def _estimate_size(rows: list) -> int:
+    # JSON size of up to 16 rows, extrapolated, plus a fixed overhead per row
+    if not rows:
+        return 64
+    sample = rows[:16]
+    sample_size = len(json.dumps(sample, default=str))
+    return 64 + (sample_size * len(rows)) // len(sample) + 56 * len(rows)
+
+
+class CachedRepository(DBRepository):
+    """
+    Repository answering repeated read queries of the wrapped repository from a `QueryCache`.
+    Writes made through it (execute_query, execute_many) evict the results of the tables they change;
+    call `invalidate(table)` after writes made elsewhere. Unlike the other repositories it is not a
+    singleton, there is one per wrapped repository.
+
+    Attributes:
+    ----------
+    repository : DBRepository
+        The wrapped repository.
+    cache : QueryCache
+        The cached results.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, repository: DBRepository, cache: QueryCache = None):
+        """
+        Initializes the cached repository.
+
+        Parameters:
+        ----------
+        repository : DBRepository
+            The repository running the queries.
+        cache : QueryCache, optional
+            The cache, a new 64 MB one with a 5 minutes time to live by default.
+        """
+        self.repository = repository
+        self.cache = cache or QueryCache()
+        self.connection_string = getattr(repository, 'connection_string', None)
+
+    def __getattr__(self, name):
+        # execute_many, transaction and the other methods of the wrapped repository
+        if name == 'repository':
+            raise AttributeError(name)
+        return getattr(self.repository, name)
+
+    def _connect_db(self) -> None:
+        pass
+
+    def execute_query(self, query: str, params=None) -> QueryAnswere:
+        """
+        Returns the cached result of a read query, or runs the query on the wrapped repository.
+
+        Parameters:
+        ----------
+        query : str
+            The query.
+        params : sequence or dict, optional
+            Its parameters, for repositories supporting them.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The result of the query.
+        """
+        if not self.cache.cacheable(query):
+            answer = self._run(query, params)
+            self.cache.observe(query)
+            return answer
+        answer = self.cache.get(query, params)
+        if answer is not None:
+            return answer
+        generation = self.cache.generation(query)
+        answer = self._run(query, params)
+        self.cache.put(query, params, answer, generation)
+        return answer
+
+    def execute_many(self, query: str, seq_of_params) -> QueryAnswere:
+        """
+        Runs a bulk statement on the wrapped repository, then evicts the results it makes stale.
+        """
+        answer = self.repository.execute_many(query, seq_of_params)
+        self.cache.observe(query)
+        return answer
+
+    def invalidate(self, table: str = None) -> int:
+        """
+        Evicts the cached results depending on table, or all of them. See `QueryCache.invalidate`.
+        """
+        return self.cache.invalidate(table)
+
+    def find_chat_by_id(self, chat_id: int) -> QueryAnswere:
+        return self.repository.find_chat_by_id(chat_id)
+
+    def save_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        return self.repository.save_chat(chat_id, chat)
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        return self.repository.save_chat_if_version(chat_id, chat, version)
+
+    def copy_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        return self.repository.copy_chat(chat_id, chat)
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        return self.repository.delete_chat(chat_id)
+
+    def find_chat_tail(self, chat_id: int, n: int) -> QueryAnswere:
+        return self.repository.find_chat_tail(chat_id, n)
+
+    def append_messages(self, chat_id: int, messages: list[dict]) -> QueryAnswere:
+        return self.repository.append_messages(chat_id, messages)
+
+    def get_schema(self) -> QueryAnswere:
+        return self.repository.get_schema()
+
+    def get_schema_version(self) -> str:
+        return self.repository.get_schema_version()
+
+    def _run(self, query: str, params) -> QueryAnswere:
+        if params is None:
+            return self.repository.execute_query(query)
+        return self.repository.execute_query(query, params)
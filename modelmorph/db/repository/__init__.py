@@ -1,3 +1,16 @@
-from .azure_db_repository import *
-from .mongo_db_repository import *
-#from .mysql_db_repository import *
\ No newline at end of file
+from modelmorph._lazy import attach
+from modelmorph.db.domain import DBRepository, QueryAnswere
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['azure_db_repository', 'memory_db_repository', 'mongo_db_repository', 'mysql_db_repository', 'sharded_db_repository', 'sql_db_repository'],
+    attributes={
+        'azure_db_repository': ['AzureDBRepository'],
+        'memory_db_repository': ['InMemoryDBRepository'],
+        'mongo_db_repository': ['MongoDBRepository'],
+        'mysql_db_repository': ['MySQLRepository'],
+        'sharded_db_repository': ['HashRing', 'ShardedDBRepository'],
+        'sql_db_repository': ['ConnectionPool', 'PoolTimeout', 'SqlRepository', 'translate_parameters'],
+    },
+    eager=['DBRepository', 'QueryAnswere'],
+)
@@ -0,0 +1,104 @@
+from modelmorph.db.domain import VERSION_CONFLICT, DBRepository, QueryAnswere
+import copy
+import threading
+
+
+class InMemoryDBRepository(DBRepository):
+    """
+    Chat storage kept in the memory of the process. Used with `MockLlm` for local load tests,
+    and by anything needing a DBRepository without a database server.
+    """
+
+    def __init__(self, connection_string: str = ''):
+        super().__init__(connection_string)
+
+    def _connect_db(self) -> None:
+        """
+        Creates the in-memory collections. The repository is a singleton, so existing data is kept.
+        """
+        if not hasattr(self, 'collections'):
+            self.collections = {'chats': {}}
+            self._lock = threading.Lock()
+
+    def execute_query(self, query: str) -> QueryAnswere:
+        """
+        Returns every document of the collection named by query.
+        """
+        with self._lock:
+            data = [copy.deepcopy(document) for document in self.collections.get(query, {}).values()]
+        return QueryAnswere(data=data, error="")
+
+    def find_chat_by_id(self, chat_id: int) -> QueryAnswere:
+        """
+        Finds a chat by its ID, with a `400` error if it does not exist.
+        """
+        with self._lock:
+            chat = self.collections['chats'].get(chat_id)
+            if chat is None:
+                return QueryAnswere(data=[], error=400)
+            return QueryAnswere(data=[copy.deepcopy(chat)], error="")
+
+    def find_chat_tail(self, chat_id: int, n: int) -> QueryAnswere:
+        """
+        Finds a chat by its ID with only its last n messages, with a `400` error if it does not exist.
+        """
+        with self._lock:
+            chat = self.collections['chats'].get(chat_id)
+            if chat is None:
+                return QueryAnswere(data=[], error=400)
+            tail = {**chat, 'messages': chat.get('messages', [])[-n:] if n > 0 else []}
+            return QueryAnswere(data=[copy.deepcopy(tail)], error="")
+
+    def append_messages(self, chat_id: int, messages: list[dict]) -> QueryAnswere:
+        """
+        Appends messages to a chat, creating it if needed.
+        """
+        with self._lock:
+            chat = self.collections['chats'].setdefault(chat_id, {'_id': chat_id, 'messages': []})
+            chat.setdefault('messages', []).extend(copy.deepcopy(list(messages)))
+            chat['version'] = chat.get('version', 0) + 1
+        return QueryAnswere(data=[], error="")
+
+    def save_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Saves or replaces a chat, incrementing its version.
+        """
+        with self._lock:
+            stored = self.collections['chats'].get(chat_id)
+            self._store(chat_id, chat, (stored or {}).get('version', 0) + 1)
+        return QueryAnswere(data=[], error="")
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        """
+        Saves a chat only if the stored one is at version, with a `VERSION_CONFLICT` error otherwise.
+        """
+        with self._lock:
+            stored = self.collections['chats'].get(chat_id)
+            if (stored or {}).get('version', 0) != version:
+                return QueryAnswere(data=[], error=VERSION_CONFLICT)
+            self._store(chat_id, chat, version + 1)
+        return QueryAnswere(data=[{'version': version + 1}], error="")
+
+    def copy_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Inserts a chat keeping its version, with a `VERSION_CONFLICT` error if it exists.
+        """
+        version = chat.get('version', 0)
+        with self._lock:
+            if chat_id in self.collections['chats']:
+                return QueryAnswere(data=[], error=VERSION_CONFLICT)
+            self._store(chat_id, chat, version)
+        return QueryAnswere(data=[{'version': version}], error="")
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        """
+        Deletes a chat, with a `400` error if it does not exist.
+        """
+        with self._lock:
+            if self.collections['chats'].pop(chat_id, None) is None:
+                return QueryAnswere(data=[], error=400)
+        return QueryAnswere(data=[], error="")
+
+    def _store(self, chat_id: int, chat: dict, version: int):
+        # Called with the lock held
+        self.collections['chats'][chat_id] = {**copy.deepcopy(chat), 'version': version}
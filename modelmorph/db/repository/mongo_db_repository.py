@@ -1,7 +1,20 @@
-from modelmorph.db.domain import DBRepository, QueryAnswere
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from modelmorph.db.domain import VERSION_CONFLICT, DBRepository, QueryAnswere
+from modelmorph.deadline import current_deadline
+from datetime import datetime, timezone
+import pymongo
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 import os
+import threading
+
+# Name of the TTL index removing the chats inactive for longer than CHAT_TTL_SECONDS
+CHAT_TTL_INDEX = 'chats_updated_at_ttl'
+
+# Clients by connection string, and the (connection string, database, TTL) already indexed: the
+# singleton runs `_connect_db` again on every construction, a process connects and indexes only once
+_clients = {}
+_indexed = set()
+_clients_lock = threading.Lock()
 
 class MongoDBRepository(DBRepository):
 
@@ -10,17 +23,81 @@ class MongoDBRepository(DBRepository):
         Connects to the MongoDB database using the connection string.
 
         This method retrieves the database name from environment variables and attempts to establish a connection with MongoDB.
+        The client of a connection string is shared by the repositories of the process, and the indexes
+        are created once per connection string, database and TTL.
 
         Output:
             - None; initializes the `client` and `db` attributes if connection is successful.
-            - Prints an error message if the connection fails.
+            - Creates the indexes of the 'chats' collection, with a TTL when 'CHAT_TTL_SECONDS' is set.
+            - Prints an error message if the connection fails, or if 'CHAT_TTL_SECONDS' is not a number.
         """
         db_name = os.getenv('DB_NAME')
         try:
-            self.client = MongoClient(self.connection_string)
+            with _clients_lock:
+                client = _clients.get(self.connection_string)
+                if client is None:
+                    client = _clients[self.connection_string] = MongoClient(self.connection_string)
+            self.client = client
             self.db = self.client.get_database(db_name)
         except PyMongoError as e:
             print(f"Failed to connect to MongoDB: {e}")
+            return
+        ttl = os.getenv('CHAT_TTL_SECONDS')
+        if not ttl:
+            return
+        try:
+            ttl = int(ttl)
+        except ValueError:
+            print(f"Invalid CHAT_TTL_SECONDS '{ttl}', the chats are kept without TTL")
+            return
+        key = (self.connection_string, db_name, ttl)
+        with _clients_lock:
+            if key in _indexed:
+                return
+            _indexed.add(key)
+        result = self.ensure_indexes(ttl)
+        if result.error:
+            print(f"Failed to create the chat indexes: {result.error}")
+            with _clients_lock:
+                # Tried again by the next repository
+                _indexed.discard(key)
+
+    def ensure_indexes(self, ttl_seconds: int = None) -> QueryAnswere:
+        """
+        Creates the indexes of the 'chats' collection. Chats are saved with an 'updated_at' date, and
+        with ttl_seconds the ones not updated for that long are removed by MongoDB. Changing ttl_seconds
+        updates the existing index, and None drops it.
+
+        Input:
+            - ttl_seconds (int, optional): Seconds of inactivity after which a chat is removed.
+
+        Output:
+            - QueryAnswere: Contains the names of the indexes of the collection, or the error.
+        """
+        try:
+            collection = self.db['chats']
+            if ttl_seconds is None:
+                if CHAT_TTL_INDEX in collection.index_information():
+                    collection.drop_index(CHAT_TTL_INDEX)
+            else:
+                try:
+                    collection.create_index([("updated_at", ASCENDING)], name=CHAT_TTL_INDEX, expireAfterSeconds=ttl_seconds)
+                except OperationFailure as e:
+                    # IndexOptionsConflict: the index exists with another TTL
+                    if e.code != 85:
+                        raise
+                    self.db.command('collMod', 'chats', index={'name': CHAT_TTL_INDEX, 'expireAfterSeconds': ttl_seconds})
+            return QueryAnswere(data=list(collection.index_information()), error="")
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def _timeout(self):
+        """
+        Limits the operations of the block to the time left to the current request (see `use_deadline`),
+        they fail at once with a timeout error once it is cancelled.
+        """
+        deadline = current_deadline()
+        return pymongo.timeout(deadline.remaining() if deadline is not None else None)
 
     def execute_query(self, query: str) -> QueryAnswere:
         """
@@ -34,9 +111,10 @@ class MongoDBRepository(DBRepository):
             - Returns an error message in `QueryAnswere` if the query fails.
         """
         try:
-            collection = self.db[query]
-            data = list(collection.find())
-            return QueryAnswere(data=data, error="")
+            with self._timeout():
+                collection = self.db[query]
+                data = list(collection.find())
+                return QueryAnswere(data=data, error="")
         except PyMongoError as e:
             return QueryAnswere(data=[], error=str(e))
         
@@ -52,18 +130,66 @@ class MongoDBRepository(DBRepository):
             - Returns a `400` error in `QueryAnswere` if the chat is not found, or another error if an exception occurs.
         """
         try:
-            collection = self.db['chats']
-            data = list(collection.find({"_id": chat_id}))
-            if data:
-                return QueryAnswere(data=data, error="")
-            else:
-                return QueryAnswere(data=[], error=400)
+            with self._timeout():
+                collection = self.db['chats']
+                data = list(collection.find({"_id": chat_id}))
+                if data:
+                    return QueryAnswere(data=data, error="")
+                else:
+                    return QueryAnswere(data=[], error=400)
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def find_chat_tail(self, chat_id: int, n: int) -> QueryAnswere:
+        """
+        Finds a chat by its ID with only its last n messages, projected by the server with $slice,
+        so the read has the same size whatever the length of the chat.
+
+        Input:
+            - chat_id (int): The ID of the chat to find.
+            - n (int): Number of messages to load, from the end of the chat.
+
+        Output:
+            - QueryAnswere: Contains the chat and error information, `400` if the chat is not found.
+        """
+        try:
+            with self._timeout():
+                collection = self.db['chats']
+                projection = {"messages": {"$slice": -n}} if n > 0 else {"messages": 0}
+                chat = collection.find_one({"_id": chat_id}, projection)
+                if chat is None:
+                    return QueryAnswere(data=[], error=400)
+                chat.setdefault("messages", [])
+                return QueryAnswere(data=[chat], error="")
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def append_messages(self, chat_id: int, messages: list[dict]) -> QueryAnswere:
+        """
+        Appends messages to a chat with $push, creating it if needed, without sending the stored history again.
+
+        Input:
+            - chat_id (int): The ID of the chat.
+            - messages (list of dict): The new messages.
+
+        Output:
+            - QueryAnswere: Contains information on the update operation.
+        """
+        try:
+            with self._timeout():
+                collection = self.db['chats']
+                collection.update_one(
+                    {"_id": chat_id},
+                    {"$push": {"messages": {"$each": list(messages)}}, "$set": {"updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}},
+                    upsert=True
+                )
+                return QueryAnswere(data=[], error="")
         except PyMongoError as e:
             return QueryAnswere(data=[], error=str(e))
         
     def save_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
         """
-        Saves or updates a chat in the 'chats' collection.
+        Saves or updates a chat in the 'chats' collection, incrementing its version.
 
         Input:
             - chat_id (int): The ID of the chat to save.
@@ -74,11 +200,114 @@ class MongoDBRepository(DBRepository):
             - Returns an error in `QueryAnswere` if the save operation fails.
         """
         try:
-            collection = self.db['chats']
-            result = collection.update_one({"_id": chat_id}, {"$set": chat}, upsert=True)
-            if result.modified_count > 0:
-                return QueryAnswere(data=[], error="")
-            else:
-                return QueryAnswere(data=[], error="Failed to save chat")
+            with self._timeout():
+                collection = self.db['chats']
+                result = collection.update_one({"_id": chat_id}, {"$set": self._document(chat), "$inc": {"version": 1}}, upsert=True)
+                if result.matched_count > 0 or result.upserted_id is not None:
+                    return QueryAnswere(data=[], error="")
+                else:
+                    return QueryAnswere(data=[], error="Failed to save chat")
         except PyMongoError as e:
             return QueryAnswere(data=[], error=str(e))
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        """
+        Saves a chat only if the stored one is still at version, with a single conditional update: the
+        replicas of a service can serve the turns of the same chat without overwriting each other.
+
+        Input:
+            - chat_id (int): The ID of the chat to save.
+            - chat (dict): The chat data to save.
+            - version (int): Version of the chat when it was read, 0 for a new chat (or one saved without version).
+
+        Output:
+            - QueryAnswere: [{'version': int}] with the new version, or a `VERSION_CONFLICT` (409) error if the chat changed.
+        """
+        update = {"$set": {**self._document(chat), "version": version + 1}}
+        try:
+            with self._timeout():
+                collection = self.db['chats']
+                if version:
+                    result = collection.update_one({"_id": chat_id, "version": version}, update)
+                    if result.matched_count == 0:
+                        return QueryAnswere(data=[], error=VERSION_CONFLICT)
+                else:
+                    # Inserts the chat, or fails on the _id when it was created (with a version) meanwhile
+                    collection.update_one({"_id": chat_id, "version": {"$in": [None, 0]}}, update, upsert=True)
+                return QueryAnswere(data=[{"version": version + 1}], error="")
+        except DuplicateKeyError:
+            return QueryAnswere(data=[], error=VERSION_CONFLICT)
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def copy_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Inserts a chat read from another database keeping its version, see `DBRepository.copy_chat`.
+
+        Input:
+            - chat_id (int): The ID of the chat to insert.
+            - chat (dict): The chat data, with its 'version'.
+
+        Output:
+            - QueryAnswere: [{'version': int}] with the kept version, or a `VERSION_CONFLICT` (409) error if the chat exists.
+        """
+        version = chat.get("version", 0)
+        try:
+            with self._timeout():
+                self.db['chats'].insert_one({**self._document(chat), "_id": chat_id, "version": version})
+                return QueryAnswere(data=[{"version": version}], error="")
+        except DuplicateKeyError:
+            return QueryAnswere(data=[], error=VERSION_CONFLICT)
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        """
+        Deletes a chat from the 'chats' collection.
+
+        Input:
+            - chat_id (int): The ID of the chat to delete.
+
+        Output:
+            - QueryAnswere: Contains information on the deletion, `400` if the chat is not found.
+        """
+        try:
+            with self._timeout():
+                result = self.db['chats'].delete_one({"_id": chat_id})
+                return QueryAnswere(data=[], error="" if result.deleted_count else 400)
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def _document(self, chat: dict) -> dict:
+        """
+        Returns the fields of chat set by a save, the version is managed by the repository.
+        """
+        document = {key: value for key, value in chat.items() if key not in ("_id", "version")}
+        document["updated_at"] = datetime.now(timezone.utc)
+        return document
+
+    def get_schema(self) -> QueryAnswere:
+        """
+        Lists the collections of the database with the fields of one sample document of each.
+
+        Output:
+            - QueryAnswere: One {'table': str, 'columns': list[str]} dict per collection.
+            - Returns an error in `QueryAnswere` if the introspection fails.
+        """
+        try:
+            data = []
+            for name in sorted(self.db.list_collection_names()):
+                sample = self.db[name].find_one() or {}
+                data.append({"table": name, "columns": list(sample.keys())})
+            return QueryAnswere(data=data, error="")
+        except PyMongoError as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def get_schema_version(self) -> str:
+        """
+        Returns the sorted collection names as the schema version, documents have no fixed columns.
+
+        Output:
+            - str: Comma separated collection names.
+        """
+        return ",".join(sorted(self.db.list_collection_names()))
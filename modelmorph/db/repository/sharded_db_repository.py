@@ -0,0 +1,595 @@
+from bisect import bisect
+from collections import OrderedDict
+from modelmorph.db.domain import DBRepository, QueryAnswere
+import hashlib
+import os
+import threading
+import time
+
+# Chat ids known to be on their current shard, skipping the lookup in the previous ones
+_SETTLED_SIZE = 100000
+
+# Repositories created by `ShardedDBRepository.from_env`, by value of the variable, shared like the singletons
+_env_repositories = {}
+_env_lock = threading.Lock()
+
+
+def ring_hash(key) -> int:
+    """
+    Returns a 64 bits hash of key, stable across processes (unlike `hash`).
+    """
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring: each node is placed at virtual_nodes points of the ring and a key belongs
+    to the node of the first point after its hash. Adding a node moves only about 1/N of the keys,
+    all of them to the new node.
+
+    Attributes:
+    ----------
+    nodes : tuple[str]
+        Names of the nodes, in order of addition.
+    virtual_nodes : int
+        Points per node, more spread the keys more evenly.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes: int = 128):
+        """
+        Initializes the ring.
+
+        Parameters:
+        ----------
+        nodes : iterable of str
+            Names of the nodes.
+        virtual_nodes : int
+            Points per node.
+        """
+        self.virtual_nodes = virtual_nodes
+        self.nodes = tuple(nodes)
+        if len(set(self.nodes)) != len(self.nodes):
+            raise ValueError(f"Duplicate node names in {list(self.nodes)}")
+        points = sorted((ring_hash(f'{node}#{replica}'), node) for node in self.nodes for replica in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def with_node(self, node: str) -> 'HashRing':
+        """
+        Returns a new ring with node added.
+        """
+        return HashRing(self.nodes + (node,), self.virtual_nodes)
+
+    def node(self, key) -> str:
+        """
+        Returns the node owning key.
+        """
+        if not self._hashes:
+            raise LookupError("The ring has no nodes")
+        return self._owners[bisect(self._hashes, ring_hash(key)) % len(self._hashes)]
+
+    def shares(self) -> dict:
+        """
+        Returns the fraction of the ring (and so of the keys) owned by every node.
+        """
+        shares = dict.fromkeys(self.nodes, 0)
+        previous = self._hashes[-1] - 2 ** 64 if self._hashes else 0
+        for point, node in zip(self._hashes, self._owners):
+            shares[node] += point - previous
+            previous = point
+        return {node: share / 2 ** 64 for node, share in shares.items()}
+
+
+class ShardedDBRepository(DBRepository):
+    """
+    Chat storage spread over several repositories (e.g. one MongoDBRepository per cluster) by a
+    consistent hash of the chat id, so the write throughput grows with the number of shards.
+
+    The placement can be read from a configuration file shared by every process (the workers of
+    `modelmorph.serve`, the replicas of a deployment), checked again every reload_interval seconds.
+    Shards are added with `add_shard`, which writes the file: every process switches to the new
+    placement at the same time, once they all had the time to read it. The chats the new shard owns
+    are then copied from their previous shard the first time they are read or written (lazy
+    migration), the others do not move. The copies left on the previous shards are only deleted by
+    `finish_migration`. `stats` reports the health and load of every shard.
+
+    Unlike the other repositories it is not a singleton.
+
+    Attributes:
+    ----------
+    shards : dict[str, DBRepository]
+        Repositories by shard name, the names (not the connection strings) place the shards on the ring.
+    ring : HashRing
+        Placement of the chats, the newest one even before it is active.
+    error_threshold : int
+        Consecutive errors after which a shard is reported unhealthy.
+    config_path : str
+        Shared configuration file, None when the placement only comes from the constructor.
+    reload_interval : float
+        Seconds between two checks of the configuration file.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, shards: dict, virtual_nodes: int = 128, error_threshold: int = 3, previous_shards: list = None,
+                 active_since: float = None):
+        """
+        Initializes the sharded repository.
+
+        Parameters:
+        ----------
+        shards : dict[str, DBRepository]
+            Repositories by shard name.
+        virtual_nodes : int
+            Points of every shard on the ring.
+        error_threshold : int
+            Consecutive errors after which a shard is reported unhealthy.
+        previous_shards : list of list of str, optional
+            Names of the shards of the placements before the last additions, newest first, while their
+            chats are migrated. Lets a process started after `add_shard` find the chats not moved yet.
+        active_since : float, optional
+            Unix time from which the placement of shards is used, the first previous one until then.
+        """
+        if not shards:
+            raise ValueError("At least one shard is required")
+        self.virtual_nodes = virtual_nodes
+        self.error_threshold = error_threshold
+        self.config_path = None
+        self.reload_interval = 1.0
+        self._repository_factory = None
+        self._config_values = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self._settled = OrderedDict()
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._apply(shards, previous_shards, active_since)
+        self.connection_string = None
+
+    @classmethod
+    def from_connection_strings(cls, connection_strings: dict, repository_class: type = None, **kwargs) -> 'ShardedDBRepository':
+        """
+        Creates a shard per connection string.
+
+        Parameters:
+        ----------
+        connection_strings : dict[str, str]
+            Connection strings by shard name.
+        repository_class : type, optional
+            Repository of every shard, defaults to MongoDBRepository.
+        kwargs :
+            Arguments of the constructor (virtual_nodes, error_threshold, previous_shards, active_since).
+
+        Returns:
+        -------
+        ShardedDBRepository:
+            The sharded repository.
+        """
+        factory = _repository_factory(repository_class)
+        return cls({name: factory(name, connection_string) for name, connection_string in connection_strings.items()}, **kwargs)
+
+    @classmethod
+    def from_config_file(cls, path: str, repository_class: type = None, repository_factory=None, reload_interval: float = 1.0,
+                         **kwargs) -> 'ShardedDBRepository':
+        """
+        Creates the shards listed in a configuration file shared by the processes, and reloads it when
+        it changes. The file has the variables read by `from_env`, one 'VARIABLE=value' per line:
+        'CHAT_SHARDS', 'CHAT_SHARDS_PREVIOUS' and 'CHAT_SHARDS_SINCE'.
+
+        Parameters:
+        ----------
+        path : str
+            Configuration file, on storage every process reads (a shared volume, a config map...).
+        repository_class : type, optional
+            Repository of every shard, defaults to MongoDBRepository.
+        repository_factory : callable, optional
+            Creates the repository of a shard from its name and connection string, instead of repository_class.
+        reload_interval : float
+            Seconds between two checks of the file. Shards added with `add_shard` are used after 3 intervals.
+        kwargs :
+            Arguments of the constructor (virtual_nodes, error_threshold).
+
+        Returns:
+        -------
+        ShardedDBRepository:
+            The sharded repository.
+        """
+        factory = repository_factory or _repository_factory(repository_class)
+        values = _read_config(path)
+        connection_strings, previous_shards, active_since = _parse_config(values, path)
+        repository = cls({name: factory(name, connection_string) for name, connection_string in connection_strings.items()},
+                         previous_shards=previous_shards, active_since=active_since, **kwargs)
+        repository.config_path = path
+        repository.reload_interval = reload_interval
+        repository._repository_factory = factory
+        repository._config_values = values
+        repository._checked_at = time.monotonic()
+        return repository
+
+    @classmethod
+    def from_env(cls, variable: str = 'CHAT_SHARDS', **kwargs) -> 'ShardedDBRepository':
+        """
+        Creates the shards listed in an environment variable as 'name=connection string' entries separated
+        by ';' (MongoDB connection strings can have commas), or returns None when it is not set. The
+        repository is created once per process, like the other repositories.
+
+        While chats are migrated to added shards, '<variable>_PREVIOUS' lists the shard names of the
+        previous placements, e.g. 'a,b' (or 'a,b,c|a,b' after two additions, newest first), and
+        '<variable>_SINCE' the Unix time from which the new placement is used.
+
+        The environment of running processes does not change, so shards can only be added this way by
+        restarting every process. With '<variable>_FILE' set to the path of a shared configuration file,
+        the variables are read from the file instead and shards can be added while serving (see
+        `from_config_file`).
+        """
+        path = os.getenv(f'{variable}_FILE', '').strip()
+        value = path or os.getenv(variable, '').strip()
+        if not value:
+            return None
+        with _env_lock:
+            if value not in _env_repositories:
+                if path:
+                    _env_repositories[value] = cls.from_config_file(path, **kwargs)
+                else:
+                    connection_strings, previous_shards, active_since = _parse_config(
+                        {name: os.getenv(f'{variable}{name}', '') for name in ('', '_PREVIOUS', '_SINCE')}, variable)
+                    kwargs.setdefault('previous_shards', previous_shards)
+                    kwargs.setdefault('active_since', active_since)
+                    _env_repositories[value] = cls.from_connection_strings(connection_strings, **kwargs)
+            return _env_repositories[value]
+
+    def _connect_db(self) -> None:
+        pass
+
+    def add_shard(self, name: str, connection_string: str, delay: float = None):
+        """
+        Adds a shard while serving, by writing it to the shared configuration file. Every process uses
+        the new placement after delay seconds: about 1/N of the chats then belong to the new shard, each
+        is copied from its previous shard the first time it is used.
+
+        Parameters:
+        ----------
+        name : str
+            Name of the shard, it must stay the same in every process and restart.
+        connection_string : str
+            Connection string of the shard.
+        delay : float, optional
+            Seconds before the new placement is used, long enough for every process to read the file.
+            Defaults to 3 reload intervals.
+
+        Raises:
+        ------
+        ValueError:
+            If the repository has no configuration file, or the shard already exists.
+        """
+        if self.config_path is None:
+            raise ValueError("Adding a shard requires a configuration file shared by the processes, see `from_config_file`")
+        self._reload(force=True)
+        values = _read_config(self.config_path)
+        connection_strings, previous_shards, _ = _parse_config(values, self.config_path)
+        if name in connection_strings:
+            raise ValueError(f"Shard '{name}' already exists")
+        if any(separator in name for separator in '=;,|') or any(separator in connection_string for separator in ';|'):
+            raise ValueError(f"Invalid shard '{name}={connection_string}', names can not have '=;,|' and connection strings ';|'")
+        previous_shards.insert(0, list(connection_strings))
+        connection_strings[name] = connection_string
+        since = time.time() + (3 * self.reload_interval if delay is None else delay)
+        _write_config(self.config_path, connection_strings, previous_shards, since)
+        self._reload(force=True)
+
+    def finish_migration(self, chat_ids=()):
+        """
+        Ends the migrations, once every process uses the current placement: chats are then only looked
+        for on their current shard, and the chats not copied yet are lost. The configuration file (when
+        there is one) is rewritten without the previous placements.
+
+        Parameters:
+        ----------
+        chat_ids : iterable, optional
+            Chats whose copies on their previous shards are deleted, after they are copied to their
+            current shard if they were not yet. Copies of the other chats are left behind (the chat
+            TTL index of MongoDB eventually removes them).
+
+        Raises:
+        ------
+        ValueError:
+            If the current placement is not used yet.
+        """
+        self._reload(force=True)
+        if self._active_since is not None and time.time() < self._active_since:
+            raise ValueError("The placement is not used yet, every process may not have switched to it")
+        _, previous_rings = self._placement()
+        for chat_id in chat_ids:
+            shard = self._locate(chat_id)
+            for source in {previous.node(chat_id) for previous in previous_rings} - {shard}:
+                self._call(source, 'write', lambda repository: repository.delete_chat(chat_id))
+        if self.config_path is not None:
+            connection_strings, _, _ = _parse_config(_read_config(self.config_path), self.config_path)
+            _write_config(self.config_path, connection_strings, [], None)
+            self._reload(force=True)
+        else:
+            with self._lock:
+                self._previous_rings = []
+                self._active_since = None
+                self._settled.clear()
+
+    def shard_for(self, chat_id) -> str:
+        """
+        Returns the name of the shard owning chat_id.
+        """
+        self._reload()
+        return self._placement()[0].node(chat_id)
+
+    def find_chat_by_id(self, chat_id: int) -> QueryAnswere:
+        """
+        Finds a chat on its shard, copying it there first when it is still on a previous one.
+        """
+        shard = self._locate(chat_id)
+        return self._call(shard, 'read', lambda repository: repository.find_chat_by_id(chat_id))
+
+    def find_chat_tail(self, chat_id: int, n: int) -> QueryAnswere:
+        shard = self._locate(chat_id)
+        return self._call(shard, 'read', lambda repository: repository.find_chat_tail(chat_id, n))
+
+    def save_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        shard = self._locate(chat_id)
+        return self._call(shard, 'write', lambda repository: repository.save_chat(chat_id, chat))
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        shard = self._locate(chat_id)
+        return self._call(shard, 'write', lambda repository: repository.save_chat_if_version(chat_id, chat, version))
+
+    def append_messages(self, chat_id: int, messages: list[dict]) -> QueryAnswere:
+        shard = self._locate(chat_id)
+        return self._call(shard, 'write', lambda repository: repository.append_messages(chat_id, messages))
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        shard = self._locate(chat_id)
+        return self._call(shard, 'write', lambda repository: repository.delete_chat(chat_id))
+
+    def execute_query(self, query: str) -> QueryAnswere:
+        """
+        Runs query on every shard and concatenates the results, stopping at the first error.
+        """
+        self._reload()
+        data = []
+        for name in self.ring.nodes:
+            answer = self._call(name, 'read', lambda repository: repository.execute_query(query))
+            if answer.error:
+                return answer
+            data.extend(answer.data)
+        return QueryAnswere(data=data, error="")
+
+    def get_schema(self) -> QueryAnswere:
+        return self.shards[self.ring.nodes[0]].get_schema()
+
+    def get_schema_version(self) -> str:
+        return self.shards[self.ring.nodes[0]].get_schema_version()
+
+    def stats(self) -> dict:
+        """
+        Returns, per shard: 'healthy' (fewer than error_threshold consecutive errors), 'reads', 'writes',
+        'errors', 'consecutive_errors', 'last_error', 'latency_ms' (moving average), 'migrated_in' (chats
+        copied to it) and 'share' (fraction of the chats it owns in the placement used).
+        """
+        self._reload()
+        shares = self._placement()[0].shares()
+        with self._lock:
+            return {name: metrics.to_dict(self.error_threshold, shares.get(name, 0.0)) for name, metrics in self._metrics.items()}
+
+    def check_health(self) -> dict:
+        """
+        Sends a read to every shard (a chat that does not exist) and returns whether each one answered.
+        """
+        self._reload()
+        health = {}
+        for name in self.ring.nodes:
+            answer = self._call(name, 'read', lambda repository: repository.find_chat_by_id('__modelmorph_health__'))
+            health[name] = not answer.error or answer.error == 400
+        return health
+
+    def _apply(self, shards: dict, previous_shards: list, active_since: float):
+        ring = HashRing(shards, self.virtual_nodes)
+        previous_rings = []
+        for names in previous_shards or []:
+            unknown = set(names) - set(shards)
+            if unknown:
+                raise ValueError(f"Unknown previous shards {sorted(unknown)}")
+            previous_rings.append(HashRing(names, self.virtual_nodes))
+        with self._lock:
+            self.shards = dict(shards)
+            self.ring = ring
+            # Placements before the last shard additions, newest first, where chats not migrated yet are
+            self._previous_rings = previous_rings
+            self._active_since = active_since if previous_rings else None
+            self._metrics = {name: self._metrics.get(name) or _ShardMetrics() for name in self.shards}
+            self._settled.clear()
+
+    def _reload(self, force: bool = False):
+        """
+        Applies the configuration file when it changed, read at most every reload_interval seconds.
+        """
+        if self.config_path is None:
+            return
+        with self._reload_lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                values = _read_config(self.config_path)
+                if values == self._config_values:
+                    return
+                connection_strings, previous_shards, active_since = _parse_config(values, self.config_path)
+            except (OSError, ValueError):
+                # The last placement read stays in use while the file is unavailable or invalid
+                return
+            shards = {}
+            for name, connection_string in connection_strings.items():
+                current = self.shards.get(name)
+                if current is not None and getattr(current, 'connection_string', None) == connection_string:
+                    shards[name] = current
+                else:
+                    shards[name] = self._repository_factory(name, connection_string)
+            self._apply(shards, previous_shards, active_since)
+            self._config_values = values
+
+    def _placement(self) -> tuple:
+        """
+        Returns the ring in use and the previous rings, the newest placement being used only from active_since.
+        """
+        with self._lock:
+            ring, previous_rings, active_since = self.ring, self._previous_rings, self._active_since
+        if active_since is not None and time.time() < active_since:
+            return previous_rings[0], previous_rings[1:]
+        return ring, previous_rings
+
+    def _locate(self, chat_id) -> str:
+        """
+        Returns the shard of chat_id, after copying the chat there when it is only on the shard that
+        owned it before the last additions.
+        """
+        self._reload()
+        ring, previous_rings = self._placement()
+        shard = ring.node(chat_id)
+        if not previous_rings:
+            return shard
+        key = (chat_id, shard)
+        with self._lock:
+            if key in self._settled:
+                self._settled.move_to_end(key)
+                return shard
+        found = self._call(shard, 'read', lambda repository: repository.find_chat_by_id(chat_id))
+        if found.error == 400:
+            self._migrate(chat_id, shard, previous_rings)
+        if not found.error or found.error == 400:
+            with self._lock:
+                self._settled[key] = None
+                while len(self._settled) > _SETTLED_SIZE:
+                    self._settled.popitem(last=False)
+        return shard
+
+    def _migrate(self, chat_id, shard: str, previous_rings: list):
+        # The newest placement having the chat has its latest copy. The copy is not deleted: a process
+        # that did not read the new placement yet would write the chat there again, see `finish_migration`
+        for ring in previous_rings:
+            source = ring.node(chat_id)
+            if source == shard:
+                continue
+            found = self._call(source, 'read', lambda repository: repository.find_chat_by_id(chat_id))
+            if found.error:
+                continue
+            chat = found.data[0]
+            # Keeps the version, so a writer that read the chat before the move still conflicts; a chat
+            # written meanwhile on the new shard is not overwritten
+            copied = self._call(shard, 'write', lambda repository: repository.copy_chat(chat_id, chat))
+            if not copied.error:
+                with self._lock:
+                    self._metrics[shard].migrated_in += 1
+            return
+
+    def _call(self, shard: str, kind: str, operation) -> QueryAnswere:
+        started = time.perf_counter()
+        try:
+            answer = operation(self.shards[shard])
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            answer = QueryAnswere(data=[], error=str(e))
+        elapsed = time.perf_counter() - started
+        # Missing chats (400) and version conflicts (409) are answers of a healthy shard
+        failed = bool(answer.error) and answer.error not in (400, 409)
+        with self._lock:
+            self._metrics[shard].record(kind, elapsed, answer.error if failed else None)
+        return answer
+
+
+def _repository_factory(repository_class: type = None):
+    if repository_class is None:
+        from .mongo_db_repository import MongoDBRepository
+        repository_class = MongoDBRepository
+    return lambda name, connection_string: repository_class.standalone(connection_string)
+
+
+def _read_config(path: str) -> dict:
+    # 'VARIABLE=value' lines, the values of the variables are suffixes of CHAT_SHARDS ('', '_PREVIOUS', '_SINCE')
+    values = {}
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            variable, _, value = line.partition('=')
+            values[variable.strip().replace('CHAT_SHARDS', '', 1)] = value.strip().strip('"')
+    return values
+
+
+def _parse_config(values: dict, source: str) -> tuple:
+    """
+    Returns the connection strings by shard name, the previous placements and the time the current
+    one is used from, of the values of 'CHAT_SHARDS', 'CHAT_SHARDS_PREVIOUS' and 'CHAT_SHARDS_SINCE'.
+    """
+    connection_strings = {}
+    for entry in filter(None, (entry.strip() for entry in values.get('', '').split(';'))):
+        name, separator, connection_string = entry.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid shard '{entry}' in {source}, expected 'name=connection string'")
+        connection_strings[name.strip()] = connection_string.strip()
+    if not connection_strings:
+        raise ValueError(f"No shard in {source}")
+    previous = values.get('_PREVIOUS', '').strip()
+    previous_shards = [[name.strip() for name in group.split(',') if name.strip()] for group in previous.split('|')] if previous else []
+    since = values.get('_SINCE', '').strip()
+    return connection_strings, previous_shards, float(since) if since else None
+
+
+def _write_config(path: str, connection_strings: dict, previous_shards: list, since: float):
+    lines = ['CHAT_SHARDS=' + ';'.join(f'{name}={connection_string}' for name, connection_string in connection_strings.items())]
+    if previous_shards:
+        lines.append('CHAT_SHARDS_PREVIOUS=' + '|'.join(','.join(names) for names in previous_shards))
+        if since is not None:
+            lines.append(f'CHAT_SHARDS_SINCE={since:.3f}')
+    # Written aside and renamed, the other processes never read a partial file
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, path)
+
+
+class _ShardMetrics:
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_error = None
+        self.latency = None
+        self.migrated_in = 0
+
+    def record(self, kind: str, elapsed: float, error):
+        if kind == 'read':
+            self.reads += 1
+        else:
+            self.writes += 1
+        self.latency = elapsed if self.latency is None else 0.9 * self.latency + 0.1 * elapsed
+        if error is None:
+            self.consecutive_errors = 0
+        else:
+            self.errors += 1
+            self.consecutive_errors += 1
+            self.last_error = str(error)
+
+    def to_dict(self, error_threshold: int, share: float) -> dict:
+        return {
+            'healthy': self.consecutive_errors < error_threshold,
+            'reads': self.reads,
+            'writes': self.writes,
+            'errors': self.errors,
+            'consecutive_errors': self.consecutive_errors,
+            'last_error': self.last_error,
+            'latency_ms': None if self.latency is None else self.latency * 1000,
+            'migrated_in': self.migrated_in,
+            'share': share,
+        }
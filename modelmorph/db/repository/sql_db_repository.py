@@ -0,0 +1,608 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from functools import lru_cache
+from modelmorph.db.domain import VERSION_CONFLICT, DBRepository, QueryAnswere
+from modelmorph.deadline import current_deadline
+import importlib
+import json
+import re
+import threading
+import time
+import zlib
+
+# Table of the chats saved by `SqlRepository`, left out of the schema given to the NlpToSql prompts
+CHATS_TABLE = 'modelmorph_chats'
+
+# String literals, '?' and ':name' placeholders, and '%' signs that must be escaped for format paramstyles
+_PARAMETERS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(\?)|(?<![:\w]):([A-Za-z_]\w*)|(%)""")
+
+
+class PoolTimeout(TimeoutError):
+    """
+    Raised when no connection of a `ConnectionPool` was free before the timeout.
+    """
+
+
+@lru_cache(maxsize=1024)
+def translate_parameters(sql: str, paramstyle: str) -> str:
+    """
+    Rewrites the '?' (qmark) and ':name' (named) placeholders of sql for a driver using the
+    'format' or 'pyformat' paramstyle (e.g. MySQL). Placeholders inside string literals are kept.
+
+    Parameters:
+    ----------
+    sql : str
+        Query with qmark or named placeholders.
+    paramstyle : str
+        The `paramstyle` of the DB-API driver.
+
+    Returns:
+    -------
+    str:
+        The query for the driver, sql itself for the qmark and named paramstyles.
+    """
+    if paramstyle not in ('format', 'pyformat'):
+        return sql
+
+    def replace(match):
+        literal, qmark, name, percent = match.groups()
+        if literal:
+            return literal.replace('%', '%%')
+        if qmark:
+            return '%s'
+        if name:
+            return f'%({name})s'
+        return '%%'
+
+    return _PARAMETERS.sub(replace, sql)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of DB-API connections. Connections are opened on demand up to max_size, and a thread
+    checks out a single connection at a time: nested `connection()` blocks of the same thread reuse it,
+    so a transaction sees its own writes.
+
+    Attributes:
+    ----------
+    max_size : int
+        Maximum number of open connections.
+    timeout : float
+        Seconds to wait for a free connection before raising PoolTimeout.
+    """
+
+    def __init__(self, connect, max_size: int = 5, timeout: float = 30.0):
+        """
+        Initializes the pool, no connection is opened yet.
+
+        Parameters:
+        ----------
+        connect : callable
+            Function opening a new connection.
+        max_size : int
+            Maximum number of open connections.
+        timeout : float
+            Seconds to wait for a free connection, shortened by the deadline of the current request.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._statements = {}
+        self._stats = {'created': 0, 'waits': 0, 'discarded': 0}
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the block. When the block raises, the transaction is rolled back,
+        and the connection is closed if the rollback fails too.
+
+        Returns:
+        -------
+        Connection:
+            The DB-API connection of the thread.
+
+        Raises:
+        ------
+        PoolTimeout:
+            If no connection was free in time.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+
+        connection = self._acquire()
+        self._local.connection = connection
+        broken = False
+        try:
+            yield connection
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._local.connection = None
+            self._release(connection, broken)
+
+    def statements(self, connection) -> OrderedDict:
+        """
+        Returns the cursors kept for the statements of a checked out connection, by query.
+        """
+        return self._statements[id(connection)]
+
+    def stats(self) -> dict:
+        """
+        Returns the number of open, idle and checked out connections, the connections opened and
+        discarded since the start, and the checkouts that had to wait.
+        """
+        with self._condition:
+            return dict(self._stats, size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle))
+
+    def close(self):
+        """
+        Closes the idle connections, the checked out ones are closed when they are given back.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._close(connection)
+
+    def _acquire(self):
+        deadline = current_deadline()
+        timeout = self.timeout if deadline is None else deadline.timeout(self.timeout)
+        end = time.monotonic() + timeout
+        unregister = deadline.on_cancel(self._wake) if deadline is not None else None
+        try:
+            with self._condition:
+                waited = False
+                while True:
+                    if self._closed:
+                        raise RuntimeError("The connection pool is closed")
+                    if deadline is not None:
+                        deadline.check('database connection')
+                    if self._idle:
+                        # Most recently used first, its server session is the least likely to have timed out
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No database connection free after {timeout:.1f}s ({self.max_size} in use)")
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    self._condition.wait(remaining)
+        finally:
+            if unregister is not None:
+                unregister()
+
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats['created'] += 1
+            self._statements[id(connection)] = OrderedDict()
+        return connection
+
+    def _release(self, connection, broken: bool):
+        with self._condition:
+            if not broken and not self._closed:
+                self._idle.append(connection)
+                self._condition.notify()
+                return
+            self._size -= 1
+            if broken:
+                self._stats['discarded'] += 1
+            self._condition.notify()
+        self._close(connection)
+
+    def _close(self, connection):
+        for cursor in self._statements.pop(id(connection), {}).values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+
+class SqlRepository(DBRepository):
+    """
+    Repository over any DB-API 2 driver (sqlite3, mysql.connector...) with a bounded connection pool,
+    so the queries generated by NlpToSql can run concurrently from many chat sessions.
+
+    Queries are written with '?' or ':name' placeholders whatever the driver, and take their values
+    from params instead of being formatted into the SQL. Each pooled connection keeps a cursor per
+    query (a prepared statement with `cursor_kwargs={'prepared': True}` on MySQL; sqlite3 caches the
+    compiled statements of the connection), so repeated queries are not parsed again.
+
+    Chats are saved as JSON documents in the 'modelmorph_chats' table.
+
+    Unlike the other repositories it is not a singleton: each instance owns its pool, so repositories
+    of different databases can be used side by side. Create it once and share it.
+
+    Attributes:
+    ----------
+    pool : ConnectionPool
+        The connections of the repository.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, connection_string: str = '', driver='sqlite3', pool_size: int = 5, checkout_timeout: float = 30.0,
+                 statement_cache_size: int = 128, connect_kwargs: dict = None, cursor_kwargs: dict = None):
+        """
+        Initializes the repository and creates the chats table if needed.
+
+        Parameters:
+        ----------
+        connection_string : str
+            First argument of the driver's connect, e.g. the database file of sqlite3. Empty to only use connect_kwargs.
+            With sqlite3 use a file: every connection to ':memory:' opens a different database.
+        driver : str or module
+            DB-API 2 module, or its name.
+        pool_size : int
+            Maximum number of open connections.
+        checkout_timeout : float
+            Seconds to wait for a free connection.
+        statement_cache_size : int
+            Cursors (statements) kept per connection.
+        connect_kwargs : dict, optional
+            Keyword arguments of the driver's connect.
+        cursor_kwargs : dict, optional
+            Keyword arguments of `connection.cursor()`, e.g. {'prepared': True} for MySQL server-side prepared statements.
+        """
+        self.driver = importlib.import_module(driver) if isinstance(driver, str) else driver
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.statement_cache_size = statement_cache_size
+        self.connect_kwargs = dict(connect_kwargs or {})
+        self.cursor_kwargs = dict(cursor_kwargs or {})
+        self._statement_stats = {'hits': 0, 'misses': 0}
+        self._transactions = threading.local()
+        super().__init__(connection_string)
+
+    def _connect_db(self) -> None:
+        """
+        Creates the connection pool and the chats table.
+        """
+        self.pool = ConnectionPool(self._open_connection, self.pool_size, self.checkout_timeout)
+        answer = self.execute_query(f"CREATE TABLE IF NOT EXISTS {CHATS_TABLE} (id VARCHAR(255) PRIMARY KEY, document TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0)")
+        if not answer.error and self.execute_query(f"SELECT version FROM {CHATS_TABLE} WHERE 1 = 0").error:
+            # Chats table created before the chats had a version
+            answer = self.execute_query(f"ALTER TABLE {CHATS_TABLE} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if answer.error:
+            print(f"Failed to create the chats table: {answer.error}")
+
+    def _open_connection(self):
+        args = (self.connection_string,) if self.connection_string else ()
+        kwargs = dict(self.connect_kwargs)
+        if self.driver.__name__ == 'sqlite3':
+            # Pooled connections are used by one thread at a time, but not always the same one
+            kwargs.setdefault('check_same_thread', False)
+            kwargs.setdefault('cached_statements', self.statement_cache_size)
+        return self.driver.connect(*args, **kwargs)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a pooled connection for the block, see `ConnectionPool.connection`.
+        """
+        with self.pool.connection() as connection:
+            yield connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the queries of the block, made from this thread, in one transaction committed at the end
+        of the block, or rolled back if it raises.
+        """
+        with self.pool.connection() as connection:
+            depth = getattr(self._transactions, 'depth', 0)
+            self._transactions.depth = depth + 1
+            try:
+                yield connection
+            finally:
+                self._transactions.depth = depth
+            if depth == 0:
+                connection.commit()
+
+    def execute_query(self, query: str, params=None) -> QueryAnswere:
+        """
+        Executes a query, committed at once outside of `transaction()`.
+
+        Parameters:
+        ----------
+        query : str
+            The query, with '?' or ':name' placeholders.
+        params : sequence or dict, optional
+            Values of the placeholders.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The rows as dicts, or [{'rowcount': int}] for statements without results.
+        """
+        return self._execute(query, params, many=False)
+
+    def execute_many(self, query: str, seq_of_params) -> QueryAnswere:
+        """
+        Executes a statement once per set of values with the driver's executemany, in one round of
+        statement preparation and one commit, e.g. for bulk inserts.
+
+        Parameters:
+        ----------
+        query : str
+            The statement, with '?' or ':name' placeholders.
+        seq_of_params : iterable of sequence or dict
+            Values of the placeholders for each execution.
+
+        Returns:
+        -------
+        QueryAnswere:
+            [{'rowcount': int}] with the number of rows changed.
+        """
+        return self._execute(query, seq_of_params, many=True)
+
+    def _execute(self, query: str, params, many: bool) -> QueryAnswere:
+        try:
+            with self.pool.connection() as connection:
+                deadline = current_deadline()
+                # sqlite3 stops a running statement when the request is cancelled
+                unregister = deadline.on_cancel(connection.interrupt) if deadline is not None and hasattr(connection, 'interrupt') else None
+                try:
+                    cursor = self._cursor(connection, query)
+                    # Without values the driver does not format the query, its '%' signs are kept as they are
+                    sql = query if params is None and not many else translate_parameters(query, self.driver.paramstyle)
+                    if many:
+                        cursor.executemany(sql, params)
+                    elif params is None:
+                        cursor.execute(sql)
+                    else:
+                        cursor.execute(sql, params)
+                    data = self._rows(cursor)
+                finally:
+                    if unregister is not None:
+                        unregister()
+                if not getattr(self._transactions, 'depth', 0):
+                    connection.commit()
+                return QueryAnswere(data=data, error="")
+        except (self.driver.Error, TimeoutError) as e:
+            return QueryAnswere(data=[], error=str(e))
+
+    def _cursor(self, connection, query: str):
+        statements = self.pool.statements(connection)
+        cursor = statements.get(query)
+        if cursor is not None:
+            statements.move_to_end(query)
+            self._statement_stats['hits'] += 1
+            return cursor
+        self._statement_stats['misses'] += 1
+        cursor = connection.cursor(**self.cursor_kwargs)
+        statements[query] = cursor
+        if len(statements) > self.statement_cache_size:
+            _, evicted = statements.popitem(last=False)
+            evicted.close()
+        return cursor
+
+    @staticmethod
+    def _rows(cursor) -> list[dict]:
+        if cursor.description is None:
+            return [{'rowcount': cursor.rowcount}]
+        columns = [column[0] for column in cursor.description]
+        return [row if isinstance(row, Mapping) else dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def stats(self) -> dict:
+        """
+        Returns the pool statistics (see `ConnectionPool.stats`) with the statement cache hits and misses.
+        """
+        return dict(self.pool.stats(), statements=dict(self._statement_stats))
+
+    def close(self):
+        """
+        Closes the connections of the pool.
+        """
+        self.pool.close()
+
+    def find_chat_by_id(self, chat_id: int) -> QueryAnswere:
+        """
+        Finds a chat by its ID.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to find.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The chat, with a `400` error if it does not exist.
+        """
+        answer = self.execute_query(f"SELECT document, version FROM {CHATS_TABLE} WHERE id = ?", (str(chat_id),))
+        if answer.error:
+            return answer
+        if not answer.data:
+            return QueryAnswere(data=[], error=400)
+        return QueryAnswere(data=[{**json.loads(answer.data[0]['document']), 'version': answer.data[0]['version']}], error="")
+
+    def save_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Saves or replaces a chat, incrementing its version.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to save.
+        chat : dict
+            The chat document, with its messages.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The result of the update.
+        """
+        document = _chat_document(chat_id, chat)
+        try:
+            with self.transaction():
+                answer = self.execute_query(f"UPDATE {CHATS_TABLE} SET document = ?, version = version + 1 WHERE id = ?", (document, str(chat_id)))
+                if not answer.error and answer.data[0]['rowcount'] == 0:
+                    answer = self.execute_query(f"INSERT INTO {CHATS_TABLE} (id, document, version) VALUES (?, ?, 1)", (str(chat_id), document))
+        except (self.driver.Error, TimeoutError) as e:
+            return QueryAnswere(data=[], error=str(e))
+        return QueryAnswere(data=[], error=answer.error)
+
+    def save_chat_if_version(self, chat_id: int, chat: dict, version: int) -> QueryAnswere:
+        """
+        Saves a chat only if the stored one is still at version, with an UPDATE conditioned on it
+        (or an INSERT failing on the primary key for a new chat).
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to save.
+        chat : dict
+            The chat document, with its messages.
+        version : int
+            Version of the chat when it was read, 0 for a new chat.
+
+        Returns:
+        -------
+        QueryAnswere:
+            [{'version': int}] with the new version, or a `VERSION_CONFLICT` (409) error if the chat changed.
+        """
+        document = _chat_document(chat_id, chat)
+        try:
+            with self.transaction():
+                answer = self.execute_query(f"UPDATE {CHATS_TABLE} SET document = ?, version = ? WHERE id = ? AND version = ?",
+                                            (document, version + 1, str(chat_id), version))
+                if answer.error:
+                    return answer
+                if answer.data[0]['rowcount'] == 0:
+                    if version:
+                        return QueryAnswere(data=[], error=VERSION_CONFLICT)
+                    answer = self.execute_query(f"INSERT INTO {CHATS_TABLE} (id, document, version) VALUES (?, ?, 1)", (str(chat_id), document))
+                    if answer.error:
+                        # Created meanwhile by another writer, or a real failure
+                        exists = self.execute_query(f"SELECT 1 AS found FROM {CHATS_TABLE} WHERE id = ?", (str(chat_id),))
+                        return QueryAnswere(data=[], error=VERSION_CONFLICT if exists.data else answer.error)
+        except (self.driver.Error, TimeoutError) as e:
+            return QueryAnswere(data=[], error=str(e))
+        return QueryAnswere(data=[{'version': version + 1}], error="")
+
+    def copy_chat(self, chat_id: int, chat: dict) -> QueryAnswere:
+        """
+        Inserts a chat read from another database keeping its version, with an INSERT failing on the
+        primary key, see `DBRepository.copy_chat`.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to insert.
+        chat : dict
+            The chat data, with its 'version'.
+
+        Returns:
+        -------
+        QueryAnswere:
+            [{'version': int}] with the kept version, or a `VERSION_CONFLICT` (409) error if the chat exists.
+        """
+        version = chat.get('version', 0)
+        answer = self.execute_query(f"INSERT INTO {CHATS_TABLE} (id, document, version) VALUES (?, ?, ?)",
+                                    (str(chat_id), _chat_document(chat_id, chat), version))
+        if answer.error:
+            exists = self.execute_query(f"SELECT 1 AS found FROM {CHATS_TABLE} WHERE id = ?", (str(chat_id),))
+            return QueryAnswere(data=[], error=VERSION_CONFLICT if exists.data else answer.error)
+        return QueryAnswere(data=[{'version': version}], error="")
+
+    def delete_chat(self, chat_id: int) -> QueryAnswere:
+        """
+        Deletes a chat.
+
+        Parameters:
+        ----------
+        chat_id : int
+            The ID of the chat to delete.
+
+        Returns:
+        -------
+        QueryAnswere:
+            The result of the deletion, with a `400` error if the chat does not exist.
+        """
+        answer = self.execute_query(f"DELETE FROM {CHATS_TABLE} WHERE id = ?", (str(chat_id),))
+        if answer.error:
+            return answer
+        return QueryAnswere(data=[], error="" if answer.data[0]['rowcount'] else 400)
+
+    def get_schema(self) -> QueryAnswere:
+        """
+        Lists the tables of the database with their columns, without the chats table.
+
+        Returns:
+        -------
+        QueryAnswere:
+            Data with one {'table': str, 'columns': list[str]} dict per table.
+        """
+        if self.driver.__name__ == 'sqlite3':
+            answer = self.execute_query(
+                "SELECT m.name AS table_name, p.name AS column_name FROM sqlite_master m, pragma_table_info(m.name) p "
+                "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' ORDER BY m.name, p.cid"
+            )
+        else:
+            answer = self.execute_query(
+                "SELECT table_name, column_name FROM information_schema.columns "
+                "WHERE table_schema NOT IN ('information_schema', 'pg_catalog', 'mysql', 'performance_schema', 'sys') "
+                "ORDER BY table_name, ordinal_position"
+            )
+        return _schema_answer(answer)
+
+    def get_schema_version(self) -> str:
+        """
+        Returns a fingerprint of the schema, see `DBRepository.get_schema_version`.
+        """
+        if self.driver.__name__ == 'sqlite3':
+            answer = self.execute_query("PRAGMA schema_version")
+            return "" if answer.error else str(next(iter(answer.data[0].values())))
+        answer = self.get_schema()
+        return "" if answer.error else f"{zlib.crc32(json.dumps(answer.data).encode()):08x}"
+
+
+def _chat_document(chat_id, chat: dict) -> str:
+    # The version is kept in its own column, the one of the document would be stale
+    return json.dumps({**{key: value for key, value in chat.items() if key != 'version'}, '_id': chat_id}, ensure_ascii=False, default=str)
+
+
+def _schema_answer(answer: QueryAnswere) -> QueryAnswere:
+    # Rows of (table_name, column_name), whatever the case of the keys returned by the driver
+    if answer.error:
+        return answer
+    tables = {}
+    for row in answer.data:
+        table, column = (row[key] for key in row)
+        if table != CHATS_TABLE:
+            tables.setdefault(table, []).append(column)
+    return QueryAnswere(data=[{"table": table, "columns": columns} for table, columns in tables.items()], error="")
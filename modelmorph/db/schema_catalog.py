@@ -0,0 +1,193 @@
+import math
+import re
+import threading
+import time
+import weakref
+from collections import Counter
+from modelmorph.db.domain import DBRepository
+
+_STOP_WORDS = frozenset(
+    "a an and are as at by do does for from give get how i in is it list many me much of on or per show "
+    "that the their there to was were what when where which who with all each every find".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text, camelCase and snake_case identifiers into lowercase terms, dropping stop words
+    and a trailing plural 's' so 'wells' matches 'WellName'.
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    terms = []
+    for term in re.findall(r"[a-z0-9]+", text.lower()):
+        if term in _STOP_WORDS:
+            continue
+        if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+class Bm25Index:
+    """
+    In-memory BM25 keyword index over small documents (one per table).
+
+    Attributes:
+    ----------
+    k1 : float
+        Term frequency saturation.
+    b : float
+        Document length normalization.
+    """
+
+    def __init__(self, documents: dict, k1: float = 1.2, b: float = 0.75):
+        """
+        Builds the inverted index.
+
+        Parameters:
+        ----------
+        documents : dict[str, str]
+            Text of every document by key.
+        """
+        self.k1 = k1
+        self.b = b
+        self._keys = list(documents)
+        self._lengths = {}
+        self._postings = {}
+        for key, text in documents.items():
+            terms = Counter(tokenize(text))
+            self._lengths[key] = sum(terms.values())
+            for term, frequency in terms.items():
+                self._postings.setdefault(term, []).append((key, frequency))
+        self._average_length = (sum(self._lengths.values()) / len(self._lengths)) if self._lengths else 0.0
+        total = len(self._keys)
+        self._idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query: str, k: int = 5) -> list[tuple]:
+        """
+        Scores the documents matching the query terms.
+
+        Parameters:
+        ----------
+        query : str
+            Free text query.
+        k : int
+            Maximum number of results.
+
+        Returns:
+        -------
+        list[tuple[str, float]]:
+            (key, score) pairs with a positive score, best first.
+        """
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for key, frequency in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[key] / self._average_length)
+                scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class SchemaCatalog:
+    """
+    Catalog of the tables of a database, built from `DBRepository.get_schema` and shared by every
+    catalog of the same repository instance in the process (repositories of several databases on
+    one server have their own entries). The cached schema and its BM25 index are rebuilt
+    only when `DBRepository.get_schema_version` changes, which is checked at most every
+    `version_check_interval` seconds.
+
+    Attributes:
+    ----------
+    repository : DBRepository
+        Repository introspected by the catalog.
+    version_check_interval : float
+        Minimum number of seconds between two schema version checks.
+    """
+
+    # Entries by repository instance, dropped with the repository
+    _shared = weakref.WeakKeyDictionary()
+    _shared_lock = threading.Lock()
+
+    def __init__(self, repository: DBRepository, version_check_interval: float = 60.0):
+        """
+        Initializes the catalog, the schema is loaded on first use.
+
+        Parameters:
+        ----------
+        repository : DBRepository
+            Repository to introspect.
+        version_check_interval : float
+            Minimum number of seconds between two schema version checks.
+        """
+        self.repository = repository
+        self.version_check_interval = version_check_interval
+
+    @property
+    def tables(self) -> dict:
+        """
+        Columns of every table by table name.
+        """
+        return self._load()['tables']
+
+    def select(self, text: str, k: int = 5) -> dict:
+        """
+        Selects the tables most relevant to a natural language request.
+
+        Parameters:
+        ----------
+        text : str
+            Natural language request.
+        k : int
+            Maximum number of tables.
+
+        Returns:
+        -------
+        dict[str, list[str]]:
+            Columns by table name of the top k tables. When no table matches, the first k tables.
+        """
+        entry = self._load()
+        matches = entry['index'].search(text, k)
+        names = [name for name, _ in matches] or list(entry['tables'])[:k]
+        return {name: entry['tables'][name] for name in names}
+
+    @staticmethod
+    def render(tables: dict) -> str:
+        """
+        Formats tables the way the NlpToSql prompts describe them: '# Table (Column1, Column2)'.
+        """
+        return "\n".join(f"# {table} ({', '.join(columns)})" for table, columns in tables.items())
+
+    def invalidate(self):
+        """
+        Drops the cached schema of the repository, forcing the next use to introspect it again.
+        """
+        with self._shared_lock:
+            self._shared.pop(self.repository, None)
+
+    def _load(self) -> dict:
+        now = time.monotonic()
+        with self._shared_lock:
+            entry = self._shared.get(self.repository)
+        if entry is not None and now - entry['checked_at'] < self.version_check_interval:
+            return entry
+
+        version = self.repository.get_schema_version()
+        if entry is not None and entry['version'] == version:
+            entry['checked_at'] = now
+            return entry
+
+        answer = self.repository.get_schema()
+        if answer.error:
+            raise ValueError(f"Failed to introspect the schema: {answer.error}")
+        tables = {row['table']: list(row['columns']) for row in answer.data}
+        # The table name is repeated so it weighs more than a single column
+        index = Bm25Index({table: f"{table} {table} {' '.join(columns)}" for table, columns in tables.items()})
+        entry = {'version': version, 'tables': tables, 'index': index, 'checked_at': now}
+        with self._shared_lock:
+            self._shared[self.repository] = entry
+        return entry
@@ -0,0 +1 @@
+from .deadline import Deadline, DeadlineExceeded, RequestCancelled, current_deadline, sleep, use_deadline
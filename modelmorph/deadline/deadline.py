@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+_current_deadline = ContextVar('modelmorph_current_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the time budget of a request is exhausted before a step could run or finish.
+    """
+
+
+class RequestCancelled(DeadlineExceeded):
+    """
+    Raised when a request is cancelled, e.g. its client disconnected, so nobody waits for the result.
+    """
+
+
+class Deadline:
+    """
+    Time budget and cancellation flag of one request, shared by every step of its path (model calls,
+    storage, assistants). Steps call `check` before starting, pass `remaining` as their I/O timeout,
+    and register an `on_cancel` callback to abort what is in flight (e.g. close a response stream).
+
+    Make it the deadline of the code below a block with `use_deadline`; `current_deadline` returns it.
+    """
+
+    __slots__ = ('at', 'reason', '_event', '_callbacks', '_lock')
+
+    def __init__(self, timeout: float = None):
+        """
+        Initializes the deadline.
+
+        Input:
+            - timeout (float, optional): Seconds from now before the deadline passes, None to only allow cancellation.
+        """
+        self.at = None if timeout is None else time.monotonic() + timeout
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def coerce(cls, value) -> 'Deadline':
+        """
+        Returns value if it is a Deadline, a new Deadline if it is a timeout in seconds, or None.
+        """
+        if value is None or isinstance(value, Deadline):
+            return value
+        return cls(value)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        """
+        True once the request is cancelled or its time is over.
+        """
+        return self._event.is_set() or (self.at is not None and time.monotonic() >= self.at)
+
+    def remaining(self) -> float:
+        """
+        Returns the seconds left (0 once expired), or None when the deadline has no time limit.
+        """
+        if self._event.is_set():
+            return 0.0
+        if self.at is None:
+            return None
+        return max(self.at - time.monotonic(), 0.0)
+
+    def timeout(self, default: float = None) -> float:
+        """
+        Returns the timeout to give to a blocking call: the smallest of default and the time left.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+    def cancel(self, reason: str = 'cancelled'):
+        """
+        Cancels the request and runs the callbacks registered with `on_cancel`. Can be called from any thread.
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """
+        Registers callback to run when the request is cancelled, at once if it already is.
+
+        Output:
+            - Returns a function unregistering the callback, to call once the guarded step is over.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+
+    def check(self, step: str = 'request'):
+        """
+        Raises RequestCancelled or DeadlineExceeded when step should not start anymore.
+        """
+        if self._event.is_set():
+            raise RequestCancelled(f"Request {self.reason} before {step}")
+        if self.at is not None and time.monotonic() >= self.at:
+            raise DeadlineExceeded(f"Deadline exceeded before {step}")
+
+    def wait(self, seconds: float, step: str = 'request'):
+        """
+        Sleeps for seconds, waking up and raising as soon as the request is cancelled or expires.
+        """
+        self._event.wait(self.timeout(seconds))
+        self.check(step)
+
+    def _unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def current_deadline() -> Deadline:
+    """
+    Returns the deadline of the running request, or None.
+    """
+    return _current_deadline.get()
+
+
+@contextmanager
+def use_deadline(deadline=None):
+    """
+    Makes deadline the one of the code run inside the block.
+
+    Input:
+        - deadline (Deadline or float, optional): Deadline, or timeout in seconds of a new one.
+          None keeps the deadline already in use, if any.
+
+    Output:
+        - Yields the deadline in use, or None.
+    """
+    deadline = Deadline.coerce(deadline)
+    if deadline is None:
+        yield _current_deadline.get()
+        return
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def sleep(seconds: float, deadline: Deadline = None):
+    """
+    time.sleep that is interrupted when the request is cancelled or expires.
+
+    Input:
+        - seconds (float): Time to sleep.
+        - deadline (Deadline, optional): Deadline of the request, defaults to the current one. Generators
+          take it when they start, their consumer may run in another context between two items.
+    """
+    deadline = deadline or _current_deadline.get()
+    if deadline is None:
+        time.sleep(seconds)
+    else:
+        deadline.wait(seconds)
@@ -0,0 +1,9 @@
+from modelmorph._lazy import attach
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['comparison', 'scorers'],
+    attributes={
+        'comparison': ['CaseResult', 'ComparisonReport', 'EvalCase', 'ModelComparison', 'ResultStore'],
+    },
+)
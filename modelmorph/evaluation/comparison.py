@@ -0,0 +1,353 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from modelmorph.chatbot.domain import Llm
+from modelmorph.deadline import use_deadline
+from modelmorph.tracing import span, wrap
+
+
+class EvalCase(NamedTuple):
+    """
+    A prompt sent to every compared model, with the generation options of `Llm.get_response_message`
+    and the expected answer used by the scorers.
+    """
+    id: str
+    message: str
+    system_message: str = ''
+    options: dict = None
+    expected: object = None
+    metadata: dict = None
+
+    @classmethod
+    def from_prompt(cls, case_id: str, prompt, text: str = None, expected=None, system_message: str = '', **options) -> 'EvalCase':
+        """
+        Builds a case from a `Prompt`, generated with text as its content.
+        """
+        options.setdefault('type_object', 'text')
+        return cls(case_id, prompt.generate_prompt(text), system_message, options, expected, {'text': text})
+
+    @classmethod
+    def from_nlp_to_sql(cls, case_id: str, plugin, input_data: str, expected=None, catalog=None, top_k: int = 5) -> 'EvalCase':
+        """
+        Builds a case from the input of a `NlpToSql` plugin, with its prompt and generation settings.
+        A single choice is requested, whatever the 'n' of the plugin.
+        """
+        prompt, _ = plugin._render_prompt(input_data, catalog, top_k)
+        settings = plugin.plugin_data['settings']
+        options = {'max_tokens': settings.max_tokens, 'temperature': settings.temperature, 'top_p': settings.top_p,
+                   'stop': settings.stop, 'type_object': 'text'}
+        return cls(case_id, prompt, '', options, expected, {'input': input_data, 'plugin': plugin.plugin_name})
+
+
+class CaseResult(NamedTuple):
+    """
+    Answer of a model to a case. started and finished are seconds from the start of the run that
+    called the model; cached is True when the answer comes from the result store.
+    """
+    model: str
+    case_id: str
+    repetition: int
+    text: str
+    latency: float
+    prompt_tokens: int
+    completion_tokens: int
+    error: str
+    started: float
+    finished: float
+    cached: bool = False
+    scores: dict = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.error
+
+
+class ResultStore:
+    """
+    Answers of the models, appended to a JSON lines file as they arrive. A comparison run again with
+    the same store replays the stored answers, with their recorded latency and usage, and only calls
+    the models for the missing ones, so reports (and new scorers) can be computed offline. Failed
+    requests are not stored and are sent again.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initializes the store, loading the answers of path when it exists.
+
+        Parameters:
+        ----------
+        path : str
+            JSON lines file of the answers.
+        """
+        self.path = path
+        self._records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[record.pop('key')] = record
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key: str) -> dict:
+        with self._lock:
+            return self._records.get(key)
+
+    def put(self, key: str, record: dict):
+        with self._lock:
+            self._records[key] = record
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps({'key': key, **record}, separators=(',', ':'), default=str) + '\n')
+
+
+class ModelComparison:
+    """
+    Sends the same cases to several models concurrently and reports their latency percentiles, token
+    usage, throughput, cost and quality scores, to choose the cheapest and fastest model that passes.
+
+    Attributes:
+    ----------
+    models : dict[str, Llm]
+        Compared models by name, the name identifies their answers in the store.
+    scorers : dict[str, callable]
+        Quality scores by name, each called with (case, text) and returning a number from 0 to 1 or a bool.
+    """
+
+    def __init__(self, models: dict, scorers: dict = None, concurrency: int = 4, store: ResultStore = None, timeout: float = None,
+                 prices: dict = None, threshold: float = 1.0):
+        """
+        Initializes the comparison.
+
+        Parameters:
+        ----------
+        models : dict[str, Llm]
+            Compared models by name.
+        scorers : dict[str, callable], optional
+            Quality scores by name, see `modelmorph.evaluation.scorers`.
+        concurrency : int
+            Requests in flight per model.
+        store : ResultStore, optional
+            Store of the answers, replayed instead of calling the models again.
+        timeout : float, optional
+            Seconds allowed per request, see `use_deadline`.
+        prices : dict, optional
+            Price per 1000 tokens by model name, a number or a (prompt, completion) pair.
+        threshold : float
+            Minimum of every score for an answer to pass.
+        """
+        if not models:
+            raise ValueError("At least one model is required")
+        for name, llm in models.items():
+            if not isinstance(llm, Llm):
+                raise TypeError(f"Model '{name}' is not an Llm")
+        self.models = dict(models)
+        self.scorers = dict(scorers or {})
+        self.concurrency = concurrency
+        self.store = store
+        self.timeout = timeout
+        self.prices = dict(prices or {})
+        self.threshold = threshold
+
+    def run(self, cases: list, repeat: int = 1) -> 'ComparisonReport':
+        """
+        Sends every case repeat times to every model and scores the answers.
+
+        Parameters:
+        ----------
+        cases : list of EvalCase
+            The cases, their ids must be unique.
+        repeat : int
+            Requests per case and model, more give steadier latency percentiles.
+
+        Returns:
+        -------
+        ComparisonReport:
+            The answers and their summary per model.
+        """
+        cases = list(cases)
+        if len({case.id for case in cases}) != len(cases):
+            raise ValueError("Case ids must be unique")
+        started = time.perf_counter()
+        tasks = [(name, case, repetition) for repetition in range(repeat) for case in cases for name in self.models]
+        with span('evaluation.run', models=len(self.models), cases=len(cases)):
+            # One pool per model, so a slow model does not hold the workers of the others
+            pools = {name: ThreadPoolExecutor(max_workers=max(1, self.concurrency)) for name in self.models}
+            try:
+                request = wrap(self._request)
+                futures = [pools[name].submit(request, name, case, repetition, started) for name, case, repetition in tasks]
+                answers = [future.result() for future in futures]
+            finally:
+                for pool in pools.values():
+                    pool.shutdown(wait=True, cancel_futures=True)
+        by_id = {case.id: case for case in cases}
+        results = [answer._replace(scores=self._score(by_id[answer.case_id], answer)) for answer in answers]
+        return ComparisonReport(results, list(self.models), list(self.scorers), self.prices, self.threshold)
+
+    def _request(self, name: str, case: EvalCase, repetition: int, run_started: float) -> CaseResult:
+        key = _result_key(name, case, repetition)
+        if self.store is not None:
+            record = self.store.get(key)
+            if record is not None:
+                return CaseResult(name, case.id, repetition, record['text'], record['latency'], record['prompt_tokens'],
+                                  record['completion_tokens'], '', record['started'], record['finished'], cached=True)
+        started = time.perf_counter()
+        text, usage, error = '', None, ''
+        with span('evaluation.request', model=name, case=case.id) as request_span:
+            try:
+                with use_deadline(self.timeout):
+                    response = self.models[name].get_response_message(case.message, system_message=case.system_message, **(case.options or {}))
+                request_span.record_usage(response)
+                text = response.choices[0].message.content or ''
+                usage = getattr(response, 'usage', None)
+            except Exception as e:
+                request_span.record_exception(e)
+                error = f"{type(e).__name__}: {e}"
+        finished = time.perf_counter()
+        result = CaseResult(name, case.id, repetition, text, finished - started, getattr(usage, 'prompt_tokens', 0) or 0,
+                            getattr(usage, 'completion_tokens', 0) or 0, error, started - run_started, finished - run_started)
+        if self.store is not None and not error:
+            self.store.put(key, {'model': name, 'case_id': case.id, 'repetition': repetition, 'text': text, 'latency': result.latency,
+                                 'prompt_tokens': result.prompt_tokens, 'completion_tokens': result.completion_tokens,
+                                 'started': result.started, 'finished': result.finished})
+        return result
+
+    def _score(self, case: EvalCase, result: CaseResult) -> dict:
+        if result.error:
+            return {}
+        scores = {}
+        for name, scorer in self.scorers.items():
+            try:
+                scores[name] = float(scorer(case, result.text))
+            except Exception:
+                # A scorer failing on an answer (e.g. unparsable) scores it 0
+                scores[name] = 0.0
+        return scores
+
+
+class ComparisonReport:
+    """
+    Answers of a `ModelComparison` run with their summary per model.
+    """
+
+    def __init__(self, results: list, models: list, scorers: list, prices: dict = None, threshold: float = 1.0):
+        self.results = results
+        self.models = models
+        self.scorers = scorers
+        self.prices = prices or {}
+        self.threshold = threshold
+
+    def passed(self, result: CaseResult) -> bool:
+        """
+        True when the answer has no error and reaches the threshold on every score.
+        """
+        return result.ok and all(score >= self.threshold for score in (result.scores or {}).values())
+
+    def summary(self) -> dict:
+        """
+        Returns, per model name: requests, errors, cached, latency percentiles (p50, p90, p95, p99, mean, in
+        seconds), prompt and completion tokens, throughput (requests and completion tokens per second of the
+        run), cost, the mean of every score and the pass rate.
+        """
+        summary = {}
+        for model in self.models:
+            results = [result for result in self.results if result.model == model]
+            answered = [result for result in results if result.ok]
+            latencies = sorted(result.latency for result in answered)
+            prompt_tokens = sum(result.prompt_tokens for result in answered)
+            completion_tokens = sum(result.completion_tokens for result in answered)
+            wall = (max(result.finished for result in results) - min(result.started for result in results)) if results else 0.0
+            summary[model] = {
+                'requests': len(results),
+                'errors': len(results) - len(answered),
+                'cached': sum(result.cached for result in results),
+                'latency': {
+                    'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                    'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+                    'mean': sum(latencies) / len(latencies) if latencies else None,
+                },
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'requests_per_second': len(answered) / wall if wall > 0 else None,
+                'tokens_per_second': completion_tokens / wall if wall > 0 else None,
+                'cost': self._cost(model, prompt_tokens, completion_tokens),
+                'scores': {name: _mean([result.scores[name] for result in answered if name in result.scores]) for name in self.scorers},
+                'pass_rate': sum(self.passed(result) for result in results) / len(results) if results else 0.0,
+            }
+        return summary
+
+    def best(self, min_pass_rate: float = 1.0, max_p95: float = None, by: str = 'cost') -> str:
+        """
+        Returns the name of the model with the lowest cost (by='cost') or p95 latency (by='latency')
+        among the ones passing min_pass_rate and max_p95, or None when no model does. Ties are broken
+        by the other criterion.
+        """
+        if by not in ('cost', 'latency'):
+            raise ValueError(f"Unknown criterion '{by}', expected 'cost' or 'latency'")
+        candidates = []
+        for model, stats in self.summary().items():
+            p95 = stats['latency']['p95']
+            if stats['pass_rate'] < min_pass_rate or p95 is None or (max_p95 is not None and p95 > max_p95):
+                continue
+            cost = stats['cost'] if stats['cost'] is not None else math.inf
+            candidates.append(((cost, p95) if by == 'cost' else (p95, cost), model))
+        return min(candidates)[1] if candidates else None
+
+    def format(self) -> str:
+        """
+        Returns the summary as a text table, one row per model.
+        """
+        headers = ['model', 'requests', 'errors', 'p50 s', 'p95 s', 'p99 s', 'req/s', 'tokens', 'cost', 'pass'] + self.scorers
+        rows = [headers]
+        for model, stats in self.summary().items():
+            latency = stats['latency']
+            rows.append([model, str(stats['requests']), str(stats['errors']), _number(latency['p50']), _number(latency['p95']),
+                         _number(latency['p99']), _number(stats['requests_per_second'], 2),
+                         str(stats['prompt_tokens'] + stats['completion_tokens']), _number(stats['cost'], 4),
+                         f"{stats['pass_rate']:.0%}"] + [_number(stats['scores'][name], 2) for name in self.scorers])
+        widths = [max(len(row[column]) for row in rows) for column in range(len(headers))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+    def _cost(self, model: str, prompt_tokens: int, completion_tokens: int):
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        if isinstance(price, (int, float)):
+            return (prompt_tokens + completion_tokens) * price / 1000
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1000
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Returns the q-th percentile (0 to 100) of sorted values, linearly interpolated, or None without values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _mean(values: list):
+    return sum(values) / len(values) if values else None
+
+
+def _number(value, digits: int = 3) -> str:
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+def _result_key(model: str, case: EvalCase, repetition: int) -> str:
+    request = [model, case.message, case.system_message, case.options or {}, repetition]
+    encoded = json.dumps(request, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:32]
@@ -0,0 +1,74 @@
+import json
+import re
+
+from modelmorph.chatbot.plugins.sql_validator import SqlValidator, clean_sql
+from modelmorph.db.query_cache import is_read_only
+
+# Scorers of `ModelComparison` receive the case and the text answered by a model, and return a number from 0 to 1 or a bool
+
+
+def _normalize(text) -> str:
+    return re.sub(r"\s+", " ", str(text)).strip().casefold()
+
+
+def exact_match(case, text: str) -> bool:
+    """
+    True when the answer is the expected one, ignoring case and whitespace.
+    """
+    return _normalize(text) == _normalize(case.expected)
+
+
+def contains(case, text: str) -> bool:
+    """
+    True when the answer contains the expected text, or every expected text when it is a list.
+    """
+    expected = case.expected if isinstance(case.expected, (list, tuple)) else [case.expected]
+    answer = _normalize(text)
+    return all(_normalize(item) in answer for item in expected)
+
+
+def valid_json(case, text: str) -> bool:
+    """
+    True when the answer is a JSON document.
+    """
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+
+def valid_sql(schema: dict, repository=None):
+    """
+    Returns a scorer which is True when the answer is a query valid on schema (columns by table name),
+    or on repository with its 'EXPLAIN', see `SqlValidator`. Use the `schema` of a `NlpToSql` plugin
+    to score its cases.
+    """
+    validator = SqlValidator(schema, repository)
+
+    def score(case, text: str) -> bool:
+        return not validator.validate(clean_sql(text))
+
+    return score
+
+
+def same_rows(repository):
+    """
+    Returns a scorer comparing the rows of the answered query and of the expected query on repository,
+    regardless of their order: 1 when they are the same, 0 otherwise or when the answer fails. Answers
+    that are not a single read-only query score 0 and are not run.
+    """
+    def rows(sql: str):
+        sql = clean_sql(sql)
+        if not is_read_only(sql):
+            return None
+        answer = repository.execute_query(sql)
+        if answer.error:
+            return None
+        return sorted(json.dumps(list(row.values()) if isinstance(row, dict) else list(row), default=str) for row in answer.data)
+
+    def score(case, text: str) -> bool:
+        answered = rows(text)
+        return answered is not None and answered == rows(case.expected)
+
+    return score
@@ -0,0 +1,3 @@
+from .batch import BatchRunner
+from .cache import TTLCache
+from .pipeline import Pipeline, PipelineError, Step
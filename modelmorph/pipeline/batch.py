@@ -0,0 +1,314 @@
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from modelmorph.deadline import sleep
+from modelmorph.tracing import span, wrap
+
+_PLACEHOLDER = re.compile(r"\{\{\$(\w+)\}\}")
+
+
+class BatchRunner:
+    """
+    Generates a completion per row of a pandas DataFrame, for offline enrichment jobs that must
+    survive crashes and rate limiting.
+
+    Prompts are rendered a chunk at a time with vectorized string operations: the '{{$column}}'
+    placeholders of the template are replaced by the values of the row. The rows of a chunk are sent
+    with bounded concurrency; rate limited (429) requests pause every worker and are retried with
+    exponential backoff. Once done, the chunk is appended to the output file, which is also the
+    checkpoint: a run started again skips the rows already in the output.
+
+    The output is a JSON lines file, or with a '.parquet' path a directory of Parquet part files
+    (one per chunk, requires pyarrow). Its rows have the key of the input row, the 'completion', the
+    'error' of the rows that failed after max_retries, and the keep_columns of the input.
+
+    Attributes:
+    ----------
+    assistant : CompletionAssistant
+        Assistant generating the completions, with its `generate_completion`.
+    output : str
+        Output file, or directory for Parquet.
+    """
+
+    def __init__(self, assistant, template, output: str, text: str = '', columns: dict = None, key: str = None, keep_columns: list = None,
+                 chunk_size: int = 100, concurrency: int = 4, max_retries: int = 5, backoff: float = 1.0, timeout: float = None,
+                 **completion_kwargs):
+        """
+        Initializes the runner.
+
+        Parameters:
+        ----------
+        assistant : CompletionAssistant
+            Assistant generating the completions.
+        template : str, Prompt or Plugin
+            Prompt with '{{$column}}' placeholders: a string, a `Prompt` (generated once with its
+            '{{$...}}' placeholders in place, or per row when it has a retriever or compacts), or a
+            plugin with a 'prompt_template', like `NlpToSql`.
+        output : str
+            JSON lines file, or directory of Parquet files when it ends with '.parquet'.
+        text : str
+            Content given to `Prompt.generate_prompt`, with '{{$column}}' placeholders.
+        columns : dict, optional
+            Column of each placeholder when they differ, e.g. {'input': 'review'} for '{{$input}}'.
+        key : str, optional
+            Column identifying the rows, defaults to the index. Keys must be unique.
+        keep_columns : list of str, optional
+            Input columns copied to the output.
+        chunk_size : int
+            Rows rendered, generated and written together.
+        concurrency : int
+            Requests in flight.
+        max_retries : int
+            Retries of a failing request before its error is written.
+        backoff : float
+            Seconds before the first retry, doubled on each one.
+        timeout : float, optional
+            Seconds allowed per request.
+        completion_kwargs :
+            Arguments of `generate_completion` (response_type, max_tokens, temp...).
+        """
+        self.assistant = assistant
+        self.template = template
+        self.output = output
+        self.text = text
+        self.columns = dict(columns or {})
+        self.key = key
+        self.keep_columns = list(keep_columns or [])
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.completion_kwargs = completion_kwargs
+        self.parquet = output.endswith('.parquet')
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def run(self, frame) -> dict:
+        """
+        Generates the completions of the rows of frame missing in the output.
+
+        Parameters:
+        ----------
+        frame : pandas.DataFrame
+            Input rows, with a column for every placeholder of the template.
+
+        Returns:
+        -------
+        dict:
+            Number of rows in frame ('rows'), already in the output ('skipped'), generated ('completed')
+            and failed ('failed').
+        """
+        keys = frame[self.key] if self.key else frame.index.to_series(index=frame.index)
+        if not keys.is_unique:
+            raise ValueError(f"The {'column ' + repr(self.key) if self.key else 'index'} does not identify the rows, it has duplicates")
+        if not self.parquet:
+            _drop_partial_line(self.output)
+        done = self.completed_keys()
+        pending = frame[~keys.map(_key).isin(done)]
+        stats = {'rows': len(frame), 'skipped': len(frame) - len(pending), 'completed': 0, 'failed': 0}
+
+        with span('batch.run', rows=len(frame), pending=len(pending)), ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            generate = wrap(self._generate)
+            for start in range(0, len(pending), self.chunk_size):
+                chunk = pending.iloc[start:start + self.chunk_size]
+                with span('batch.chunk', start=start, rows=len(chunk)):
+                    prompts = self.render(chunk)
+                    results = list(pool.map(generate, prompts))
+                    self._write(chunk, results)
+                failed = sum(1 for _, error in results if error)
+                stats['failed'] += failed
+                stats['completed'] += len(results) - failed
+        return stats
+
+    def render(self, chunk) -> list:
+        """
+        Returns the prompts of the rows of a DataFrame chunk.
+        """
+        if self._per_row():
+            return [self.template.generate_prompt(self._fill(self.text, row)) for _, row in chunk.iterrows()]
+        template = self._template()
+        # Concatenating whole columns is much faster than formatting the rows one by one
+        pieces = _PLACEHOLDER.split(template)
+        rendered = pieces[0]
+        for position in range(1, len(pieces), 2):
+            rendered = rendered + chunk[self.columns.get(pieces[position], pieces[position])].astype(str) + pieces[position + 1]
+        if isinstance(rendered, str):
+            return [rendered] * len(chunk)
+        return rendered.tolist()
+
+    def completed_keys(self) -> set:
+        """
+        Returns the keys of the rows in the output without error.
+        """
+        done = set()
+        for record in self._records():
+            if record.get('error'):
+                done.discard(_key(record['key']))
+            else:
+                done.add(_key(record['key']))
+        return done
+
+    def read_output(self):
+        """
+        Returns the output as a DataFrame indexed by key, with the last result of every row.
+        """
+        import pandas as pd
+
+        if self.parquet:
+            parts = sorted(glob.glob(os.path.join(self.output, 'part-*.parquet')))
+            frame = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True) if parts else pd.DataFrame(columns=['key'])
+        else:
+            frame = pd.DataFrame(list(self._records()), columns=None)
+            if frame.empty:
+                frame = pd.DataFrame(columns=['key'])
+        return frame.drop_duplicates('key', keep='last').set_index('key')
+
+    def _per_row(self) -> bool:
+        return hasattr(self.template, 'generate_prompt') and (getattr(self.template, 'retriever', None) is not None or getattr(self.template, 'auto_compact', False))
+
+    def _template(self) -> str:
+        if isinstance(self.template, str):
+            return self.template
+        if hasattr(self.template, 'generate_prompt'):
+            return self.template.generate_prompt(self.text)
+        if hasattr(self.template, 'prompt_template'):
+            # Default tables of an NlpToSql plugin, unless a column gives them
+            if 'schema' in self.columns:
+                return self.template.prompt_template
+            return self.template.prompt_template.replace('{{$schema}}', getattr(self.template, 'schema_text', ''))
+        raise TypeError(f"Unsupported template {type(self.template).__name__}, expected a str, a Prompt or a plugin")
+
+    def _fill(self, text: str, row) -> str:
+        return _PLACEHOLDER.sub(lambda match: str(row[self.columns.get(match.group(1), match.group(1))]), text)
+
+    def _generate(self, prompt: str):
+        error = ''
+        for attempt in range(self.max_retries + 1):
+            self._wait_pause()
+            try:
+                return self.assistant.generate_completion(prompt, deadline=self.timeout, **self.completion_kwargs), ''
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if attempt == self.max_retries:
+                    break
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+                if _rate_limited(e):
+                    # Every worker waits, sending more requests would only extend the rate limiting
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + max(delay, _retry_after(e)))
+                else:
+                    sleep(delay)
+        return None, error
+
+    def _wait_pause(self):
+        while True:
+            with self._lock:
+                delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            sleep(delay)
+
+    def _write(self, chunk, results: list):
+        keys = chunk[self.key] if self.key else chunk.index
+        records = []
+        for position, (key, (completion, error)) in enumerate(zip(keys, results)):
+            record = {'key': _plain(key), 'completion': completion, 'error': error or None}
+            for column in self.keep_columns:
+                record[column] = _plain(chunk[column].iloc[position])
+            records.append(record)
+        if self.parquet:
+            self._write_parquet(records)
+        else:
+            self._write_jsonl(records)
+
+    def _write_jsonl(self, records: list):
+        directory = os.path.dirname(os.path.abspath(self.output))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.output, 'a', encoding='utf-8') as file:
+            file.write(''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _write_parquet(self, records: list):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow, install it or use a JSON lines output") from e
+        os.makedirs(self.output, exist_ok=True)
+        part = len(glob.glob(os.path.join(self.output, 'part-*.parquet')))
+        path = os.path.join(self.output, f'part-{part:05d}.parquet')
+        # Written aside and renamed, a crash never leaves a partial part file
+        pq.write_table(pa.Table.from_pylist(records), path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _records(self):
+        if self.parquet:
+            if not os.path.isdir(self.output):
+                return
+            import pyarrow.parquet as pq
+            for part in sorted(glob.glob(os.path.join(self.output, 'part-*.parquet'))):
+                yield from pq.read_table(part, columns=['key', 'error']).to_pylist()
+            return
+        if not os.path.exists(self.output):
+            return
+        with open(self.output, 'rb') as file:
+            for line in file:
+                if line.endswith(b'\n'):
+                    yield json.loads(line)
+
+
+def _drop_partial_line(path: str):
+    # The last line of a run that crashed while writing is removed, so the next chunk starts on a new line
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        file.seek(size - 1)
+        if file.read(1) == b'\n':
+            return
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            file.seek(start)
+            block = file.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                file.truncate(start + newline + 1)
+                return
+            end = start
+        file.truncate(0)
+
+
+def _key(value) -> str:
+    return json.dumps(_plain(value), default=str)
+
+
+def _plain(value):
+    # numpy scalars and timestamps of the DataFrame
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _rate_limited(error: Exception) -> bool:
+    return getattr(error, 'status_code', None) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def _retry_after(error: Exception) -> float:
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after', 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries expire after a time to live.
+
+    Attributes:
+    ----------
+    ttl : float
+        Seconds an entry stays valid after being stored.
+    max_entries : int
+        Maximum number of entries, the least recently used one is evicted first.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 1024):
+        """
+        Initializes an empty cache.
+
+        Parameters:
+        ----------
+        ttl : float
+            Default time to live of the entries in seconds.
+        max_entries : int
+            Maximum number of entries kept in memory.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, or default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is self._MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Stores value for key, evicting the least recently used entries when the cache is full.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,338 @@
+import hashlib
+import itertools
+import json
+import threading
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Union
+
+from modelmorph.tracing import wrap
+
+from .cache import TTLCache
+
+_MISSING = object()
+
+# Attributes naming the backend of a repository, model, assistant or plugin in the cache keys
+_IDENTITY_ATTRIBUTES = ('connection_string', 'endpoint', 'deployment_id', 'model_name', 'plugin_directory', 'llm')
+# Values identified by their repr
+_PLAIN_TYPES = (str, int, float, bool, bytes, tuple, frozenset, list, dict, set, type(None))
+
+# Token of the objects without a stable identity, never reused unlike id()
+_instance_tokens = weakref.WeakKeyDictionary()
+_instance_tokens_lock = threading.Lock()
+_next_token = itertools.count()
+
+
+def _instance_key(obj, depth: int = 0) -> str:
+    """
+    Returns a key identifying obj in the cache keys of the steps. It is stable between instances
+    configured alike, so pipelines built per request share their results, and differs between backends:
+
+    - repositories, models, assistants and plugins: their class with their connection string,
+      endpoint, deployment, model name, plugin directory or model (see `_IDENTITY_ATTRIBUTES`),
+    - functions: their qualified name and code, with the keys of the variables they close over,
+    - bound methods: the key of their function and of their instance,
+    - plain values: their repr.
+
+    Other objects get a token of the instance, unique in the process.
+
+    Raises:
+    ------
+    TypeError:
+        If obj has no stable identity and can not be weakly referenced, give the step a key instead.
+    """
+    if isinstance(obj, _PLAIN_TYPES):
+        return repr(obj)
+    if hasattr(obj, '__self__') and hasattr(obj, '__func__'):
+        return f"{_instance_key(obj.__func__, depth)}@{_instance_key(obj.__self__, depth)}"
+    name = getattr(obj, '__qualname__', None) or type(obj).__qualname__
+    module = getattr(obj, '__module__', None) or type(obj).__module__
+    code = getattr(obj, '__code__', None)
+    if code is not None and depth < 3:
+        digest = hashlib.sha256(code.co_code + repr((code.co_consts, code.co_names)).encode()).hexdigest()[:16]
+        closure = [_cell_key(cell, depth + 1) for cell in getattr(obj, '__closure__', None) or ()]
+        return f"{module}.{name}:{digest}({','.join(closure)})"
+    identity = [f"{attribute}={_instance_key(value, depth + 1) if depth < 3 else repr(value)}"
+                for attribute in _IDENTITY_ATTRIBUTES if (value := getattr(obj, attribute, None))]
+    if identity and not isinstance(obj, type):
+        return f"{module}.{name}[{','.join(identity)}]"
+    try:
+        with _instance_tokens_lock:
+            token = _instance_tokens.get(obj)
+            if token is None:
+                token = _instance_tokens[obj] = next(_next_token)
+    except TypeError:
+        raise TypeError(f"{module}.{name} has no stable identity for the cache keys, give the step a key") from None
+    return f"{module}.{name}#{token}"
+
+
+def _cell_key(cell, depth: int) -> str:
+    try:
+        return _instance_key(cell.cell_contents, depth)
+    except ValueError:
+        # Variable not assigned yet
+        return '-'
+
+
+class PipelineError(Exception):
+    """
+    Raised when the pipeline graph is invalid or one of its steps fails.
+
+    Attributes:
+    ----------
+    step : str
+        Name of the failing step, empty for graph errors.
+    """
+
+    def __init__(self, message: str, step: str = ''):
+        super().__init__(message)
+        self.step = step
+
+
+@dataclass
+class Step:
+    """
+    A node of a pipeline.
+
+    Attributes:
+    ----------
+    name : str
+        Unique name of the step, other steps use it as input.
+    func : Callable
+        Function called with the values of the inputs, in order.
+    inputs : list[str]
+        Names of the pipeline inputs or steps feeding this step.
+    cache : bool
+        Whether the result is memoized by the hash of its inputs.
+    ttl : float, optional
+        Time to live of the memoized results, defaults to the cache ttl.
+    key : str or Callable
+        Identifies the step implementation in the cache keys, a callable is evaluated on every run.
+    """
+    name: str
+    func: Callable
+    inputs: list[str] = field(default_factory=list)
+    cache: bool = True
+    ttl: Optional[float] = None
+    key: Union[str, Callable[[], str]] = ''
+
+
+class Pipeline:
+    """
+    Runs plugin, query and completion steps declared as a directed acyclic graph. Steps whose
+    inputs are ready run concurrently, and their results are memoized by input hash so repeated
+    runs reuse the upstream SQL and data.
+
+    Attributes:
+    ----------
+    steps : dict[str, Step]
+        Steps of the pipeline by name.
+    cache : TTLCache
+        Memoized step results, can be shared between pipelines.
+    stats : dict
+        Number of cache 'hits' and 'misses' since the pipeline was created.
+    """
+
+    def __init__(self, max_workers: int = 4, cache: TTLCache = None, cache_ttl: float = 300.0):
+        """
+        Initializes an empty pipeline.
+
+        Parameters:
+        ----------
+        max_workers : int
+            Maximum number of steps running at the same time.
+        cache : TTLCache, optional
+            Cache for the step results, a new one is created if not provided.
+        cache_ttl : float
+            Time to live in seconds of the results when a new cache is created.
+        """
+        self.steps = {}
+        self.cache = cache if cache is not None else TTLCache(ttl=cache_ttl)
+        self.stats = {'hits': 0, 'misses': 0}
+        self._stats_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='modelmorph-pipeline')
+
+    def add_step(self, name: str, func: Callable, inputs=(), cache: bool = True, ttl: float = None, key=None) -> 'Pipeline':
+        """
+        Adds a step calling func with the values of its inputs.
+
+        Parameters:
+        ----------
+        name : str
+            Unique name of the step.
+        func : Callable
+            Function receiving one positional argument per input.
+        inputs : iterable of str
+            Names of pipeline inputs or other steps.
+        cache : bool
+            Whether to memoize the result.
+        ttl : float, optional
+            Time to live of the memoized result.
+        key : str or Callable, optional
+            Identifies the implementation in the cache keys, defaults to the qualified name and code of func
+            with the variables it closes over: two lambdas of a scope doing different things, or using
+            different repositories, do not share results.
+
+        Returns:
+        -------
+        Pipeline:
+            The pipeline itself, to chain calls.
+
+        Raises:
+        ------
+        ValueError:
+            If a step with the same name already exists.
+        """
+        if name in self.steps:
+            raise ValueError(f"Step '{name}' already exists.")
+        key = key or _instance_key(func)
+        self.steps[name] = Step(name=name, func=func, inputs=list(inputs), cache=cache, ttl=ttl, key=key)
+        return self
+
+    def add_plugin_step(self, name: str, plugin, plugin_name: str, input: str, key=None, **kwargs) -> 'Pipeline':
+        """
+        Adds a step running a plugin (see `Plugin.run`) on the value of input. Results are memoized per
+        plugin directory and model, or per key when given.
+        """
+        def plugin_key():
+            return f"plugin:{_instance_key(plugin)}:{plugin_name}"
+
+        return self.add_step(name, lambda value: plugin.run(plugin_name, value), [input], key=key or plugin_key, **kwargs)
+
+    def add_query_step(self, name: str, repository, query: str, key=None, **kwargs) -> 'Pipeline':
+        """
+        Adds a step executing the SQL produced by the query step with `DBRepository.execute_query`.
+        The step fails, and its result is not memoized, when the query returns an error. Results are
+        memoized per repository class and connection string (or per key when given), not shared
+        between databases.
+        """
+        def execute(sql):
+            answer = repository.execute_query(sql)
+            if answer.error:
+                raise ValueError(f"Query failed: {answer.error}")
+            return answer.data
+
+        return self.add_step(name, execute, [query], key=key or f"query:{_instance_key(repository)}", **kwargs)
+
+    def add_completion_step(self, name: str, assistant, prompt, inputs, key=None, **kwargs) -> 'Pipeline':
+        """
+        Adds a step calling `CompletionAssistant.generate_completion`. A str prompt is a template
+        whose {{input}} placeholders are replaced by the input values; with a Prompt instance the
+        input values are passed as the prompt content. Results are memoized per deployment, model and prompt,
+        or per key and prompt when a key is given.
+        """
+        inputs = list(inputs)
+
+        def render(*values):
+            named = dict(zip(inputs, values))
+            if isinstance(prompt, str):
+                text = prompt
+                for input_name, value in named.items():
+                    text = text.replace(f"{{{{{input_name}}}}}", str(value))
+                return text
+            return prompt.generate_prompt("\n".join(f"{input_name}: {value}" for input_name, value in named.items()))
+
+        def complete(*values):
+            return assistant.generate_completion(render(*values))
+
+        def completion_key():
+            # The model of the assistant can be replaced between two runs
+            model = key or _instance_key(assistant)
+            return f"completion:{model}:{prompt if isinstance(prompt, str) else prompt.generate_prompt()}"
+
+        return self.add_step(name, complete, inputs, key=completion_key, **kwargs)
+
+    def run(self, **inputs) -> dict:
+        """
+        Runs every step once its inputs are available, independent branches concurrently.
+
+        Parameters:
+        ----------
+        **inputs :
+            Values of the pipeline inputs.
+
+        Returns:
+        -------
+        dict:
+            Result of every step by name.
+
+        Raises:
+        ------
+        PipelineError:
+            If an input is missing, the graph has a cycle or a step fails.
+        """
+        self._validate(inputs)
+        results = dict(inputs)
+        waiting = {name: set(step.inputs) - set(inputs) for name, step in self.steps.items()}
+        running = {}
+
+        def submit_ready():
+            for name in [name for name, deps in waiting.items() if not deps]:
+                del waiting[name]
+                step = self.steps[name]
+                values = [results[input_name] for input_name in step.inputs]
+                running[self._pool.submit(wrap(self._run_step), step, values)] = name
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    for pending in running:
+                        pending.cancel()
+                    raise PipelineError(f"Step '{name}' failed: {e}", step=name) from e
+                for deps in waiting.values():
+                    deps.discard(name)
+            submit_ready()
+
+        return {name: results[name] for name in self.steps}
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the worker threads of the pipeline.
+        """
+        self._pool.shutdown(wait=wait)
+
+    def _validate(self, inputs: dict):
+        known = set(inputs) | set(self.steps)
+        for step in self.steps.values():
+            missing = [name for name in step.inputs if name not in known]
+            if missing:
+                raise PipelineError(f"Step '{step.name}' depends on unknown inputs {missing}.", step=step.name)
+
+        # Kahn's algorithm: every step must be reachable from the pipeline inputs
+        waiting = {name: set(step.inputs) - set(inputs) for name, step in self.steps.items()}
+        ready = [name for name, deps in waiting.items() if not deps]
+        while ready:
+            done = ready.pop()
+            del waiting[done]
+            for name, deps in waiting.items():
+                if done in deps:
+                    deps.discard(done)
+                    if not deps:
+                        ready.append(name)
+        if waiting:
+            raise PipelineError(f"Pipeline has a cycle between steps {sorted(waiting)}.")
+
+    def _run_step(self, step: Step, values: list):
+        if not step.cache:
+            return step.func(*values)
+
+        key = self._cache_key(step, values)
+        value = self.cache.get(key, _MISSING)
+        with self._stats_lock:
+            self.stats['hits' if value is not _MISSING else 'misses'] += 1
+        if value is _MISSING:
+            value = step.func(*values)
+            self.cache.set(key, value, ttl=step.ttl)
+        return value
+
+    @staticmethod
+    def _cache_key(step: Step, values: list) -> str:
+        implementation = step.key() if callable(step.key) else step.key
+        payload = json.dumps([implementation, values], sort_keys=True, default=str)
+        return f"{step.name}:{hashlib.sha256(payload.encode()).hexdigest()}"
@@ -0,0 +1,11 @@
+from modelmorph._lazy import attach
+
+# numpy is only imported when the index is first used
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['retriever', 'vector_index'],
+    attributes={
+        'retriever': ['Retriever'],
+        'vector_index': ['VectorIndex'],
+    },
+)
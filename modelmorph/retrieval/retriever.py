@@ -0,0 +1,72 @@
+from modelmorph.chatbot.domain import Llm
+from modelmorph.tracing import span
+from .vector_index import VectorIndex
+
+
+class Retriever:
+    """
+    Finds the documents of a VectorIndex relevant to a text, with the embeddings of an Llm.
+    Pass it to `Prompt(retriever=...)` to add the documents to the prompt content.
+    """
+
+    def __init__(self, llm: Llm, index: VectorIndex, k: int = 3, min_score: float = 0.0, batch_size: int = 64):
+        """
+        Initializes the retriever.
+
+        Parameters:
+        ----------
+        llm : Llm
+            Model computing the embeddings, see `Llm.get_embeddings`.
+        index : VectorIndex
+            Index with the documents.
+        k : int
+            Number of documents returned by default.
+        min_score : float
+            Minimum cosine similarity of the documents returned.
+        batch_size : int
+            Texts per embeddings request when documents are added.
+        """
+        self.llm = llm
+        self.index = index
+        self.k = k
+        self.min_score = min_score
+        self.batch_size = batch_size
+
+    def add(self, texts: list[str], metadata: list[dict] = None) -> int:
+        """
+        Embeds texts and appends them to the index.
+
+        Parameters:
+        ----------
+        texts : list of str
+            Documents to add.
+        metadata : list of dict, optional
+            Extra fields stored with each document.
+
+        Returns:
+        -------
+        int:
+            Number of documents in the index.
+        """
+        vectors = self.llm.get_embeddings(texts, batch_size=self.batch_size)
+        documents = [{'text': text, **(extra or {})} for text, extra in zip(texts, metadata or [None] * len(texts))]
+        return self.index.append(vectors, documents)
+
+    def search(self, text: str, k: int = None) -> list[tuple[float, dict]]:
+        """
+        Returns the (score, document) pairs most similar to text, by decreasing score.
+        """
+        with span('retrieval.search') as search_span:
+            vector = self.llm.get_embeddings([text])[0]
+            results = [result for result in self.index.search(vector, k or self.k) if result[0] >= self.min_score]
+            search_span.set_attribute('retrieval.documents', len(results))
+        return results
+
+    def augment(self, text: str, k: int = None) -> str:
+        """
+        Returns text followed by the relevant documents, or text alone when none is found.
+        """
+        results = self.search(text, k)
+        if not results:
+            return text
+        return text + "\nRelevant documents:\n" + "\n".join(f"- {document['text']}" for _, document in results)
@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Rows scored per matrix product, bounds the memory used by a search
+SEARCH_BLOCK_ROWS = 65536
+
+
+class VectorIndex:
+    """
+    Local vector index stored in a directory: the vectors in a raw float32 (or int8) matrix file read
+    through a memory map, and the documents in a JSON lines file. Vectors are normalized when added,
+    so the score of a search is the cosine similarity.
+
+    With quantize=True every vector is stored as int8 with one float32 scale per row, a quarter of the
+    float32 size, at the cost of a small error in the scores.
+
+    Vectors are appended incrementally; the number of rows in 'index.json' is updated last, so an
+    interrupted append leaves the index in its previous state. Appends hold a lock on the 'index.lock'
+    file and start from the rows in 'index.json', so several processes can append to the same index.
+    """
+
+    def __init__(self, directory: str, dim: int = None, quantize: bool = False):
+        """
+        Opens or creates the index.
+
+        Parameters:
+        ----------
+        directory : str
+            Directory of the index files, created if missing.
+        dim : int, optional
+            Size of the vectors, taken from the first append when not given.
+        quantize : bool
+            Store the vectors as int8, only used when the index is created.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._meta_path = os.path.join(directory, 'index.json')
+        self._vectors_path = os.path.join(directory, 'vectors.bin')
+        self._scales_path = os.path.join(directory, 'scales.bin')
+        self._lock_path = os.path.join(directory, 'index.lock')
+        self._documents_path = os.path.join(directory, 'documents.jsonl')
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._scales = None
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as file:
+                meta = json.load(file)
+            if dim is not None and meta['dim'] is not None and dim != meta['dim']:
+                raise ValueError(f"The index in {directory} has vectors of size {meta['dim']}, not {dim}")
+            self.dim = meta['dim']
+            self.quantize = meta['quantize']
+            self.count = meta['count']
+            self._documents_size = meta['documents_size']
+        else:
+            self.dim = dim
+            self.quantize = quantize
+            self.count = 0
+            self._documents_size = 0
+
+        self.documents = []
+        if self.count:
+            with open(self._documents_path, 'rb') as file:
+                self.documents = [json.loads(line) for line in file.read(self._documents_size).splitlines()]
+
+    def __len__(self):
+        return self.count
+
+    def append(self, vectors, documents: list) -> int:
+        """
+        Adds vectors and their documents to the index.
+
+        Parameters:
+        ----------
+        vectors : array-like of shape (n, dim)
+            Vectors to add.
+        documents : list of str or dict
+            One document per vector; a str is stored as {'text': str}.
+
+        Returns:
+        -------
+        int:
+            Number of vectors in the index.
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(documents):
+            raise ValueError("Expected one vector per document in a 2D array")
+        if len(matrix) == 0:
+            return self.count
+        documents = [document if isinstance(document, dict) else {'text': document} for document in documents]
+
+        with self._lock, _file_lock(self._lock_path):
+            # Rows committed by other processes are kept, only an interrupted append is dropped
+            self._reload()
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Expected vectors of size {self.dim}, not {matrix.shape[1]}")
+            matrix = _normalize(matrix)
+
+            # Drop what an interrupted append may have left after the last complete row
+            self._truncate_files()
+            if self.quantize:
+                scales = np.abs(matrix).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+                with open(self._vectors_path, 'ab') as file:
+                    file.write(quantized.tobytes())
+                with open(self._scales_path, 'ab') as file:
+                    file.write(scales.astype(np.float32).tobytes())
+            else:
+                with open(self._vectors_path, 'ab') as file:
+                    file.write(matrix.tobytes())
+            lines = ''.join(json.dumps(document, ensure_ascii=False) + '\n' for document in documents).encode()
+            with open(self._documents_path, 'ab') as file:
+                file.write(lines)
+            self._documents_size += len(lines)
+
+            self.count += len(matrix)
+            self.documents.extend(documents)
+            self._write_meta()
+            self._matrix = None
+            self._scales = None
+            return self.count
+
+    def search(self, query, k: int = 5) -> list:
+        """
+        Finds the documents closest to one or several query vectors.
+
+        Parameters:
+        ----------
+        query : array-like of shape (dim,) or (m, dim)
+            Query vector, or one query per row.
+        k : int
+            Number of documents returned per query.
+
+        Returns:
+        -------
+        list:
+            (score, document) tuples by decreasing score, or one such list per query row.
+        """
+        queries = np.asarray(query, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = _normalize(np.atleast_2d(queries))
+        with self._lock:
+            matrix, scales = self._map()
+            documents = self.documents
+        if matrix is None or k <= 0:
+            return [] if single else [[] for _ in queries]
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Expected query vectors of size {self.dim}, not {queries.shape[1]}")
+
+        k = min(k, len(matrix))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            block = matrix[start:start + SEARCH_BLOCK_ROWS]
+            if scales is None:
+                scores = queries @ block.T
+            else:
+                scores = (queries @ block.T.astype(np.float32)) * scales[start:start + SEARCH_BLOCK_ROWS]
+            # Keep the k best of this block with the k best so far
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.argsort(-scores, axis=1)
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        results = []
+        for query_scores, query_rows, query_order in zip(best_scores, best_rows, order):
+            results.append([(float(query_scores[i]), documents[query_rows[i]]) for i in query_order])
+        return results[0] if single else results
+
+    def _map(self):
+        if self._matrix is None and self.count:
+            dtype = np.int8 if self.quantize else np.float32
+            self._matrix = np.memmap(self._vectors_path, dtype=dtype, mode='r', shape=(self.count, self.dim))
+            if self.quantize:
+                self._scales = np.memmap(self._scales_path, dtype=np.float32, mode='r', shape=(self.count,))
+        return self._matrix, self._scales
+
+    def _reload(self):
+        """
+        Reads 'index.json' again, with the documents appended since by other processes.
+        """
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path) as file:
+            meta = json.load(file)
+        if meta['count'] <= self.count:
+            return
+        with open(self._documents_path, 'rb') as file:
+            file.seek(self._documents_size)
+            lines = file.read(meta['documents_size'] - self._documents_size)
+        self.documents = self.documents + [json.loads(line) for line in lines.splitlines()]
+        self.dim = meta['dim']
+        self.quantize = meta['quantize']
+        self.count = meta['count']
+        self._documents_size = meta['documents_size']
+        self._matrix = None
+        self._scales = None
+
+    def _truncate_files(self):
+        row_size = self.dim * (1 if self.quantize else 4)
+        sizes = ((self._vectors_path, self.count * row_size), (self._scales_path, self.count * 4 if self.quantize else 0), (self._documents_path, self._documents_size))
+        for path, size in sizes:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as file:
+                    file.truncate(size)
+
+    def _write_meta(self):
+        temporary = f'{self._meta_path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump({'dim': self.dim, 'quantize': self.quantize, 'count': self.count, 'documents_size': self._documents_size}, file)
+        os.replace(temporary, self._meta_path)
+
+
+@contextmanager
+def _file_lock(path: str):
+    """
+    Holds an exclusive lock on the file at path, waiting for the other processes holding it.
+    """
+    with open(path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
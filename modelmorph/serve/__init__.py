@@ -0,0 +1,2 @@
+from .config import ServerConfig
+from .server import Server
@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+from .config import ServerConfig
+from .server import Server
+
+
+def main():
+    defaults = ServerConfig()
+    parser = argparse.ArgumentParser(prog='python -m modelmorph.serve', description='Serve the modelmorph chat, completion and plugin endpoints.')
+    parser.add_argument('--host', default=defaults.host)
+    parser.add_argument('--port', type=int, default=defaults.port)
+    parser.add_argument('--workers', type=int, default=defaults.workers, help='Number of worker processes.')
+    parser.add_argument('--max-queue', type=int, default=defaults.max_queue, help='Requests in flight per worker before shedding load with 503.')
+    parser.add_argument('--max-concurrency', type=int, default=defaults.max_concurrency, help='Backend calls running at once in each worker.')
+    parser.add_argument('--max-sessions', type=int, default=defaults.max_sessions, help='Chats kept in memory by each worker.')
+    parser.add_argument('--session-idle', type=float, default=defaults.session_idle, help='Seconds before the messages of an idle chat are spilled to disk.')
+    parser.add_argument('--spill-dir', default=defaults.spill_dir, help='Directory of the session spill files.')
+    parser.add_argument('--history-window', type=int, default=defaults.history_window, help='Previous messages of a chat loaded and sent to the model, 0 for all.')
+    parser.add_argument('--request-timeout', type=float, default=defaults.request_timeout, help='Seconds before a request is abandoned with a 504, 0 for no limit.')
+    parser.add_argument('--config', dest='config_path', default=defaults.config_path, help='Configuration file of the assistants.')
+    parser.add_argument('--plugin-dir', default=defaults.plugin_dir, help='Directory of the plugins served by /plugin.')
+    parser.add_argument('--mock', action='store_true', help='Use the local mock model and in-memory chat storage (load tests).')
+    parser.add_argument('--mock-latency', type=float, default=defaults.mock_latency, help='Latency of the mock model in seconds.')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(Server(ServerConfig(**vars(args))).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ServerConfig:
+    """
+    Settings of the serving layer, see `python -m modelmorph.serve --help`.
+
+    Attributes:
+        host (str): Interface the HTTP server listens on.
+        port (int): Port of the HTTP server, 0 picks a free one.
+        workers (int): Number of worker processes running the assistants.
+        max_queue (int): Requests accepted per worker (running and waiting) before new ones are shed with a 503.
+        max_concurrency (int): Backend calls running at the same time in each worker.
+        max_sessions (int): Chats kept in memory by each worker, the least recently used are saved and dropped.
+        session_idle (float): Seconds without use after which the messages of a chat are spilled to disk.
+        spill_dir (str): Directory of the spill files of the workers, defaults to the temp directory.
+        history_window (int): Previous messages of a chat loaded and sent to the model, 0 for all of them.
+        request_timeout (float): Seconds before a request is abandoned with a 504, 0 for no limit. Clients may
+            ask for a shorter one with a "timeout" field.
+        max_body (int): Maximum size in bytes of a request body.
+        config_path (str): Configuration file of the assistants.
+        plugin_dir (str): Directory with the plugins served by the '/plugin' endpoint.
+        mock (bool): Use `MockLlm` and `InMemoryDBRepository` instead of Azure OpenAI and MongoDB.
+        mock_latency (float): Simulated latency of the mock model in seconds.
+    """
+    host: str = '127.0.0.1'
+    port: int = 8000
+    workers: int = 2
+    max_queue: int = 64
+    max_concurrency: int = 8
+    max_sessions: int = 10000
+    session_idle: float = 300.0
+    spill_dir: str = ''
+    history_window: int = 0
+    request_timeout: float = 0.0
+    max_body: int = 1024 * 1024
+    config_path: str = ''
+    plugin_dir: str = ''
+    mock: bool = False
+    mock_latency: float = 0.05
@@ -0,0 +1,111 @@
+import asyncio
+import json
+from typing import NamedTuple, Optional
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class HttpError(Exception):
+    """
+    Error answered to the client with the given HTTP status.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpRequest(NamedTuple):
+    method: str
+    path: str
+    headers: dict
+    body: bytes
+
+    @property
+    def keep_alive(self) -> bool:
+        return self.headers.get('connection', '').lower() != 'close'
+
+    def json(self) -> dict:
+        try:
+            payload = json.loads(self.body or b'{}')
+        except ValueError:
+            raise HttpError(400, 'Body must be valid JSON')
+        if not isinstance(payload, dict):
+            raise HttpError(400, 'Body must be a JSON object')
+        return payload
+
+
+async def read_request(reader: asyncio.StreamReader, max_body: int) -> Optional[HttpRequest]:
+    """
+    Reads one HTTP/1.1 request from the stream.
+
+    Input:
+        - reader (StreamReader): Stream of the client connection.
+        - max_body (int): Maximum size of the body in bytes.
+
+    Output:
+        - Returns the HttpRequest, or None when the client closed the connection.
+
+    Raises:
+        HttpError: If the request is malformed or the body is too large.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, 'Headers too large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise HttpError(400, 'Malformed request line')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    length = headers.get('content-length', '') or '0'
+    if not length.isascii() or not length.isdigit():
+        raise HttpError(400, 'Invalid Content-Length')
+    length = int(length)
+    if length > max_body:
+        raise HttpError(413, f'Body larger than {max_body} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return HttpRequest(method.upper(), target.split('?', 1)[0], headers, body)
+
+
+def json_response(status: int, payload: dict, keep_alive: bool = True, headers: dict = None) -> bytes:
+    """
+    Serializes a complete JSON response.
+    """
+    body = json.dumps(payload).encode()
+    extra = ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+    return (
+        f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+        f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n{extra}\r\n'
+    ).encode() + body
+
+
+def sse_headers() -> bytes:
+    """
+    Headers of a Server-Sent Events response. The connection is closed when the stream ends.
+    """
+    return (
+        'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+        'Cache-Control: no-cache\r\nConnection: close\r\n\r\n'
+    ).encode()
+
+
+def sse_event(data: dict, event: str = None) -> bytes:
+    """
+    Serializes one Server-Sent Event with a JSON payload.
+    """
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data)}\n\n'.encode()
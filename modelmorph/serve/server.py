@@ -0,0 +1,219 @@
+import asyncio
+import itertools
+import multiprocessing
+import threading
+import zlib
+from .config import ServerConfig
+from .protocol import HttpError, json_response, read_request, sse_event, sse_headers
+from .worker import run_worker
+
+ROUTES = {'/chat': 'chat', '/completion': 'completion', '/plugin': 'plugin'}
+REQUIRED_FIELDS = {'chat': ('chat_id', 'message'), 'completion': ('prompt',), 'plugin': ('plugin', 'input')}
+# HTTP status of the last event of a request
+STATUSES = {'done': 200, 'timeout': 504}
+# Seconds between two checks that the client of a request is still connected
+DISCONNECT_POLL = 0.2
+
+
+class Server:
+    """
+    Asyncio HTTP front end of the worker processes.
+
+    Endpoints (POST with a JSON body, '"stream": true' answers with Server-Sent Events):
+        - /chat {"chat_id", "message"}: routed to a worker by hash of chat_id, so a chat always lives in the same process.
+        - /completion {"prompt"}: routed to the least loaded worker.
+        - /plugin {"plugin", "input"}: routed to the least loaded worker.
+        - GET /health: queue depth of every worker and number of shed requests.
+
+    Admission control: each worker accepts up to `max_queue` requests in flight, further requests
+    routed to it are shed immediately with a 503 and a 'Retry-After' header instead of queueing.
+
+    Deadlines: a request answers 504 after `request_timeout` seconds, or the "timeout" of its body when
+    shorter. When the client disconnects first, the request is cancelled in its worker.
+    """
+
+    def __init__(self, config: ServerConfig):
+        self.config = config
+        self.depths = [0] * config.workers
+        self.shed = 0
+        self._ids = itertools.count()
+        self._pending = {}
+        self._processes = []
+        self._connections = []
+        self._server = None
+        self._loop = None
+
+    async def start(self) -> int:
+        """
+        Starts the worker processes and the HTTP server.
+
+        Output:
+            - Returns the port the server listens on.
+        """
+        self._loop = asyncio.get_running_loop()
+        for index in range(self.config.workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, args=(child, self.config), daemon=True, name=f'modelmorph-worker-{index}')
+            process.start()
+            child.close()
+            self._processes.append(process)
+            self._connections.append(parent)
+            threading.Thread(target=self._read_worker, args=(index, parent), daemon=True).start()
+
+        self._server = await asyncio.start_server(self._handle_connection, self.config.host, self.config.port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        port = await self.start()
+        print(f"modelmorph serving on http://{self.config.host}:{port} with {self.config.workers} workers")
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Stops the HTTP server and the worker processes.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for connection in self._connections:
+            # Forked workers inherit the front ends of the pipes and never see EOF, so they are told to stop
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def route(self, kind: str, payload: dict) -> int:
+        """
+        Chooses the worker of a request: by chat_id for chats (session affinity), otherwise the least loaded one.
+        """
+        if kind == 'chat':
+            return zlib.crc32(str(payload['chat_id']).encode()) % self.config.workers
+        return min(range(self.config.workers), key=self.depths.__getitem__)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.config.max_body)
+                    if request is None:
+                        break
+                    keep_alive = await self._handle_request(request, reader, writer)
+                except HttpError as e:
+                    writer.write(json_response(e.status, {'error': str(e)}, keep_alive=False))
+                    keep_alive = False
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request, reader, writer) -> bool:
+        if request.path == '/health':
+            writer.write(json_response(200, {'workers': self.depths, 'max_queue': self.config.max_queue, 'shed': self.shed}, request.keep_alive))
+            return request.keep_alive
+
+        kind = ROUTES.get(request.path)
+        if kind is None:
+            raise HttpError(404, f'Unknown path {request.path}')
+        if request.method != 'POST':
+            raise HttpError(405, 'Use POST')
+        payload = request.json()
+        missing = [field for field in REQUIRED_FIELDS[kind] if field not in payload]
+        if missing:
+            raise HttpError(400, f'Missing fields {missing}')
+        timeout = payload.get('timeout')
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise HttpError(400, 'timeout must be a positive number of seconds')
+
+        worker = self.route(kind, payload)
+        if self.depths[worker] >= self.config.max_queue:
+            self.shed += 1
+            writer.write(json_response(503, {'error': 'Server overloaded, retry later'}, request.keep_alive, {'Retry-After': '1'}))
+            return request.keep_alive
+
+        request_id, events = self._dispatch(worker, kind, payload)
+        try:
+            if payload.get('stream'):
+                writer.write(sse_headers())
+                while True:
+                    event, data = await self._next_event(events, reader)
+                    writer.write(sse_event(data, None if event == 'chunk' else event))
+                    await writer.drain()
+                    if event != 'chunk':
+                        return False
+
+            while True:
+                event, data = await self._next_event(events, reader)
+                if event != 'chunk':
+                    writer.write(json_response(STATUSES.get(event, 500), data, request.keep_alive))
+                    return request.keep_alive
+        except ConnectionError:
+            self._cancel(request_id)
+            raise
+
+    async def _next_event(self, events: asyncio.Queue, reader) -> tuple:
+        """
+        Waits for the next event of a request, raising ConnectionError if its client disconnects meanwhile.
+        """
+        get = asyncio.ensure_future(events.get())
+        while True:
+            done, _ = await asyncio.wait((get,), timeout=DISCONNECT_POLL)
+            if done:
+                return get.result()
+            # The connection is only read between requests, the end of the stream means the client left
+            if reader.at_eof():
+                get.cancel()
+                raise ConnectionError('Client disconnected')
+
+    def _cancel(self, request_id: int):
+        """
+        Tells the worker of a request still running that nobody waits for it anymore.
+        """
+        worker, _ = self._pending.get(request_id, (None, None))
+        if worker is not None:
+            try:
+                self._connections[worker].send((request_id, 'cancel', None))
+            except OSError:
+                pass
+
+    def _dispatch(self, worker: int, kind: str, payload: dict) -> tuple:
+        request_id = next(self._ids)
+        events = asyncio.Queue()
+        self._pending[request_id] = (worker, events)
+        self.depths[worker] += 1
+        self._connections[worker].send((request_id, kind, payload))
+        return request_id, events
+
+    def _read_worker(self, index: int, connection):
+        # Pipes have no asyncio support, each worker gets a reader thread handing answers to the loop
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                self._loop.call_soon_threadsafe(self._fail_worker, index)
+                return
+            self._loop.call_soon_threadsafe(self._deliver, *message)
+
+    def _deliver(self, request_id: int, event: str, data: dict):
+        worker, events = self._pending.get(request_id, (None, None))
+        if events is None:
+            return
+        if event != 'chunk':
+            del self._pending[request_id]
+            self.depths[worker] -= 1
+        events.put_nowait((event, data))
+
+    def _fail_worker(self, index: int):
+        for request_id, (worker, _) in list(self._pending.items()):
+            if worker == index:
+                self._deliver(request_id, 'error', {'error': 'Worker process stopped'})
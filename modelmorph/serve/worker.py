@@ -0,0 +1,180 @@
+import asyncio
+import os
+import tempfile
+import threading
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from modelmorph.chatbot.assistant.chat import Chat
+from modelmorph.chatbot.assistant.sessions import ChatSessions
+from modelmorph.deadline import Deadline, DeadlineExceeded, use_deadline
+from .config import ServerConfig
+
+
+def run_worker(connection, config: ServerConfig):
+    """
+    Entry point of a worker process: serves the requests received on the pipe until it is closed.
+
+    Input:
+        - connection (Connection): Worker end of the pipe shared with the front process.
+        - config (ServerConfig): Settings of the serving layer.
+    """
+    asyncio.run(Worker(connection, config).serve())
+
+
+class Worker:
+    """
+    Runs the assistants of one worker process. Requests arrive on a pipe as
+    (request_id, kind, payload) tuples, None stops the worker, and every answer is sent back as
+    (request_id, event, data), with event 'chunk' for streamed deltas and 'done', 'error' or 'timeout'
+    at the end. A (request_id, 'cancel', None) message cancels a request whose client went away: its
+    model call is aborted and the steps left (e.g. saving the chat) are skipped.
+
+    Chats routed to this worker stay in memory (session affinity), and messages of the same chat
+    are processed one at a time. The messages of idle chats are spilled to a file of the worker.
+    """
+
+    def __init__(self, connection, config: ServerConfig):
+        self.connection = connection
+        self.config = config
+        spill_path = os.path.join(config.spill_dir or tempfile.gettempdir(), f'modelmorph-sessions-{os.getpid()}.spill')
+        self.sessions = ChatSessions(self._new_chat, config.max_sessions, config.session_idle, spill_path)
+        # A lock lives as long as a request of its chat holds or waits on it
+        self._chat_locks = weakref.WeakValueDictionary()
+        self._send_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=config.max_concurrency, thread_name_prefix='modelmorph-serve')
+        self._tasks = set()
+        self._deadlines = {}
+        self._build_backend()
+
+    def _build_backend(self):
+        from modelmorph.chatbot.assistant import ChatCompletionAssistant, CompletionAssistant
+        from modelmorph.settings import load_settings
+
+        settings = load_settings(self.config.config_path)
+        llm = db_connection = None
+        if self.config.mock:
+            from modelmorph.chatbot.repository import MockLlm
+            from modelmorph.db.repository import InMemoryDBRepository
+            llm = MockLlm(latency=self.config.mock_latency)
+            db_connection = InMemoryDBRepository()
+
+        self.chat_assistant = ChatCompletionAssistant(settings=settings, llm=llm, db_connection=db_connection, history_window=self.config.history_window or None)
+        self.completion_assistant = CompletionAssistant(settings=settings, llm=llm)
+        self.plugin = None
+        if self.config.plugin_dir:
+            from modelmorph.chatbot.plugins import Plugin
+            self.plugin = Plugin(self.config.plugin_dir, self.completion_assistant.llm, settings)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        spiller = asyncio.create_task(self._spill_idle())
+        while True:
+            message = await loop.run_in_executor(None, self._receive)
+            if message is None:
+                break
+            request_id, kind, payload = message
+            if kind == 'cancel':
+                deadline = self._deadlines.get(request_id)
+                if deadline is not None:
+                    deadline.cancel('cancelled by the client')
+                continue
+            # Registered before the task starts, a cancel message may follow right away
+            self._deadlines[request_id] = self._deadline(payload)
+            task = asyncio.create_task(self.handle(request_id, kind, payload))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        spiller.cancel()
+        self.sessions.close()
+        self._executor.shutdown(wait=False)
+
+    async def _spill_idle(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(min(self.config.session_idle, 30.0))
+            # Chats with a request running or waiting are not idle, however old their last use
+            busy = {chat_id for chat_id, lock in list(self._chat_locks.items()) if lock.locked()}
+            # The spill file is written on a thread, not on the event loop
+            await loop.run_in_executor(None, self.sessions.spill_idle, None, busy)
+
+    async def handle(self, request_id: int, kind: str, payload: dict):
+        loop = asyncio.get_running_loop()
+        deadline = self._deadlines.get(request_id) or self._deadline(payload)
+        try:
+            if kind == 'chat':
+                chat_id = payload['chat_id']
+                lock = self._chat_locks.get(chat_id)
+                if lock is None:
+                    lock = self._chat_locks[chat_id] = asyncio.Lock()
+                async with lock:
+                    result = await loop.run_in_executor(self._executor, self._run, deadline, self._chat, request_id, payload)
+            elif kind == 'completion':
+                result = await loop.run_in_executor(self._executor, self._run, deadline, self._completion, request_id, payload)
+            elif kind == 'plugin':
+                result = await loop.run_in_executor(self._executor, self._run, deadline, self._run_plugin, payload)
+            else:
+                raise ValueError(f"Unknown request kind '{kind}'")
+            self._send(request_id, 'done', result)
+        except DeadlineExceeded as e:
+            self._send(request_id, 'timeout', {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self._send(request_id, 'error', {'error': str(e) or type(e).__name__})
+        finally:
+            self._deadlines.pop(request_id, None)
+
+    def _deadline(self, payload: dict) -> Deadline:
+        # The shortest of the server timeout and the one asked by the client, none when both are 0
+        timeouts = [timeout for timeout in (self.config.request_timeout, payload.get('timeout')) if timeout]
+        return Deadline(min(timeouts) if timeouts else None)
+
+    @staticmethod
+    def _run(deadline: Deadline, function, *args):
+        # Requests waiting for a thread or a chat lock are dropped once nobody waits for them
+        deadline.check('start')
+        with use_deadline(deadline):
+            return function(*args)
+
+    def _chat(self, request_id: int, payload: dict) -> dict:
+        with self.sessions.use(payload['chat_id']) as chat:
+            if payload.get('stream'):
+                for delta in chat.send_stream(payload['message']):
+                    self._send(request_id, 'chunk', {'delta': delta})
+                answer = chat.chat['messages'][-1]['content']
+            else:
+                result = chat.send(payload['message'])
+                if result is None:
+                    raise RuntimeError(self.chat_assistant.error_response)
+                answer = result[1]
+            chat.save_chat()
+        return {'chat_id': payload['chat_id'], 'message': answer}
+
+    def _completion(self, request_id: int, payload: dict) -> dict:
+        assistant = self.completion_assistant
+        if payload.get('stream'):
+            parts = []
+            for delta in assistant.llm.stream_response_message(message=payload['prompt'], system_message=assistant.initial_prompt, type_object=payload.get('response_type', 'text')):
+                parts.append(delta)
+                self._send(request_id, 'chunk', {'delta': delta})
+            return {'completion': ''.join(parts)}
+        return {'completion': assistant.generate_completion(payload['prompt'], response_type=payload.get('response_type', 'text'))}
+
+    def _run_plugin(self, payload: dict) -> dict:
+        if self.plugin is None:
+            raise ValueError('No plugin directory configured')
+        return {'result': self.plugin.run(payload['plugin'], payload['input'])}
+
+    def _new_chat(self, chat_id) -> Chat:
+        # Not init_chat: it saves an empty chat, the history is loaded from the storage on the first message
+        assistant = self.chat_assistant
+        return Chat(chat_id, assistant.llm, assistant.initial_prompt, assistant.db_connection, assistant.history_window)
+
+    def _receive(self):
+        try:
+            return self.connection.recv()
+        except (EOFError, OSError):
+            return None
+
+    def _send(self, request_id: int, event: str, data: dict):
+        with self._send_lock:
+            self.connection.send((request_id, event, data))
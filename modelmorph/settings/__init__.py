@@ -0,0 +1 @@
+from .settings import Settings, LlmSettings, ConnectorSettings, PluginSettings, load_settings, load_plugin_settings, clear_settings_cache
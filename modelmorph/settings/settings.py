@@ -0,0 +1,195 @@
+import configparser
+import json
+import os
+import threading
+from typing import Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel, ConfigDict, field_validator
+
+
+class LlmSettings(BaseModel):
+    """
+    Settings of an LLM section of the configuration file ('LLM_COMPLETATION' or 'LLM_CHAT').
+
+    Values left as None were not present in the file, so each consumer keeps its own fallback.
+    """
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
+    initial_prompt: Optional[str] = None
+    error_response: Optional[str] = None
+    intro: str = ''
+    how: str = ''
+    format: str = ''
+    objective_delimiter: str = '\n'
+    restriction_delimiter: str = '\n'
+    parameter_delimiter: str = '\n'
+
+    max_tokens: Optional[int] = None
+    temp: Optional[float] = None
+    top_p: Optional[float] = None
+    type: Optional[str] = None
+
+    @field_validator('max_tokens', 'temp', 'top_p', 'type', mode='before')
+    @classmethod
+    def _empty_as_none(cls, value):
+        return None if value == '' else value
+
+
+class ConnectorSettings(BaseModel):
+    """
+    Connectors written before each section of a generated prompt ('CONNECTORS' section).
+    """
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
+    role: str = 'Role:'
+    intro: str = 'Introduction:'
+    objectives: str = 'Objectives:'
+    how: str = 'Approach:'
+    restrictions: str = 'Conditions:'
+    format: str = 'Output Format:'
+    parameters: str = 'Parametros:'
+
+
+class PluginSettings(BaseModel):
+    """
+    Generation settings of a plugin, loaded from its 'config.json'. Unknown keys are kept as extra fields.
+    """
+    model_config = ConfigDict(frozen=True, extra='allow')
+
+    description: str = ''
+    max_tokens: int = 100
+    temperature: float = 0
+    top_p: float = 1.0
+    n: int = 1
+    stop: list[str] = ["\n"]
+    timeout: Optional[float] = None
+
+
+class Settings(BaseModel):
+    """
+    Immutable settings shared by assistants, prompts and plugins. Built from the environment
+    (and '.env' file) plus an INI configuration file, see `load_settings`.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    endpoint: Optional[str] = None
+    api_key: Optional[str] = None
+    deployment_id: Optional[str] = None
+    api_version: Optional[str] = None
+    connection_string: Optional[str] = None
+    db_name: Optional[str] = None
+
+    completion: LlmSettings = LlmSettings()
+    chat: LlmSettings = LlmSettings()
+    connectors: ConnectorSettings = ConnectorSettings()
+
+    @classmethod
+    def from_file(cls, config_path: str = '') -> 'Settings':
+        """
+        Parses the configuration file and the environment variables into a Settings object.
+
+        Input:
+            - config_path (str): Path to the INI configuration file. Missing files give the default settings.
+
+        Output:
+            - Returns a new Settings instance.
+        """
+        _load_env()
+        config = configparser.ConfigParser()
+        if config_path:
+            config.read(config_path)
+
+        def section(name):
+            # Sections inherit the [DEFAULT] values, as with ConfigParser.get
+            return dict(config[name]) if config.has_section(name) else dict(config.defaults())
+
+        return cls(
+            endpoint=os.getenv('ENDPOINT'),
+            api_key=os.getenv('API_KEY'),
+            deployment_id=os.getenv('DEPLOYMENT_ID'),
+            api_version=os.getenv('API_VERSION'),
+            connection_string=os.getenv('CONNECTION_STRING'),
+            db_name=os.getenv('DB_NAME'),
+            completion=LlmSettings(**section('LLM_COMPLETATION')),
+            chat=LlmSettings(**section('LLM_CHAT')),
+            connectors=ConnectorSettings(**section('CONNECTORS')),
+        )
+
+
+_env_loaded = False
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _load_env():
+    global _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+
+
+def _file_signature(path: str):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+def _load_cached(kind: str, path: str, loader):
+    """
+    Returns the cached value for (kind, path), calling loader(path) only on the first load
+    or when the file changed on disk since it was cached.
+    """
+    key = (kind, os.path.abspath(path) if path else '')
+    signature = _file_signature(key[1]) if path else None
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    value = loader(path)
+    with _cache_lock:
+        _cache[key] = (signature, value)
+    return value
+
+
+def load_settings(config_path: str = '') -> Settings:
+    """
+    Loads the settings for a configuration file once per process. The cached object is reused
+    until the file changes on disk (modification time or size).
+
+    Input:
+        - config_path (str): Path to the INI configuration file, empty for environment only settings.
+
+    Output:
+        - Returns the shared, immutable Settings instance for that path.
+    """
+    return _load_cached('settings', config_path, Settings.from_file)
+
+
+def load_plugin_settings(config_path: str) -> PluginSettings:
+    """
+    Loads and caches the 'config.json' of a plugin, reloading it only when the file changes.
+
+    Input:
+        - config_path (str): Path to the plugin 'config.json' file.
+
+    Output:
+        - Returns the shared, immutable PluginSettings instance for that file.
+    """
+    def loader(path):
+        with open(path, 'r') as config_file:
+            return PluginSettings(**json.load(config_file))
+
+    return _load_cached('plugin', config_path, loader)
+
+
+def clear_settings_cache():
+    """
+    Drops every cached settings object, forcing the next load to read the files again.
+    """
+    global _env_loaded
+    with _cache_lock:
+        _cache.clear()
+    _env_loaded = False
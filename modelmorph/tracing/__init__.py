@@ -0,0 +1,11 @@
+from modelmorph._lazy import attach
+from .tracer import NOOP_SPAN, Span, SpanContext, Tracer, configure, current_span, disable, extract, get_tracer, inject, span, wrap
+
+__getattr__, __dir__, __all__ = attach(
+    __name__,
+    submodules=['exporters', 'tracer'],
+    attributes={
+        'exporters': ['InMemoryExporter', 'JsonLinesExporter', 'OtlpFileExporter', 'SpanExporter'],
+    },
+    eager=['NOOP_SPAN', 'Span', 'SpanContext', 'Tracer', 'configure', 'current_span', 'disable', 'extract', 'get_tracer', 'inject', 'span', 'wrap'],
+)
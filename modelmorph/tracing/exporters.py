@@ -0,0 +1,140 @@
+from abc import ABCMeta, abstractmethod
+import json
+import threading
+from .tracer import Span
+
+
+class SpanExporter(metaclass=ABCMeta):
+
+    @abstractmethod
+    def export(self, span: Span):
+        """
+        Receives a finished span. Called in the thread that ended the span, so it must be quick.
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """
+        Releases the resources of the exporter when tracing is disabled.
+        """
+
+
+class InMemoryExporter(SpanExporter):
+    """
+    Keeps the finished spans in a list, for tests and interactive debugging.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def find(self, name: str) -> list[Span]:
+        """
+        Returns the finished spans with the given name.
+        """
+        with self._lock:
+            return [span for span in self.spans if span.name == name]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+class _FileExporter(SpanExporter):
+    """
+    Appends every finished span to a file as one JSON object per line, in the format of `_encode`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(self._encode(span), default=str)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + '\n')
+
+    def shutdown(self):
+        with self._lock:
+            self._file.close()
+
+    @abstractmethod
+    def _encode(self, span: Span) -> dict:
+        """
+        Returns the JSON object written for a finished span.
+        """
+        raise NotImplementedError
+
+
+class JsonLinesExporter(_FileExporter):
+    """
+    Appends every finished span to a file as one JSON object per line, see `Span.to_dict`.
+    """
+
+    def _encode(self, span: Span) -> dict:
+        return span.to_dict()
+
+
+class OtlpFileExporter(_FileExporter):
+    """
+    Appends every finished span to a file as an OTLP/JSON ExportTraceServiceRequest per line
+    (the OpenTelemetry file exporter format), which collectors and trace viewers can import.
+    """
+
+    def __init__(self, path: str, service_name: str = 'modelmorph'):
+        """
+        Initializes the exporter.
+
+        Input:
+            - path (str): File receiving the spans.
+            - service_name (str): 'service.name' resource attribute of the spans.
+        """
+        super().__init__(path)
+        self.service_name = service_name
+
+    def _encode(self, span: Span) -> dict:
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': _attributes(span.attributes),
+            'status': {'code': 1},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        if span.error is not None:
+            error_type, message, time_ns = span.error
+            otlp_span['status'] = {'code': 2, 'message': message}
+            otlp_span['events'] = [{
+                'name': 'exception',
+                'timeUnixNano': str(time_ns),
+                'attributes': _attributes({'exception.type': error_type, 'exception.message': message}),
+            }]
+        return {'resourceSpans': [{
+            'resource': {'attributes': _attributes({'service.name': self.service_name})},
+            'scopeSpans': [{'scope': {'name': 'modelmorph'}, 'spans': [otlp_span]}],
+        }]}
+
+
+def _attributes(values: dict) -> list[dict]:
+    attributes = []
+    for key, value in values.items():
+        if isinstance(value, bool):
+            encoded = {'boolValue': value}
+        elif isinstance(value, int):
+            encoded = {'intValue': str(value)}
+        elif isinstance(value, float):
+            encoded = {'doubleValue': value}
+        else:
+            encoded = {'stringValue': str(value)}
+        attributes.append({'key': key, 'value': encoded})
+    return attributes
@@ -0,0 +1,300 @@
+from contextvars import ContextVar
+from typing import NamedTuple
+import functools
+import os
+import random
+import time
+
+_current_span = ContextVar('modelmorph_current_span', default=None)
+
+# Global tracer, None while tracing is disabled
+_tracer = None
+
+
+class SpanContext(NamedTuple):
+    """
+    Identifiers of a span, used as the parent of spans started in another process.
+    """
+    trace_id: str
+    span_id: str
+
+
+class Span:
+    """
+    Timed operation of a trace. Used as a context manager, it becomes the parent of the spans
+    started inside it (threads started with `wrap` included) and records the exception leaving it.
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error', '_tracer', '_token', '_profiler')
+
+    def __init__(self, tracer: 'Tracer', name: str, parent, attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else f'{random.getrandbits(128):032x}'
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.error = None
+        self.end_ns = None
+        self._tracer = tracer
+        self._token = None
+        self._profiler = None
+        self.start_ns = time.time_ns()
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id)
+
+    @property
+    def duration(self) -> float:
+        """
+        Duration of the span in seconds, up to now while it is running.
+        """
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def child(self, name: str, **attributes) -> 'Span':
+        """
+        Starts a span child of this one without making it the current span, for generators
+        that must not change the context of their consumer between two items.
+        """
+        return self._tracer.start_span(name, attributes, parent=self)
+
+    def record_usage(self, response):
+        """
+        Adds the model and token usage of a language model response to the attributes.
+        """
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            self.attributes['llm.prompt_tokens'] = usage.prompt_tokens
+            self.attributes['llm.completion_tokens'] = usage.completion_tokens
+        model = getattr(response, 'model', None)
+        if model:
+            self.attributes['llm.model'] = model
+
+    def record_exception(self, error: BaseException):
+        self.error = (type(error).__name__, str(error), time.time_ns())
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self._tracer._finish(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_exception(exc)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': None if self.error is None else {'type': self.error[0], 'message': self.error[1]},
+        }
+
+
+class _NoopSpan:
+    # Returned while tracing is disabled, so instrumented code costs a function call and a with block
+
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def child(self, name, **attributes):
+        return self
+
+    def record_usage(self, response):
+        pass
+
+    def record_exception(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Creates the spans and hands the finished ones to the exporters. Install it with `configure`.
+    """
+
+    def __init__(self, exporters=()):
+        """
+        Initializes the tracer.
+
+        Input:
+            - exporters (iterable of SpanExporter): Receive every finished span.
+        """
+        self.exporters = list(exporters)
+        self._profile = None
+
+    def start_span(self, name: str, attributes: dict = None, parent=None) -> Span:
+        """
+        Starts a span, child of parent or of the current span.
+
+        Input:
+            - name (str): Name of the operation.
+            - attributes (dict, optional): Initial attributes of the span.
+            - parent (Span or SpanContext, optional): Parent span, defaults to the current one.
+        """
+        if parent is None:
+            parent = _current_span.get()
+        span = Span(self, name, parent, attributes if attributes is not None else {})
+        profile = self._profile
+        if parent is None and profile is not None and random.random() < profile[1]:
+            span._profiler = self._start_profiler()
+        return span
+
+    def enable_profiling(self, directory: str, rate: float = 1.0, threshold: float = 0.0):
+        """
+        Profiles requests with cProfile: a sampled root span runs under the profiler and, when it lasts
+        at least threshold seconds, the stats are written to directory as '<trace_id>-<name>.prof' and
+        the path is added to the span as 'profile.path'. Only the thread of the root span is profiled.
+
+        Input:
+            - directory (str): Directory receiving the profiles.
+            - rate (float): Fraction of the root spans profiled.
+            - threshold (float): Minimum duration in seconds of the profiles kept.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._profile = (directory, rate, threshold)
+
+    def disable_profiling(self):
+        self._profile = None
+
+    def shutdown(self):
+        for exporter in self.exporters:
+            exporter.shutdown()
+
+    def _start_profiler(self):
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return None
+        return profiler
+
+    def _finish(self, span: Span):
+        if span._profiler is not None:
+            span._profiler.disable()
+            profile = self._profile
+            if profile is not None and span.duration >= profile[2]:
+                path = os.path.join(profile[0], f'{span.trace_id}-{span.name}.prof')
+                span._profiler.dump_stats(path)
+                span.attributes['profile.path'] = path
+            span._profiler = None
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+def configure(exporters=()) -> Tracer:
+    """
+    Enables tracing with a new global tracer.
+
+    Input:
+        - exporters (iterable of SpanExporter): Receive every finished span.
+
+    Output:
+        - Returns the installed Tracer.
+    """
+    global _tracer
+    _tracer = Tracer(exporters)
+    return _tracer
+
+
+def disable():
+    """
+    Disables tracing, `span` returns a no-op span again.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.shutdown()
+
+
+def get_tracer() -> Tracer | None:
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """
+    Starts a span child of the current one, to be used as a context manager:
+
+        with span('chat.model', chat_id=chat_id) as model_span:
+            ...
+
+    Output:
+        - Returns a Span, or a shared no-op span while tracing is disabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start_span(name, attributes)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def wrap(func):
+    """
+    Binds func to the current context, so the spans it starts in a thread pool keep their parent.
+    """
+    if _tracer is None:
+        return func
+    parent = _current_span.get()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return run
+
+
+def inject() -> dict:
+    """
+    Returns the W3C 'traceparent' header of the current span, to continue the trace in another process.
+    """
+    current = _current_span.get()
+    if current is None:
+        return {}
+    return {'traceparent': f'00-{current.trace_id}-{current.span_id}-01'}
+
+
+def extract(headers: dict) -> SpanContext | None:
+    """
+    Reads the parent span from a W3C 'traceparent' header, see `Tracer.start_span`.
+    """
+    parts = (headers or {}).get('traceparent', '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return SpanContext(parts[1], parts[2])
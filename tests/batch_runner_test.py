@@ -0,0 +1,82 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from modelmorph import Prompt
+from modelmorph.pipeline import BatchRunner
+
+
+class Crash(BaseException):
+    pass
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FakeAssistant:
+    def __init__(self, crash_after=None, rate_limited=0):
+        self.prompts = []
+        self.crash_after = crash_after
+        self.rate_limited = rate_limited
+        self._lock = threading.Lock()
+
+    def generate_completion(self, prompt, deadline=None, **kwargs):
+        with self._lock:
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise RateLimitError('Too many requests')
+            if self.crash_after is not None and len(self.prompts) >= self.crash_after:
+                raise Crash()
+            self.prompts.append(prompt)
+        if 'fail' in prompt:
+            raise ValueError('bad row')
+        return prompt.upper()
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({'review': [f'review {i}' for i in range(25)], 'stars': range(25)}, index=[f'r{i}' for i in range(25)])
+
+
+def test_crashed_run_resumes_from_the_checkpoint(tmp_path, frame):
+    output = str(tmp_path / 'out.jsonl')
+    crashing = BatchRunner(FakeAssistant(crash_after=12), "Summarize {{$input}} ({{$stars}} stars)", output,
+                           columns={'input': 'review'}, chunk_size=5, concurrency=3, backoff=0)
+    with pytest.raises(Crash):
+        crashing.run(frame)
+    with open(output, 'a') as file:
+        file.write('{"key": "r1')  # interrupted while writing
+
+    assistant = FakeAssistant()
+    runner = BatchRunner(assistant, "Summarize {{$input}} ({{$stars}} stars)", output, columns={'input': 'review'},
+                         keep_columns=['stars'], chunk_size=5, concurrency=3, backoff=0)
+    stats = runner.run(frame)
+
+    assert stats == {'rows': 25, 'skipped': 10, 'completed': 15, 'failed': 0}
+    assert len(assistant.prompts) == 15
+    result = runner.read_output()
+    assert len(result) == 25
+    assert result.loc['r7', 'completion'] == 'SUMMARIZE REVIEW 7 (7 STARS)'
+    assert runner.run(frame)['skipped'] == 25
+
+
+def test_rate_limits_and_failed_rows_are_retried(tmp_path):
+    frame = pd.DataFrame({'id': [10, 11, 12], 'text': ['ok', 'fail', 'ok too']})
+    prompt = Prompt(role='Translator')
+    runner = BatchRunner(FakeAssistant(rate_limited=2), prompt, str(tmp_path / 'out.jsonl'), text='Translate: {{$text}}',
+                         key='id', max_retries=2, backoff=0.01)
+    assert runner.run(frame) == {'rows': 3, 'skipped': 0, 'completed': 2, 'failed': 1}
+    assert runner.read_output().loc[11, 'error'] == 'ValueError: bad row'
+    assert 'ROL: TRANSLATOR' in runner.read_output().loc[12, 'completion']
+    assert runner.read_output().loc[12, 'completion'].endswith('TRANSLATE: OK TOO\n')
+
+    # Failed rows are sent again by the next run
+    assert runner.run(frame) == {'rows': 3, 'skipped': 2, 'completed': 0, 'failed': 1}
+
+
+def test_keys_must_be_unique(tmp_path):
+    runner = BatchRunner(FakeAssistant(), "{{$text}}", str(tmp_path / 'out.jsonl'))
+    with pytest.raises(ValueError):
+        runner.run(pd.DataFrame({'text': ['a', 'b']}, index=[1, 1]))
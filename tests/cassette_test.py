@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from modelmorph import CompletionAssistant
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import CassetteLlm, CassetteMiss, MockLlm
+from modelmorph.db.repository import InMemoryDBRepository
+
+
+def _traffic(llm):
+    # A new chat id per run, the in-memory storage is shared by the whole process
+    chat = Chat(f'cassette-{id(llm)}', llm, 'prompt', InMemoryDBRepository())
+    answers = [chat.send('hello')[1], chat.send('hello')[1], "".join(chat.send_stream('stream me'))]
+    assistant = CompletionAssistant(endpoint='https://example.invalid', api_key='key', api_version='2024-06-01', llm=llm)
+    answers.append(assistant.generate_completion('complete me', response_type='text'))
+    return answers
+
+
+def test_record_then_replay(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl.gz')
+    with CassetteLlm(path, MockLlm(latency=0.05), mode='record') as recorder:
+        recorded = _traffic(recorder)
+    assert recorder.stats['recorded'] == 4
+
+    replayer = CassetteLlm(path)
+    started = time.perf_counter()
+    assert _traffic(replayer) == recorded
+    assert time.perf_counter() - started < 0.1
+    assert replayer.stats == {'replayed': 4, 'recorded': 0}
+
+    timed = CassetteLlm(path, timing='recorded')
+    started = time.perf_counter()
+    _traffic(timed)
+    assert time.perf_counter() - started >= 0.2
+
+    with pytest.raises(CassetteMiss):
+        replayer.get_response_message('never recorded')
+
+
+def test_auto_mode_records_only_missing_requests(tmp_path):
+    path = str(tmp_path / 'auto.jsonl.gz')
+    with CassetteLlm(path, MockLlm(latency=0), mode='auto') as cassette:
+        cassette.get_response_message('one', type_object='text')
+    with CassetteLlm(path, MockLlm(latency=0), mode='auto') as cassette:
+        response = cassette.get_response_message('one', type_object='text')
+        cassette.get_response_message('two', type_object='text')
+
+    assert response.choices[0].message.content == 'Mock answer to: one'
+    assert response.usage.total_tokens > 0 and response.choices[0].message.tool_calls is None
+    assert cassette.stats == {'replayed': 1, 'recorded': 1}
+    assert len(CassetteLlm(path)) == 2
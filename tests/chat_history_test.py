@@ -0,0 +1,95 @@
+import uuid
+from types import SimpleNamespace
+
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.db.repository import InMemoryDBRepository, MongoDBRepository
+from modelmorph.db.repository import mongo_db_repository
+
+
+class RecordingLlm(MockLlm):
+    def __init__(self):
+        super().__init__(latency=0)
+        self.sent = []
+
+    def get_response_chat(self, messages, *args, **kwargs):
+        self.sent.append(list(messages))
+        return super().get_response_chat(messages, *args, **kwargs)
+
+
+def test_window_reads_the_tail_and_appends_new_messages():
+    db = InMemoryDBRepository()
+    chat_id = f'history-{uuid.uuid4()}'
+    chat = Chat(chat_id, MockLlm(latency=0), 'old prompt', db, history_window=4)
+    for i in range(3):
+        chat.send(f'message {i}')
+        chat.save_chat()
+    stored = db.find_chat_by_id(chat_id).data[0]['messages']
+    assert len(stored) == 7 and stored[0] == {'role': 'system', 'content': 'old prompt'}
+    # Trimmed to the system message and the window after saving
+    assert len(chat.chat['messages']) == 5
+
+    llm = RecordingLlm()
+    resumed = Chat(chat_id, llm, 'new prompt', db, history_window=4)
+    resumed.send('message 3')
+    resumed.save_chat()
+
+    sent = llm.sent[0]
+    assert sent[0] == {'role': 'system', 'content': 'new prompt'}
+    assert [m['content'] for m in sent[1:]] == [m['content'] for m in stored[-3:]] + ['message 3']
+    # Nothing stored was rewritten, the last turn was appended
+    after = db.find_chat_by_id(chat_id).data[0]['messages']
+    assert after[:7] == stored and len(after) == 9
+
+
+class FakeCollection:
+    def __init__(self):
+        self.calls = []
+
+    def find_one(self, query, projection):
+        self.calls.append(('find_one', query, projection))
+        return {'_id': query['_id'], 'messages': [{'role': 'user', 'content': 'last'}]}
+
+    def update_one(self, query, update, upsert=False):
+        self.calls.append(('update_one', query, update, upsert))
+        return SimpleNamespace(matched_count=0, upserted_id=query['_id'], modified_count=0)
+
+
+def test_mongo_tail_uses_slice_projection():
+    repository = object.__new__(MongoDBRepository)
+    collection = FakeCollection()
+    repository.db = {'chats': collection}
+
+    assert repository.find_chat_tail(7, 20).data[0]['messages'][0]['content'] == 'last'
+    assert repository.append_messages(7, [{'role': 'user', 'content': 'hi'}]).error == ""
+    # An upsert that inserts the chat is a successful save
+    assert repository.save_chat(7, {'messages': []}).error == ""
+
+    assert collection.calls[0] == ('find_one', {'_id': 7}, {'messages': {'$slice': -20}})
+    _, _, update, upsert = collection.calls[1]
+    assert upsert and update['$push'] == {'messages': {'$each': [{'role': 'user', 'content': 'hi'}]}}
+    assert 'updated_at' in update['$set']
+
+
+def test_mongo_connects_and_indexes_once_per_process(monkeypatch, capsys):
+    clients, indexed = [], []
+
+    class FakeClient:
+        def __init__(self, connection_string):
+            clients.append(connection_string)
+
+        def get_database(self, name):
+            return {'chats': FakeCollection()}
+
+    monkeypatch.setattr(mongo_db_repository, 'MongoClient', FakeClient)
+    monkeypatch.setattr(mongo_db_repository, '_clients', {})
+    monkeypatch.setattr(mongo_db_repository, '_indexed', set())
+    monkeypatch.setattr(MongoDBRepository, 'ensure_indexes', lambda self, ttl: indexed.append(ttl) or SimpleNamespace(error=''))
+    monkeypatch.setenv('CHAT_TTL_SECONDS', '3600')
+    first = MongoDBRepository.standalone('mongodb://cluster')
+    second = MongoDBRepository.standalone('mongodb://cluster')
+    assert first.client is second.client and clients == ['mongodb://cluster'] and indexed == [3600]
+
+    monkeypatch.setenv('CHAT_TTL_SECONDS', 'a day')
+    MongoDBRepository.standalone('mongodb://other')
+    assert indexed == [3600] and 'Invalid CHAT_TTL_SECONDS' in capsys.readouterr().out
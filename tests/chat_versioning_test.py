@@ -0,0 +1,82 @@
+import threading
+import uuid
+from types import SimpleNamespace
+
+from pymongo.errors import DuplicateKeyError
+
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.db.domain import VERSION_CONFLICT
+from modelmorph.db.repository import InMemoryDBRepository, MongoDBRepository, SqlRepository
+
+
+def test_replicas_saving_the_same_chat_keep_every_turn():
+    db = InMemoryDBRepository()
+    chat_id = f'versioned-{uuid.uuid4()}'
+    first = Chat(chat_id, MockLlm(latency=0), 'prompt', db)
+    first.send('hello')
+    first.save_chat()
+
+    # Two workers load the chat, answer a turn each and save
+    a, b = Chat(chat_id, MockLlm(latency=0), 'prompt', db), Chat(chat_id, MockLlm(latency=0), 'prompt', db)
+    a.send('from a')
+    b.send('from b')
+    a.save_chat()
+    b.save_chat()
+
+    stored = db.find_chat_by_id(chat_id).data[0]
+    assert [m['content'] for m in stored['messages'] if m['role'] == 'user'] == ['hello', 'from a', 'from b']
+    assert stored['version'] == 3 and b.chat['messages'] == stored['messages']
+
+    # A chat never loaded is merged without a second system message
+    c = Chat(chat_id, MockLlm(latency=0), 'prompt', db)
+    c.chat['messages'].append({'role': 'user', 'content': 'late'})
+    c.save_chat()
+    stored = db.find_chat_by_id(chat_id).data[0]['messages']
+    assert [m['role'] for m in stored].count('system') == 1 and stored[-1]['content'] == 'late'
+
+
+def test_sql_compare_and_set_and_concurrent_appends(tmp_path):
+    repository = SqlRepository(str(tmp_path / 'chats.db'), pool_size=4)
+    assert repository.save_chat_if_version(1, {'messages': []}, 0).data == [{'version': 1}]
+    assert repository.save_chat_if_version(1, {'messages': ['lost']}, 0).error == VERSION_CONFLICT
+    assert repository.save_chat_if_version(1, {'messages': ['kept']}, 1).data == [{'version': 2}]
+    assert repository.save_chat_if_version(1, {'messages': ['lost']}, 1).error == VERSION_CONFLICT
+
+    def append(worker):
+        for i in range(5):
+            assert repository.append_messages(2, [{'worker': worker, 'i': i}]).error == ""
+
+    threads = [threading.Thread(target=append, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    chat = repository.find_chat_by_id(2).data[0]
+    assert len(chat['messages']) == 20 and chat['version'] == 20
+    repository.close()
+
+
+class VersionedCollection:
+    def __init__(self, version):
+        self.version = version
+        self.calls = []
+
+    def update_one(self, query, update, upsert=False):
+        self.calls.append((query, update, upsert))
+        if upsert and self.version:
+            raise DuplicateKeyError('E11000 duplicate key')
+        matched = int(query.get('version') == self.version)
+        return SimpleNamespace(matched_count=matched, upserted_id=None, modified_count=matched)
+
+
+def test_mongo_conditional_update():
+    repository = object.__new__(MongoDBRepository)
+    repository.db = {'chats': VersionedCollection(version=4)}
+    assert repository.save_chat_if_version(7, {'_id': 7, 'messages': [], 'version': 4}, 4).data == [{'version': 5}]
+    assert repository.save_chat_if_version(7, {'messages': []}, 3).error == VERSION_CONFLICT
+    assert repository.save_chat_if_version(7, {'messages': []}, 0).error == VERSION_CONFLICT
+
+    query, update, upsert = repository.db['chats'].calls[0]
+    assert query == {'_id': 7, 'version': 4} and not upsert
+    assert update['$set']['version'] == 5 and '_id' not in update['$set'] and 'updated_at' in update['$set']
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+import httpx
+import pytest
+from openai import AzureOpenAI
+
+from modelmorph import CompletionAssistant
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import LlmScheduler, MockLlm, OpenAILlm
+from modelmorph.db.repository import InMemoryDBRepository
+from modelmorph.deadline import Deadline, DeadlineExceeded, RequestCancelled, use_deadline
+from modelmorph.serve import Server, ServerConfig
+
+
+def _cancel_later(deadline, delay=0.05):
+    threading.Timer(delay, deadline.cancel).start()
+
+
+def test_cancelled_chat_turn_is_dropped_and_not_saved():
+    storage = InMemoryDBRepository()
+    chat_id = f'deadline-{uuid.uuid4()}'
+    chat = Chat(chat_id, MockLlm(latency=5), 'prompt', storage)
+    deadline = Deadline()
+    _cancel_later(deadline)
+
+    started = time.perf_counter()
+    with use_deadline(deadline), pytest.raises(RequestCancelled):
+        chat.send('hello')
+    with use_deadline(deadline):
+        chat.save_chat()
+
+    assert time.perf_counter() - started < 1
+    assert [m['role'] for m in chat.chat['messages']] == ['system']
+    assert storage.find_chat_by_id(chat_id).error == 400
+
+
+def test_completion_timeout_and_cancelled_stream():
+    assistant = CompletionAssistant(endpoint='https://example.invalid', api_key='key', api_version='2024-06-01', llm=MockLlm(latency=5))
+    started = time.perf_counter()
+    with pytest.raises(DeadlineExceeded):
+        assistant.generate_completion('slow', deadline=0.05)
+    assert time.perf_counter() - started < 1
+
+    chat = Chat(f'deadline-{uuid.uuid4()}', MockLlm(latency=0, chunk_delay=5, chunk_size=2), 'prompt', InMemoryDBRepository())
+    deadline = Deadline()
+    stream = chat.send_stream('a long answer', deadline=deadline)
+    assert next(stream)
+    _cancel_later(deadline)
+    with pytest.raises(RequestCancelled):
+        list(stream)
+    assert chat.chat['messages'][-1]['role'] == 'system'
+
+
+def test_openai_request_gets_the_time_left():
+    timeouts = []
+
+    def handler(request):
+        timeouts.append(request.extensions['timeout']['read'])
+        return httpx.Response(200, json={"id": "x", "object": "chat.completion", "created": 0, "model": "m", "choices": [
+            {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "{}"}}]})
+
+    llm = OpenAILlm.__new__(OpenAILlm)
+    llm.model_name = "m"
+    llm.client = AzureOpenAI(api_key="k", azure_endpoint="https://test", api_version="2024-02-01",
+                             http_client=httpx.Client(transport=httpx.MockTransport(handler)))
+    with use_deadline(2.0):
+        llm.get_response_chat([{"role": "user", "content": "hi"}])
+    llm.get_response_chat([{"role": "user", "content": "hi"}])
+
+    assert 1.5 < timeouts[0] <= 2.0 and timeouts[1] > 2.0
+    with use_deadline(Deadline(0)), pytest.raises(DeadlineExceeded):
+        llm.get_response_chat([])
+
+
+def test_queued_request_is_released_on_cancel():
+    scheduler = LlmScheduler(max_concurrency=1)
+    ticket = scheduler.acquire(10)
+    deadline = Deadline()
+    _cancel_later(deadline)
+    started = time.perf_counter()
+    with use_deadline(deadline), pytest.raises(RequestCancelled):
+        scheduler.acquire(10)
+    assert time.perf_counter() - started < 1
+    scheduler.release(ticket)
+    assert scheduler.stats()['classes']['interactive']['expired'] == 1
+
+
+def test_server_answers_504_after_the_request_timeout():
+    async def scenario():
+        server = Server(ServerConfig(port=0, workers=1, mock=True, mock_latency=5))
+        port = await server.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            body = json.dumps({'prompt': 'x', 'timeout': 0.1}).encode()
+            writer.write(f'POST /completion HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            response = await asyncio.wait_for(reader.read(), 3)
+            writer.close()
+            assert response.split()[1] == b'504'
+
+            # A client leaving frees its worker for the next request
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            body = json.dumps({'prompt': 'y'}).encode()
+            writer.write(f'POST /completion HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+            await asyncio.sleep(0.2)
+            writer.close()
+            for _ in range(30):
+                await asyncio.sleep(0.1)
+                if server.depths == [0]:
+                    break
+            assert server.depths == [0]
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
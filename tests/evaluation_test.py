@@ -0,0 +1,86 @@
+import json
+import time
+
+from modelmorph import Prompt
+from modelmorph.chatbot.plugins import NlpToSql
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.evaluation import EvalCase, ModelComparison, ResultStore
+from modelmorph.evaluation.comparison import percentile
+from modelmorph.db.repository import SqlRepository
+from modelmorph.evaluation.scorers import contains, same_rows, valid_sql
+
+PROMPT = "### Tables: # Wells (WellID, WellName, Depth) ### A SQL query to find {{$input}}"
+
+
+def _good_answer(messages):
+    return "hello" if 'Say hello' in messages[-1]['content'] else "SELECT WellName FROM Wells"
+
+
+def _bad_answer(messages):
+    return "SELECT WellName FROM Wells" if 'names' in messages[-1]['content'] else "SELECT Name FROM Missing"
+
+
+def test_models_are_compared_concurrently_and_replayed_from_the_store(tmp_path):
+    (tmp_path / 'sql').mkdir()
+    (tmp_path / 'sql' / 'config.json').write_text(json.dumps({"n": 3, "temperature": 0.7}))
+    (tmp_path / 'sql' / 'skprompt.txt').write_text(PROMPT)
+    plugin = NlpToSql(str(tmp_path), 'sql', MockLlm())
+    cases = [EvalCase.from_nlp_to_sql(f'q{i}', plugin, text) for i, text in enumerate(['the well names', 'the deepest well'])]
+    cases.append(EvalCase.from_prompt('greeting', Prompt(role='Assistant'), 'Say hello', expected='hello'))
+    assert cases[0].options['temperature'] == 0.7 and 'the well names' in cases[0].message
+
+    models = {'fast': MockLlm(latency=0.02, response=_good_answer), 'slow': MockLlm(latency=0.1, response=_bad_answer)}
+    sql = valid_sql(plugin.schema)
+    scorers = {'quality': lambda case, text: contains(case, text) if case.expected else sql(case, text)}
+    comparison = ModelComparison(models, scorers, concurrency=3, store=ResultStore(str(tmp_path / 'results.jsonl')), prices={'fast': 0.5, 'slow': (1.0, 2.0)})
+
+    started = time.perf_counter()
+    report = comparison.run(cases, repeat=2)
+    # 6 requests per model, 3 at a time and both models at once
+    assert time.perf_counter() - started < 0.5
+
+    summary = report.summary()
+    assert summary['fast']['requests'] == 6 and summary['fast']['errors'] == 0
+    assert 0.1 <= summary['slow']['latency']['p50'] < 0.2 and summary['fast']['latency']['p95'] < 0.1
+    assert summary['fast']['pass_rate'] == 1.0 and summary['slow']['pass_rate'] < 1.0
+    assert summary['slow']['cost'] == (summary['slow']['prompt_tokens'] * 1.0 + summary['slow']['completion_tokens'] * 2.0) / 1000
+    assert report.best() == 'fast' and report.best(min_pass_rate=0.3, by='latency') == 'fast'
+    assert 'fast' in report.format().splitlines()[1]
+
+    replay = ModelComparison({'fast': MockLlm(latency=5), 'slow': MockLlm(latency=5)}, scorers, store=ResultStore(str(tmp_path / 'results.jsonl')))
+    started = time.perf_counter()
+    replayed = replay.run(cases, repeat=2).summary()
+    assert time.perf_counter() - started < 1
+    assert replayed['slow']['cached'] == 6 and replayed['slow']['latency'] == summary['slow']['latency']
+
+
+def test_errors_are_reported_and_not_stored(tmp_path):
+    store = ResultStore(str(tmp_path / 'results.jsonl'))
+    report = ModelComparison({'mock': MockLlm(latency=1)}, store=store, timeout=0.05).run([EvalCase('a', 'hi')])
+    assert report.results[0].error.startswith('DeadlineExceeded') and len(store) == 0
+    assert report.summary()['mock']['errors'] == 1 and report.best(min_pass_rate=0) is None
+
+
+def test_slow_model_does_not_hold_the_fast_one():
+    models = {'fast': MockLlm(latency=0.01), 'slow': MockLlm(latency=0.2)}
+    report = ModelComparison(models, concurrency=1).run([EvalCase(f'c{i}', 'hi') for i in range(4)])
+    assert max(result.finished for result in report.results if result.model == 'fast') < 0.15
+
+
+def test_same_rows_only_runs_read_only_answers(tmp_path):
+    repository = SqlRepository(str(tmp_path / 'wells.db'))
+    repository.execute_query("CREATE TABLE wells (id INTEGER PRIMARY KEY, name TEXT)")
+    repository.execute_many("INSERT INTO wells (name) VALUES (?)", [('a',), ('b',)])
+    score = same_rows(repository)
+    case = EvalCase('names', 'the well names', expected="SELECT name FROM wells ORDER BY name")
+    assert score(case, "```sql\nSELECT name FROM wells ORDER BY name DESC;\n```")
+    assert not score(case, "DELETE FROM wells")
+    assert not score(case, "SELECT name FROM wells; DROP TABLE wells")
+    assert not score(case, "WITH gone AS (DELETE FROM wells RETURNING name) SELECT name FROM gone")
+    assert repository.execute_query("SELECT COUNT(*) AS n FROM wells").data == [{'n': 2}]
+    repository.close()
+
+
+def test_percentile():
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile([1.0], 99) == 1.0 and percentile([], 50) is None
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ('openai', 'httpx', 'pydantic', 'pymongo', 'dotenv')
+
+
+def _loaded_after(statement):
+    code = f"{statement}; import sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(',') if m]
+
+
+def test_import_modelmorph_is_lazy():
+    assert _loaded_after('import modelmorph') == []
+
+
+def test_prompt_does_not_load_backends():
+    assert _loaded_after('from modelmorph import Prompt; Prompt().generate_prompt()') == []
+
+
+def test_public_names_resolve():
+    import modelmorph
+    from modelmorph.chatbot.assistant.chat_assistant import ChatCompletionAssistant
+
+    assert modelmorph.ChatCompletionAssistant is ChatCompletionAssistant
+    assert 'Prompt' in dir(modelmorph)
+    assert modelmorph.db.MongoDBRepository.__name__ == 'MongoDBRepository'
@@ -0,0 +1,144 @@
+import json
+import threading
+
+import httpx
+from openai import AzureOpenAI
+
+from modelmorph.chatbot.assistant import Chat, ChatSessions
+from modelmorph.chatbot.domain.messages import MessageStore, SpillFile
+from modelmorph.chatbot.repository import MockLlm, OpenAILlm
+from modelmorph.db.repository import InMemoryDBRepository
+from modelmorph.deadline import Deadline, use_deadline
+
+
+def test_message_store_behaves_like_a_list():
+    store = MessageStore([{"role": "system", "content": "be brief"}])
+    store.append({"role": "user", "content": "hi"})
+    store.append({"role": "tool", "content": "42", "tool_call_id": "call_1"})
+    store.append({"role": "critic", "content": "ok"})
+
+    assert len(store) == 4
+    assert store[-1] == {"role": "critic", "content": "ok"}
+    assert store[2] == {"role": "tool", "content": "42", "tool_call_id": "call_1"}
+    assert [m["role"] for m in store[1:3]] == ["user", "tool"]
+    assert list(store.view([{"role": "system", "content": "json"}]))[0]["content"] == "json"
+    del store[0]
+    assert store.to_list()[0] == {"role": "user", "content": "hi"}
+
+
+def test_spill_and_page_in(tmp_path):
+    spill_file = SpillFile(str(tmp_path / "sessions.spill"))
+    first = MessageStore([{"role": "user", "content": "é" * 100}])
+    second = MessageStore([{"role": "assistant", "content": "two"}])
+    first.spill(spill_file)
+    second.spill(spill_file)
+    assert first.spilled and spill_file.size > 100
+
+    assert first[0]["content"] == "é" * 100
+    second.append({"role": "user", "content": "three"})
+    assert second.to_list() == [{"role": "assistant", "content": "two"}, {"role": "user", "content": "three"}]
+    # Everything was paged back in, the file is emptied
+    assert spill_file.size == 0
+    spill_file.close()
+    assert not (tmp_path / "sessions.spill").exists()
+
+
+def test_spill_file_reclaims_freed_segments(tmp_path):
+    spill_file = SpillFile(str(tmp_path / "sessions.spill"), min_compact_bytes=0)
+    stores = [MessageStore([{"role": "user", "content": str(i) * 100}]) for i in range(6)]
+    for store in stores:
+        store.spill(spill_file)
+    full = spill_file.size
+
+    # The stores paged back in leave free space in the middle, the file is compacted
+    for store in stores[:4]:
+        assert len(store) == 1
+    assert spill_file.size < full / 2
+    assert [store[0]["content"][0] for store in stores[4:]] == ["4", "5"]
+    assert spill_file.size == 0
+
+    # A spilled store that is replaced frees its segment without being read, and is not spilled again
+    store = MessageStore([{"role": "user", "content": "old"}])
+    store.spill(spill_file)
+    store.release()
+    store.spill(spill_file)
+    assert spill_file.size == 0 and not store.spilled and len(store) == 0
+    spill_file.close()
+
+
+def test_eviction_keeps_chats_in_use_and_saves_without_the_request_deadline(tmp_path):
+    storage = InMemoryDBRepository.standalone()
+    llm = MockLlm(latency=0)
+    sessions = ChatSessions(lambda chat_id: Chat(chat_id, llm, "prompt", storage), max_sessions=1,
+                            spill_path=str(tmp_path / "spill"))
+    with sessions.use("a") as chat:
+        chat.send("hello")
+        sessions.get("b").send("bye")
+        # "a" is in use, the least recently used chat not in use is evicted instead
+        with use_deadline(Deadline(0)):
+            sessions.get("c")
+        assert "a" in sessions and "b" not in sessions
+    assert storage.find_chat_by_id("b").data[0]["messages"][-1]["content"] == "Mock answer to: bye"
+    sessions.get("d")
+    assert "a" not in sessions and storage.find_chat_by_id("a").data[0]["messages"][-1]["content"] == "Mock answer to: hello"
+    sessions.close()
+
+
+def test_openai_chat_request_does_not_change_history():
+    bodies = []
+
+    def handler(request):
+        bodies.append(request.content)
+        return httpx.Response(200, json={"id": "x", "object": "chat.completion", "created": 0, "model": "m", "choices": [
+            {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "{}"}}]})
+
+    llm = OpenAILlm.__new__(OpenAILlm)
+    llm.model_name = "m"
+    llm.client = AzureOpenAI(api_key="k", azure_endpoint="https://test", api_version="2024-02-01",
+                             http_client=httpx.Client(transport=httpx.MockTransport(handler)))
+    history = MessageStore([{"role": "user", "content": "hi"}])
+    llm.get_response_chat(history)
+    llm.get_response_chat(history)
+
+    assert len(history) == 1
+    assert json.loads(bodies[1])["messages"][1:] == [{"role": "user", "content": "hi"}]
+
+
+def test_idle_sessions_are_spilled_and_saved(tmp_path):
+    storage = InMemoryDBRepository()
+    llm = MockLlm(latency=0)
+    sessions = ChatSessions(lambda chat_id: Chat(chat_id, llm, "prompt", storage), max_sessions=2,
+                            idle_seconds=10, spill_path=str(tmp_path / "spill"))
+    sessions.get("a").send("hello")
+    sessions.get("b").send("bye")
+
+    assert sessions.spill_idle() == 0
+    # A chat with a request running is not idle, whatever its last use
+    assert sessions.spill_idle(now=sessions._last_used["b"] + 11, busy={"b"}) == 1
+    assert sessions.spill_idle(now=sessions._last_used["b"] + 11) == 1
+    assert sessions.get("a").chat["messages"][-1]["content"] == "Mock answer to: hello"
+
+    sessions.get("c")
+    assert "b" not in sessions
+    assert storage.find_chat_by_id("b").data[0]["messages"][-1]["content"] == "Mock answer to: bye"
+    sessions.close()
+
+
+def test_messages_appended_while_spilling_are_kept(tmp_path):
+    spill_file = SpillFile(str(tmp_path / "sessions.spill"))
+    store = MessageStore([{"role": "user", "content": "x" * 1000}])
+    done = threading.Event()
+
+    def spill():
+        while not done.is_set():
+            store.spill(spill_file)
+
+    spiller = threading.Thread(target=spill)
+    spiller.start()
+    for i in range(500):
+        store.append({"role": "assistant", "content": str(i)})
+    done.set()
+    spiller.join()
+
+    assert [m["content"] for m in store[1:]] == [str(i) for i in range(500)]
+    spill_file.close()
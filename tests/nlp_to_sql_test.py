@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from modelmorph.chatbot.assistant.promt import count_tokens
+from modelmorph.chatbot import plugins
+from modelmorph.chatbot.domain import Llm
+from modelmorph.chatbot.plugins import NlpToSql
+from modelmorph.chatbot.plugins.sql_validator import SqlValidator, clean_sql
+from modelmorph.db.domain import QueryAnswere
+from modelmorph.db.schema_catalog import SchemaCatalog
+
+PROMPT = "### Tables: # Wells (WellID, WellName, Depth) # Fields (FieldID, Name) ### A SQL query to find {{$input}}"
+
+
+class FakeLlm(Llm):
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self.calls = []
+
+    def get_response_message(self, message, system_message='', **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=c)) for c in self.candidates])
+
+    def get_response_chat(self, chat):
+        raise NotImplementedError
+
+
+class FakeRepository:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get_schema_version(self):
+        return 'v1'
+
+    def get_schema(self):
+        return QueryAnswere(data=[{'table': t, 'columns': c} for t, c in self.tables.items()], error='')
+
+
+@pytest.fixture
+def plugin_dir(tmp_path):
+    (tmp_path / 'sql').mkdir()
+    (tmp_path / 'sql' / 'config.json').write_text(json.dumps({"n": 3, "temperature": 0.7}))
+    (tmp_path / 'sql' / 'skprompt.txt').write_text(PROMPT)
+    return str(tmp_path)
+
+
+def test_schema_is_parsed_from_prompt(plugin_dir):
+    plugin = NlpToSql(plugin_dir, 'sql', FakeLlm([]))
+    assert plugin.schema == {'Wells': ['WellID', 'WellName', 'Depth'], 'Fields': ['FieldID', 'Name']}
+
+
+def test_first_valid_candidate_is_returned(plugin_dir):
+    llm = FakeLlm(['SELECT Foo FROM Wells', '```sql\nSELECT WellName FROM Wells WHERE Depth > 10;\n```', 'SELECT Name FROM Fields'])
+    plugin = NlpToSql(plugin_dir, 'sql', llm)
+
+    assert plugin.generate_valid_sql('deep wells') == 'SELECT WellName FROM Wells WHERE Depth > 10'
+    assert llm.calls[0]['n'] == 3
+
+
+def test_sqlite_stand_ins_are_reused_between_calls(plugin_dir, monkeypatch):
+    connections = []
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, 'connect', lambda *args: connections.append(args) or connect(*args))
+    plugin = NlpToSql(plugin_dir, 'sql', FakeLlm(['SELECT Foo FROM Wells', 'SELECT WellName FROM Wells']), validation_workers=2)
+
+    for _ in range(10):
+        assert plugin.generate_valid_sql('wells') == 'SELECT WellName FROM Wells'
+    assert len(connections) <= 2
+    plugin.close()
+
+
+def test_no_valid_candidate_raises(plugin_dir):
+    plugin = NlpToSql(plugin_dir, 'sql', FakeLlm(['DROP TABLE Wells', 'SELECT * FROM Missing']))
+    with pytest.raises(ValueError, match='no such table'):
+        plugin.generate_valid_sql('anything')
+
+
+def test_catalog_tables_are_injected(plugin_dir):
+    repository = FakeRepository({'Wells': ['WellID', 'WellName'], 'Invoices': ['InvoiceID', 'CustomerID', 'Amount', 'InvoiceDate']})
+    llm = FakeLlm(['SELECT Amount FROM Invoices'])
+    plugin = NlpToSql(plugin_dir, 'sql', llm)
+    prompt, tables = plugin._render_prompt('invoice amounts', SchemaCatalog(repository), top_k=1)
+
+    assert list(tables) == ['Invoices']
+    # The tables pasted in the prompt are replaced, not kept next to the selected ones
+    assert '# Invoices (InvoiceID, CustomerID, Amount, InvoiceDate)' in prompt and 'Wells' not in prompt
+    assert plugin.generate_valid_sql('invoice amounts', catalog=SchemaCatalog(repository)) == 'SELECT Amount FROM Invoices'
+
+
+def test_shipped_plugin_prompt_shrinks_with_catalog():
+    plugin = NlpToSql(os.path.dirname(plugins.__file__), 'nlpToSql', FakeLlm([]))
+    assert '{{$schema}}' in plugin.prompt_template
+    assert 'ExplorationProduction' in plugin.schema
+
+    # A warehouse of 60 tables of 12 columns, the prompt only describes the relevant one
+    tables = {f'Table{i}': [f'Column{i}x{j}' for j in range(12)] for i in range(59)}
+    tables['Invoices'] = ['InvoiceID', 'CustomerID', 'Amount', 'InvoiceDate']
+    full_prompt = plugin.prompt_template.replace('{{$schema}}', SchemaCatalog.render(tables)).replace('{{$input}}', 'invoice amounts')
+    prompt, selected = plugin._render_prompt('invoice amounts', SchemaCatalog(FakeRepository(tables)), top_k=1)
+
+    assert list(selected) == ['Invoices'] and '{{$' not in prompt
+    assert count_tokens(prompt) * 10 < count_tokens(full_prompt)
+
+
+def test_validator_rejects_invalid_queries():
+    validator = SqlValidator({'Wells': ['WellID']})
+    assert validator.validate(clean_sql('SELECT WellID FROM Wells;')) == ''
+    assert validator.validate('SELECT 1; SELECT 2') != ''
+    assert validator.validate('UPDATE Wells SET WellID = 1') != ''
+    assert validator.validate("SELECT WellID FROM Wells WHERE WellID = ';'") == ''
+
+    explained = []
+    repository = SimpleNamespace(execute_query=lambda sql: explained.append(sql) or QueryAnswere(data=[], error=''))
+    on_target = SqlValidator({'Wells': ['WellID']}, repository)
+    # Several statements are rejected before reaching a driver that could run them
+    assert on_target.validate('SELECT 1; DROP TABLE Wells') != '' and explained == []
+    assert on_target.validate('SELECT TOP 1 WellID FROM Wells') == '' and explained == ['EXPLAIN SELECT TOP 1 WellID FROM Wells']
+
+
+def test_validators_are_bounded(plugin_dir, monkeypatch):
+    monkeypatch.setattr(plugins.nlpToSql, 'MAX_VALIDATORS', 2)
+    plugin = NlpToSql(plugin_dir, 'sql', FakeLlm([]))
+    first = plugin._get_validator({'A': ['x']}, None)
+    for table in 'BCD':
+        plugin._get_validator({table: ['x']}, None)
+    assert len(plugin._validators) == 2 and plugin._get_validator({'A': ['x']}, None) is not first
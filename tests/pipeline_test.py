@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+from modelmorph.db.domain import QueryAnswere
+from modelmorph.pipeline import Pipeline, PipelineError, TTLCache
+
+
+class FakeRepository:
+    def __init__(self):
+        self.queries = []
+
+    def execute_query(self, query):
+        self.queries.append(query)
+        if 'bad' in query:
+            return QueryAnswere(data=[], error='syntax error')
+        return QueryAnswere(data=[{'wells': 3}], error='')
+
+
+class FakeAssistant:
+    def generate_completion(self, prompt):
+        return f"summary of {prompt}"
+
+
+def _slow(value):
+    time.sleep(0.2)
+    return value
+
+
+def test_independent_branches_run_concurrently():
+    pipeline = (
+        Pipeline(max_workers=2)
+        .add_step('left', _slow, ['question'], key='left')
+        .add_step('right', _slow, ['question'], key='right')
+        .add_step('both', lambda a, b: a + b, ['left', 'right'])
+    )
+    start = time.monotonic()
+    assert pipeline.run(question='x')['both'] == 'xx'
+    assert time.monotonic() - start < 0.35
+
+
+def test_sql_chain_is_memoized():
+    repository = FakeRepository()
+    pipeline = (
+        Pipeline()
+        .add_step('sql', lambda question: f"SELECT COUNT(*) FROM wells -- {question}", ['question'])
+        .add_query_step('rows', repository, 'sql')
+        .add_completion_step('summary', FakeAssistant(), 'Summarize {{rows}}', ['rows'])
+    )
+    first = pipeline.run(question='wells')
+    second = pipeline.run(question='wells')
+
+    assert first == second
+    assert first['summary'] == "summary of Summarize [{'wells': 3}]"
+    assert len(repository.queries) == 1
+    assert pipeline.stats == {'hits': 3, 'misses': 3}
+
+
+def test_shared_cache_is_kept_per_backend():
+    cache = TTLCache()
+    sales, wells = FakeRepository(), FakeRepository()
+    wells.execute_query = lambda query: QueryAnswere(data=[{'wells': 7}], error='')
+    assert Pipeline(cache=cache).add_query_step('rows', sales, 'sql').run(sql='SELECT 1')['rows'] == [{'wells': 3}]
+    assert Pipeline(cache=cache).add_query_step('rows', wells, 'sql').run(sql='SELECT 1')['rows'] == [{'wells': 7}]
+
+    class Deployment(FakeAssistant):
+        def generate_completion(self, prompt):
+            return f"other {prompt}"
+    results = [Pipeline(cache=cache).add_completion_step('summary', assistant, 'Summarize {{x}}', ['x']).run(x=1)['summary']
+               for assistant in (FakeAssistant(), Deployment())]
+    assert results == ['summary of Summarize 1', 'other Summarize 1']
+
+    # Every lambda of a scope has the same qualified name
+    pipelines = [Pipeline(cache=cache).add_step('double', lambda x: x * 2, ['x']), Pipeline(cache=cache).add_step('double', lambda x: x * 3, ['x'])]
+    assert [pipeline.run(x=2)['double'] for pipeline in pipelines] == [4, 6]
+
+
+class Database(FakeRepository):
+    def __init__(self, connection_string):
+        super().__init__()
+        self.connection_string = connection_string
+
+
+def test_pipelines_built_per_request_share_results():
+    cache = TTLCache()
+
+    def handle(repository, factor):
+        # A pipeline and its backends built for each request
+        pipeline = (
+            Pipeline(cache=cache)
+            .add_step('sql', lambda question: f"SELECT {factor} -- {question}", ['question'])
+            .add_query_step('rows', repository, 'sql')
+        )
+        pipeline.run(question='wells')
+        return pipeline.stats
+
+    assert handle(Database('db://a'), 1) == {'hits': 0, 'misses': 2}
+    assert handle(Database('db://a'), 1) == {'hits': 2, 'misses': 0}
+    assert handle(Database('db://b'), 1) == {'hits': 1, 'misses': 1}
+    assert handle(Database('db://a'), 2) == {'hits': 0, 'misses': 2}
+    assert Pipeline(cache=cache).add_query_step('rows', Database('db://b'), 'sql', key='warehouse').run(sql='SELECT 1')['rows'] == [{'wells': 3}]
+
+
+def test_failed_query_is_not_cached():
+    repository = FakeRepository()
+    pipeline = Pipeline().add_query_step('rows', repository, 'sql')
+    for _ in range(2):
+        with pytest.raises(PipelineError) as error:
+            pipeline.run(sql='bad query')
+        assert error.value.step == 'rows'
+    assert len(repository.queries) == 2
+
+
+def test_invalid_graphs_are_rejected():
+    with pytest.raises(PipelineError):
+        Pipeline().add_step('a', str, ['missing']).run()
+    with pytest.raises(PipelineError):
+        Pipeline().add_step('a', str, ['b']).add_step('b', str, ['a']).run()
+
+
+def test_ttl_cache_expires_and_evicts():
+    cache = TTLCache(ttl=0.05, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert 'a' not in cache and cache.get('c') == 3
+    time.sleep(0.06)
+    assert cache.get('c') is None
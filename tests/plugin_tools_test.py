@@ -0,0 +1,99 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from modelmorph import ChatCompletionAssistant
+from modelmorph.chatbot.domain import Llm
+from modelmorph.chatbot.plugins import Plugin, ToolExecutor
+from modelmorph.deadline import sleep
+
+
+def _message(content=None, tool_calls=None):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+
+def _call(call_id, name, text):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps({"input": text})))
+
+
+class FakeLlm(Llm):
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.requests = []
+
+    def get_response_message(self, message, system_message='', **kwargs):
+        time.sleep(self.delay if 'slow' not in message else 1)
+        return _message(content=f"answer to {message.strip()}")
+
+    def get_response_chat(self, chat, tools=None, **kwargs):
+        self.requests.append((chat, tools))
+        if tools:
+            return _message(tool_calls=[_call('1', 'sql', 'wells'), _call('2', 'summary', 'fields')])
+        return _message(content='done')
+
+
+@pytest.fixture
+def plugin(tmp_path):
+    for name in ('sql', 'summary'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'config.json').write_text(json.dumps({"description": f"{name} plugin", "timeout": 0.5}))
+        (tmp_path / name / 'skprompt.txt').write_text(f"{name} for {{{{$input}}}}")
+    return Plugin(str(tmp_path), FakeLlm())
+
+
+def test_tool_definitions(plugin):
+    names = sorted(tool['function']['name'] for tool in plugin.tool_definitions())
+    assert names == ['sql', 'summary']
+
+
+def test_tool_calls_run_concurrently(plugin):
+    executor = ToolExecutor(max_workers=2)
+    start = time.monotonic()
+    messages = executor.execute(plugin, [_call('1', 'sql', 'wells'), _call('2', 'summary', 'fields')])
+    assert time.monotonic() - start < 0.35
+    assert [m['content'] for m in messages] == ['answer to sql for wells', 'answer to summary for fields']
+
+
+def test_tool_timeout_and_errors_are_reported(plugin):
+    executor = ToolExecutor(max_workers=2)
+    messages = executor.execute(plugin, [_call('1', 'sql', 'slow'), _call('2', 'missing', 'x')])
+    assert 'timed out' in messages[0]['content']
+    assert 'failed' in messages[1]['content']
+    executor.shutdown(wait=False)
+
+
+class CooperativeLlm(FakeLlm):
+    def get_response_message(self, message, system_message='', **kwargs):
+        # Like the OpenAI requests, stops when the deadline of the call passes
+        sleep(5 if 'stuck' in message else 0.3)
+        return _message(content=f"answer to {message.strip()}")
+
+
+def test_tool_timeout_starts_with_the_call_and_frees_the_worker(plugin):
+    plugin.llm = CooperativeLlm()
+    executor = ToolExecutor(max_workers=1)
+    # Queued behind the first call, the second one still has its whole 0.5 seconds
+    messages = executor.execute(plugin, [_call('1', 'sql', 'wells'), _call('2', 'summary', 'fields')])
+    assert [m['content'] for m in messages] == ['answer to sql for wells', 'answer to summary for fields']
+
+    start = time.monotonic()
+    messages = executor.execute(plugin, [_call('1', 'sql', 'stuck')])
+    assert 'timed out' in messages[0]['content']
+    messages = executor.execute(plugin, [_call('2', 'summary', 'fields')])
+    assert messages[0]['content'] == 'answer to summary for fields'
+    assert time.monotonic() - start < 1.5
+    executor.shutdown()
+
+
+def test_plugin_tools_run_sends_one_follow_up(plugin):
+    assistant = ChatCompletionAssistant(endpoint='https://example.invalid', api_key='key', api_version='2024-06-01')
+    assistant.llm = FakeLlm()
+    chat = SimpleNamespace(chat={"messages": [{"role": "system", "content": "hi"}]})
+
+    _, answer = assistant.plugin_tools_run(chat, 'How many wells?', plugin)
+
+    assert answer == 'done'
+    assert len(assistant.llm.requests) == 2
+    assert [m['role'] for m in chat.chat['messages']] == ['system', 'user', 'assistant', 'tool', 'tool', 'assistant']
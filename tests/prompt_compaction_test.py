@@ -0,0 +1,63 @@
+from modelmorph import Prompt
+from modelmorph.chatbot.assistant.promt import count_tokens
+
+
+def _prompt(**kwargs):
+    prompt = Prompt(role="  Eres   un asistente\n\n de ventas  ", **kwargs)
+    prompt.add_objective("Responder las preguntas del cliente.")
+    prompt.add_objective("Responder   las preguntas del  cliente")
+    prompt.add_objective("Recomendar productos relevantes para el cliente", priority=2)
+    prompt.add_objective("Contar chistes cuando el cliente esté aburrido")
+    prompt.add_restriction("No inventar precios")
+    prompt.add_restriction("No inventar precios.", priority=5)
+    prompt.add_param("Tienda", "Centro")
+    return prompt
+
+
+def test_compaction_normalizes_and_dedupes():
+    prompt = _prompt()
+    result = prompt.compact("hola")
+
+    assert result.prompt == (
+        "Rol: Eres un asistente\nde ventas\n"
+        "Objetivos: Responder las preguntas del cliente.\nRecomendar productos relevantes para el cliente\n"
+        "Contar chistes cuando el cliente esté aburrido\n"
+        "Parametros: Tienda: Centro\n"
+        "Condiciones: No inventar precios.\n"
+        "Content to perform the objective: hola\n"
+    )
+    # The duplicate with the higher priority is the one kept
+    assert result.removed == [
+        ('objectives', 'Responder las preguntas del cliente', 'duplicate'),
+        ('restrictions', 'No inventar precios', 'duplicate'),
+    ]
+    assert result.saved == count_tokens(prompt.generate_prompt("hola")) - count_tokens(result.prompt) > 0
+    assert len(prompt.objectives) == 4
+
+
+def test_budgets_drop_lowest_priority_items_first():
+    prompt = _prompt(budgets={'objectives': 16, 'role': 3}, compact=True)
+    text = prompt.generate_prompt()
+
+    assert "Objetivos: Recomendar productos relevantes para el cliente\nParametros" in text
+    assert text.startswith("Rol: Eres un asis…\n")
+    assert ('objectives', 'Contar chistes cuando el cliente esté aburrido', 'budget') in prompt.last_compaction.removed
+    assert prompt.generate_prompt(compact=False) != text
+
+
+def test_compaction_keeps_delimiters_content_and_priorities():
+    prompt = _prompt()
+    prompt.restriction_delimiter = "; "
+    prompt.add_objective("Recomendar productos relevantes para el cliente")
+    text = "Tabla:\n  id | nombre\n\n  1  | Ana"
+    result = prompt.compact(text)
+
+    assert "Condiciones: No inventar precios.\n" in result.prompt
+    prompt.add_restriction("No usar jerga")
+    assert "Condiciones: No inventar precios.; No usar jerga\n" in prompt.compact(text).prompt
+    assert result.prompt.endswith(f"Content to perform the objective: {text}\n")
+    # The copy added again with the default priority keeps the earlier one's
+    assert prompt.priorities['objectives']["Recomendar productos relevantes para el cliente"] == 2
+    prompt.clean_objectives()
+    prompt.add_objective("Recomendar productos relevantes para el cliente")
+    assert prompt.priorities['objectives'] == {}
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from modelmorph.db import CachedRepository, QueryAnswere, QueryCache
+from modelmorph.db.query_cache import normalize_sql, referenced_tables
+from modelmorph.db.repository import SqlRepository
+
+
+@pytest.fixture
+def repository(tmp_path):
+    database = SqlRepository(str(tmp_path / 'cache.db'))
+    database.execute_query("CREATE TABLE wells (id INTEGER PRIMARY KEY, name TEXT, depth REAL)")
+    database.execute_query("CREATE TABLE fields (id INTEGER PRIMARY KEY, name TEXT)")
+    database.execute_many("INSERT INTO wells (name, depth) VALUES (?, ?)", [(f'w{i}', i * 10.0) for i in range(10)])
+    database.execute_query("INSERT INTO fields (name) VALUES ('north')")
+    yield CachedRepository(database, QueryCache(ttl=60))
+    database.close()
+
+
+def test_repeated_queries_are_answered_from_memory(repository):
+    first = repository.execute_query("SELECT name FROM wells WHERE depth > :depth ORDER BY depth", {'depth': 70})
+    second = repository.execute_query("select name\n  from WELLS where depth > :depth order by depth; -- again", {'depth': 70})
+    other = repository.execute_query("SELECT name FROM wells WHERE depth > :depth ORDER BY depth", {'depth': 80})
+
+    assert first.data == second.data == [{'name': 'w8'}, {'name': 'w9'}]
+    assert other.data == [{'name': 'w9'}]
+    second.data[0]['name'] = 'changed'
+    assert repository.execute_query("SELECT name FROM wells WHERE depth > :depth ORDER BY depth", {'depth': 70}).data[0] == {'name': 'w8'}
+    stats = repository.cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 2, 2)
+
+
+def test_writes_evict_only_the_tables_they_change(repository):
+    wells = "SELECT COUNT(*) AS n FROM wells"
+    fields = "SELECT f.name FROM fields f JOIN wells w ON w.id = f.id"
+    repository.execute_query(wells)
+    repository.execute_query(fields)
+    repository.execute_query("SELECT name FROM fields")
+
+    repository.execute_query("INSERT INTO wells (name, depth) VALUES (?, ?)", ('new', 5.0))
+    assert len(repository.cache) == 1
+    assert repository.execute_query(wells).data == [{'n': 11}]
+
+    assert repository.invalidate('FIELDS') == 1
+    repository.execute_query("SELECT name FROM wells WHERE name = 'now()'")
+    assert len(repository.cache) == 2
+    repository.execute_query("DELETE FROM wells WHERE name = 'new'")
+    assert len(repository.cache) == 0
+    assert repository.execute_query("SELECT CURRENT_TIMESTAMP AS t").error == ""
+    assert len(repository.cache) == 0
+
+
+def test_size_bound_and_ttl():
+    cache = QueryCache(max_bytes=2000, ttl=0.05, max_entry_bytes=1500)
+    rows = [{'name': 'x' * 100}]
+    for i in range(10):
+        assert cache.put(f"SELECT name FROM wells WHERE id = {i}", None, QueryAnswere(rows, ""))
+    assert cache.stats()['bytes'] <= 2000 and cache.stats()['evictions'] > 0
+    assert cache.get("SELECT name FROM wells WHERE id = 0") is None
+    assert cache.get("SELECT name FROM wells WHERE id = 9").data == rows
+    assert not cache.put("SELECT name FROM wells", None, QueryAnswere(rows * 50, ""))
+    time.sleep(0.06)
+    assert cache.get("SELECT name FROM wells WHERE id = 9") is None
+
+
+def test_normalization_and_tables():
+    assert normalize_sql("SELECT  Name\nFROM wells /* x */ WHERE name = 'A  B';") == "select name from wells where name = 'A  B'"
+    assert referenced_tables('SELECT * FROM main."Wells" w JOIN fields ON 1 WHERE x IN (SELECT id FROM `zones`)') == {'wells', 'fields', 'zones'}
+    assert referenced_tables("SELECT 'from nowhere'") == frozenset()
+    assert referenced_tables('SELECT * FROM wells w, main.fields AS f, (SELECT id FROM zones) z WHERE w.id = f.id') == {'wells', 'fields', 'zones'}
+    assert referenced_tables('SELECT * FROM a JOIN b ON 1, c WHERE x IN (SELECT 1 FROM d, e)') == {'a', 'b', 'c', 'd', 'e'}
+    assert QueryCache.cacheable('SELECT w.name FROM wells w, fields f WHERE w.id = f.id')
+    assert not QueryCache.cacheable('SELECT * FROM wells, json_each(wells.tags)')
+    assert not QueryCache.cacheable('SELECT * FROM wells WHERE created < CURDATE()')
+    assert not QueryCache.cacheable('SELECT UTC_TIMESTAMP, LOCALTIMESTAMP FROM wells')
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from modelmorph import Prompt
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.retrieval import Retriever, VectorIndex
+from modelmorph.retrieval import vector_index
+
+
+class CountingLlm(MockLlm):
+    def __init__(self):
+        super().__init__(latency=0)
+        self.batches = []
+
+    def embed_batch(self, texts):
+        self.batches.append(list(texts))
+        return super().embed_batch(texts)
+
+
+def test_embeddings_are_batched_and_cached():
+    llm = CountingLlm()
+    first = llm.get_embeddings(['a b', 'c', 'a b', 'd', 'e'], batch_size=2)
+    second = llm.get_embeddings(['e', 'f'])
+
+    assert llm.batches == [['a b', 'c'], ['d', 'e'], ['f']]
+    assert first[0] == first[2] and second[0] == first[4]
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_index_search_matches_brute_force(tmp_path, monkeypatch, quantize):
+    # Small blocks so the top-k of several blocks are merged
+    monkeypatch.setattr(vector_index, 'SEARCH_BLOCK_ROWS', 16)
+    vectors = np.random.default_rng(0).normal(size=(100, 8)).astype(np.float32)
+    index = VectorIndex(str(tmp_path), quantize=quantize)
+    index.append(vectors[:60], [f'doc {i}' for i in range(60)])
+    index.append(vectors[60:], [{'text': f'doc {i}', 'n': i} for i in range(60, 100)])
+
+    reopened = VectorIndex(str(tmp_path))
+    assert len(reopened) == 100 and reopened.quantize == quantize
+    queries = vectors[[3, 70]]
+    results = reopened.search(queries, k=5)
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = np.argsort(-(queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ normalized.T, axis=1)[:, :5]
+    assert [[document['text'] for _, document in query] for query in results] == [[f'doc {i}' for i in row] for row in expected]
+    assert results[1][0] == (pytest.approx(1.0, abs=0.02), {'text': 'doc 70', 'n': 70})
+    assert reopened.search(vectors[0], k=3)[0][1]['text'] == 'doc 0'
+
+
+def test_prompt_adds_retrieved_documents(tmp_path):
+    retriever = Retriever(MockLlm(latency=0), VectorIndex(str(tmp_path)), k=1)
+    retriever.add(['Los envíos tardan tres días hábiles', 'Aceptamos pagos con tarjeta'], [{'id': 1}, {'id': 2}])
+
+    prompt = Prompt(role='Asistente', retriever=retriever)
+    text = prompt.generate_prompt('¿Cuántos días tardan los envíos?')
+
+    assert text.endswith("¿Cuántos días tardan los envíos?\nRelevant documents:\n- Los envíos tardan tres días hábiles\n")
+    assert retriever.search('pagos con tarjeta')[0][1] == {'text': 'Aceptamos pagos con tarjeta', 'id': 2}
+
+
+def test_writers_of_the_same_index_keep_each_other_rows(tmp_path):
+    vectors = np.eye(4, dtype=np.float32)
+    first, second = VectorIndex(str(tmp_path)), VectorIndex(str(tmp_path))
+    first.append(vectors[:1], ['a'])
+    # An interrupted append of the first writer, after its committed row
+    with open(tmp_path / 'vectors.bin', 'ab') as file:
+        file.write(b'\0' * 7)
+    assert second.append(vectors[1:2], ['b']) == 2
+    assert first.append(vectors[2:3], ['c']) == 3
+
+    reopened = VectorIndex(str(tmp_path))
+    assert [document['text'] for document in reopened.documents] == ['a', 'b', 'c']
+    assert [reopened.search(vector, k=1)[0][1]['text'] for vector in vectors[:3]] == ['a', 'b', 'c']
+    assert first.search(vectors[1], k=1)[0][1]['text'] == 'b'
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+from modelmorph.chatbot.repository import DeadlineExceeded, LlmScheduler, MockLlm
+
+
+def _queue(scheduler, order, requests):
+    threads = []
+    for tenant, priority, cost in requests:
+        def run(tenant=tenant, priority=priority, cost=cost):
+            ticket = scheduler.acquire(cost, tenant, priority)
+            order.append(tenant)
+            scheduler.release(ticket)
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        # Wait for the request to be queued so the queueing order is known
+        while sum(c['queued'] for c in scheduler.stats()['classes'].values()) < len(threads):
+            time.sleep(0.001)
+    return threads
+
+
+def test_interactive_before_batch_and_fair_share_between_tenants():
+    scheduler = LlmScheduler(tokens_per_minute=100000, max_concurrency=1, interactive_slots=0)
+    holder = scheduler.acquire(10, 'holder')
+    order = []
+    threads = _queue(scheduler, order, [('nightly', 'batch', 10)] + [('a', 'interactive', 10)] * 3 + [('b', 'interactive', 11)] * 3)
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ['a', 'b', 'a', 'b', 'a', 'b', 'nightly']
+
+
+def test_batch_leaves_a_slot_to_interactive():
+    scheduler = LlmScheduler(tokens_per_minute=100000, max_concurrency=2, interactive_slots=1)
+    batch = scheduler.acquire(10, 'nightly', 'batch')
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire(10, 'nightly', 'batch', deadline=time.monotonic() + 0.05)
+    interactive = scheduler.acquire(10, 'user', 'interactive', deadline=time.monotonic() + 0.05)
+    scheduler.release(interactive)
+    scheduler.release(batch)
+    assert scheduler.stats()['classes']['batch']['expired'] == 1
+
+
+def test_token_budget_waits_for_refill_and_uses_actual_usage():
+    scheduler = LlmScheduler(tokens_per_minute=6000, max_concurrency=4)
+    ticket = scheduler.acquire(6000)
+    scheduler.release(ticket, used_tokens=1000)
+    started = time.monotonic()
+    ticket = scheduler.acquire(4500)
+    assert time.monotonic() - started < 0.1
+
+    scheduler.release(ticket)
+    started = time.monotonic()
+    # 500 tokens left, refilled at 100 per second
+    scheduler.acquire(540)
+    assert time.monotonic() - started >= 0.3
+
+
+def test_scheduled_llm_wraps_the_model():
+    scheduler = LlmScheduler(tokens_per_minute=100000)
+    llm = scheduler.client(MockLlm(latency=0), tenant='acme', priority='batch')
+    response = llm.get_response_message("hi", type_object='text')
+
+    assert response.choices[0].message.content == "Mock answer to: hi"
+    assert llm.model_name == 'mock'
+    assert "".join(llm.stream_response_chat([{"role": "user", "content": "yo"}])) == "Mock answer to: yo"
+    assert scheduler.stats()['classes']['batch']['granted'] == 2
+    assert scheduler.stats()['running'] == 0
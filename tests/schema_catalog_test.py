@@ -0,0 +1,58 @@
+from modelmorph.db.domain import QueryAnswere
+from modelmorph.db.schema_catalog import Bm25Index, SchemaCatalog, tokenize
+
+TABLES = {
+    'ExplorationProduction': ['WellID', 'WellName', 'ProductionVolume', 'FieldName'],
+    'Employees': ['EmployeeID', 'FirstName', 'Salary', 'DepartmentID'],
+    'Departments': ['DepartmentID', 'DepartmentName'],
+    'Invoices': ['InvoiceID', 'CustomerID', 'Amount', 'InvoiceDate'],
+}
+
+
+class FakeRepository:
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        self.version = 'v1'
+        self.introspections = 0
+
+    def get_schema_version(self):
+        return self.version
+
+    def get_schema(self):
+        self.introspections += 1
+        return QueryAnswere(data=[{'table': t, 'columns': c} for t, c in TABLES.items()], error='')
+
+
+def test_tokenize_splits_identifiers():
+    assert tokenize('Show the WellName of wells') == ['well', 'name', 'well']
+
+
+def test_bm25_ranks_relevant_documents():
+    index = Bm25Index({name: f"{name} {' '.join(columns)}" for name, columns in TABLES.items()})
+    assert index.search('salary of employees by department', k=2)[0][0] == 'Employees'
+
+
+def test_catalog_selects_top_k_tables():
+    catalog = SchemaCatalog(FakeRepository('select'), version_check_interval=0)
+    tables = catalog.select('total production volume per well', k=1)
+    assert list(tables) == ['ExplorationProduction']
+    assert catalog.render(tables) == '# ExplorationProduction (WellID, WellName, ProductionVolume, FieldName)'
+
+
+def test_catalog_is_shared_and_invalidated_by_version():
+    repository = FakeRepository('shared')
+    SchemaCatalog(repository, version_check_interval=0).tables
+    SchemaCatalog(repository, version_check_interval=0).tables
+    assert repository.introspections == 1
+
+    repository.version = 'v2'
+    SchemaCatalog(repository, version_check_interval=0).tables
+    assert repository.introspections == 2
+
+
+def test_catalog_is_kept_per_repository_instance():
+    # Two databases of one server share the connection string but not their tables
+    sales, wells = FakeRepository('mongodb://cluster'), FakeRepository('mongodb://cluster')
+    wells.get_schema = lambda: QueryAnswere(data=[{'table': 'Wells', 'columns': ['WellID']}], error='')
+    assert 'Invoices' in SchemaCatalog(sales, version_check_interval=0).tables
+    assert list(SchemaCatalog(wells, version_check_interval=0).tables) == ['Wells']
@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+
+from modelmorph.serve import Server, ServerConfig
+from modelmorph.serve.protocol import HttpError, read_request
+
+
+async def _post(port, path, payload):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode()
+    writer.write(f'POST {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body.decode()
+
+
+def test_chat_completion_and_shedding():
+    async def scenario():
+        server = Server(ServerConfig(port=0, workers=2, max_queue=1, mock=True, mock_latency=0.2))
+        port = await server.start()
+        try:
+            status, body = await _post(port, '/chat', {'chat_id': 'c1', 'message': 'hello'})
+            assert status == 200 and json.loads(body)['message'] == 'Mock answer to: hello'
+
+            status, body = await _post(port, '/chat', {'chat_id': 'c1', 'message': 'again', 'stream': True})
+            assert status == 200 and 'event: done' in body and '"delta"' in body
+
+            statuses = await asyncio.gather(*(_post(port, '/completion', {'prompt': 'x'}) for _ in range(6)))
+            assert sorted(status for status, _ in statuses) == [200, 200, 503, 503, 503, 503]
+
+            status, _ = await _post(port, '/chat', {'message': 'no id'})
+            assert status == 400
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_invalid_content_length_is_a_bad_request():
+    async def read(head):
+        reader = asyncio.StreamReader()
+        reader.feed_data(head.encode())
+        reader.feed_eof()
+        return await read_request(reader, max_body=100)
+
+    for length in ('abc', '-5', '1e3', '+7'):
+        with pytest.raises(HttpError) as error:
+            asyncio.run(read(f'POST /chat HTTP/1.1\r\nContent-Length: {length}\r\n\r\n'))
+        assert error.value.status == 400
+    assert asyncio.run(read('POST /chat HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}')).body == b'{}'
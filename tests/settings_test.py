@@ -0,0 +1,70 @@
+import os
+
+import pytest
+from pydantic import ValidationError
+
+from modelmorph import Prompt
+from modelmorph.settings import clear_settings_cache, load_plugin_settings, load_settings
+
+CONFIG = """[DEFAULT]
+ERROR_RESPONSE=Sorry
+
+[LLM_COMPLETATION]
+INITIAL_PROMPT=You are a SQL expert
+MAX_TOKENS=300
+TEMP=0.2
+
+[CONNECTORS]
+ROLE=Role:
+OBJECTIVES=Goals:
+"""
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    clear_settings_cache()
+    path = tmp_path / 'assistant.conf'
+    path.write_text(CONFIG)
+    return str(path)
+
+
+def test_settings_are_typed_and_inherit_defaults(config_path):
+    settings = load_settings(config_path)
+    assert settings.completion.max_tokens == 300
+    assert settings.completion.temp == 0.2
+    assert settings.completion.top_p is None
+    assert settings.completion.error_response == 'Sorry'
+    assert settings.chat.error_response == 'Sorry'
+    assert settings.connectors.objectives == 'Goals:'
+
+
+def test_settings_are_cached_until_file_changes(config_path):
+    settings = load_settings(config_path)
+    assert load_settings(config_path) is settings
+
+    with open(config_path, 'a') as config_file:
+        config_file.write('TOP_P=0.5\n')
+    os.utime(config_path, ns=(0, 0))
+
+    reloaded = load_settings(config_path)
+    assert reloaded is not settings
+    assert reloaded.connectors.format == 'Output Format:'
+
+
+def test_settings_are_frozen(config_path):
+    with pytest.raises(ValidationError):
+        load_settings(config_path).completion.max_tokens = 10
+
+
+def test_prompt_uses_settings(config_path):
+    prompt = Prompt(config_path)
+    prompt.add_objective('Write a query')
+    assert prompt.settings is load_settings(config_path)
+    assert prompt.generate_prompt().startswith('Role: You are a SQL expert\n\nGoals: Write a query')
+
+
+def test_plugin_settings_keep_extra_keys():
+    plugin_dir = os.path.join(os.path.dirname(__file__), '..', 'modelmorph', 'chatbot', 'plugins', 'nlpToSql')
+    settings = load_plugin_settings(os.path.join(plugin_dir, 'config.json'))
+    assert settings.max_tokens == 100
+    assert settings.model_dump()['schema'] == 1
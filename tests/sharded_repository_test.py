@@ -0,0 +1,169 @@
+import pytest
+
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.db.repository import HashRing, InMemoryDBRepository, ShardedDBRepository
+from modelmorph.db.repository import sharded_db_repository
+
+
+def _shard():
+    return InMemoryDBRepository.standalone()
+
+
+def test_ring_spreads_keys_and_moves_only_to_the_added_node():
+    ring = HashRing(['a', 'b', 'c'], virtual_nodes=128)
+    keys = [f'chat-{i}' for i in range(6000)]
+    owners = {key: ring.node(key) for key in keys}
+    counts = {node: list(owners.values()).count(node) for node in ring.nodes}
+    assert all(1500 < count < 2500 for count in counts.values())
+    assert HashRing(['c', 'a', 'b']).node('chat-1') == owners['chat-1']
+    assert abs(sum(ring.shares().values()) - 1) < 1e-9
+
+    grown = ring.with_node('d')
+    moved = [key for key in keys if grown.node(key) != owners[key]]
+    assert all(grown.node(key) == 'd' for key in moved)
+    assert 1000 < len(moved) < 2000
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clusters(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sharded_db_repository, 'time', clock)
+    clusters = {f'mem://{name}': InMemoryDBRepository.standalone(f'mem://{name}') for name in 'abcd'}
+    path = tmp_path / 'shards.env'
+    path.write_text('CHAT_SHARDS=a=mem://a;b=mem://b\n')
+
+    def open_repository():
+        # A process, reading the placement from the shared file
+        return ShardedDBRepository.from_config_file(str(path), repository_factory=lambda name, url: clusters[url], reload_interval=1)
+    return clusters, clock, open_repository
+
+
+def _messages(repository, chat_id):
+    return [message['content'] for message in repository.find_chat_by_id(chat_id).data[0]['messages']]
+
+
+def test_added_shard_takes_its_chats_on_first_use(clusters):
+    clusters, clock, open_repository = clusters
+    repository = open_repository()
+    chat_ids = [f'chat-{i}' for i in range(40)]
+    for chat_id in chat_ids:
+        repository.save_chat(chat_id, {'_id': chat_id, 'messages': [{'role': 'user', 'content': chat_id}]})
+
+    repository.add_shard('c', 'mem://c', delay=0)
+    moved = [chat_id for chat_id in chat_ids if repository.shard_for(chat_id) == 'c']
+    assert moved and not clusters['mem://c'].collections['chats']
+
+    for chat_id in chat_ids:
+        assert _messages(repository, chat_id) == [chat_id]
+    assert sorted(clusters['mem://c'].collections['chats']) == sorted(moved)
+    # The previous copies stay until the migration is finished
+    assert sum(len(clusters[url].collections['chats']) for url in ('mem://a', 'mem://b')) == 40
+
+    # A chat used through Chat is moved before its new messages are appended
+    repository.add_shard('d', 'mem://d', delay=0)
+    chat_id = next(chat_id for chat_id in chat_ids if repository.shard_for(chat_id) == 'd')
+    chat = Chat(chat_id, MockLlm(latency=0), 'prompt', repository, history_window=4)
+    chat.send('more')
+    chat.save_chat()
+    assert _messages(clusters['mem://d'], chat_id)[:2] == [chat_id, 'more']
+
+    stats = repository.stats()
+    assert stats['c']['migrated_in'] == len(moved) and stats['d']['migrated_in'] == 1
+    assert all(shard['healthy'] for shard in stats.values())
+    assert abs(sum(shard['share'] for shard in stats.values()) - 1) < 1e-9
+
+    repository.finish_migration(chat_ids)
+    assert sum(len(cluster.collections['chats']) for cluster in clusters.values()) == 40
+    assert 'PREVIOUS' not in open(repository.config_path).read()
+    with pytest.raises(ValueError):
+        ShardedDBRepository({'a': _shard()}).add_shard('b', 'mem://b')
+
+
+def test_processes_switch_to_an_added_shard_together(clusters):
+    clusters, clock, open_repository = clusters
+    first, second = open_repository(), open_repository()
+    chat_id = next(f'chat-{i}' for i in range(100) if HashRing(['a', 'b', 'c']).node(f'chat-{i}') == 'c')
+    first.save_chat(chat_id, {'_id': chat_id, 'messages': [{'role': 'user', 'content': 'hello'}]})
+    source = clusters[f"mem://{first.shard_for(chat_id)}"]
+
+    # Until every process read the file, the previous placement is used, also by the one adding the shard
+    first.add_shard('c', 'mem://c')
+    assert first.shard_for(chat_id) != 'c' and second.shard_for(chat_id) != 'c'
+    second.append_messages(chat_id, [{'role': 'assistant', 'content': 'before'}])
+    assert _messages(first, chat_id) == ['hello', 'before']
+
+    clock.now += 3.5
+    first.append_messages(chat_id, [{'role': 'user', 'content': 'after'}])
+    second.append_messages(chat_id, [{'role': 'assistant', 'content': 'again'}])
+    assert first.shard_for(chat_id) == second.shard_for(chat_id) == 'c'
+    assert _messages(first, chat_id) == _messages(second, chat_id) == ['hello', 'before', 'after', 'again']
+    # The previous copy is kept as it was, not written again by a process on the previous placement
+    assert [m['content'] for m in source.collections['chats'][chat_id]['messages']] == ['hello', 'before']
+
+    first.finish_migration([chat_id])
+    assert chat_id not in source.collections['chats']
+    clock.now += 1
+    assert second.find_chat_by_id(chat_id).data and not second._previous_rings
+
+
+def test_stale_writer_conflicts_after_a_migration(clusters):
+    clusters, clock, open_repository = clusters
+    repository = open_repository()
+    chat_id = next(f'chat-{i}' for i in range(100) if HashRing(['a', 'b', 'c']).node(f'chat-{i}') == 'c')
+    stale = repository.save_chat_if_version(chat_id, {'_id': chat_id, 'messages': ['t1']}, 0).data[0]['version']
+    version = stale
+    for turn in ('t2', 't3'):
+        chat = repository.find_chat_by_id(chat_id).data[0]
+        version = repository.save_chat_if_version(chat_id, {**chat, 'messages': chat['messages'] + [turn]}, version).data[0]['version']
+
+    repository.add_shard('c', 'mem://c', delay=0)
+    assert repository.find_chat_by_id(chat_id).data[0]['version'] == version == 3
+    assert clusters['mem://c'].collections['chats'][chat_id]['version'] == 3
+    # A writer that read the chat at its first turn does not overwrite the later ones on the new shard
+    assert repository.save_chat_if_version(chat_id, {'_id': chat_id, 'messages': ['t1', 'stale']}, stale).error == 409
+    assert repository.find_chat_by_id(chat_id).data[0]['messages'] == ['t1', 't2', 't3']
+
+
+class BrokenShard(InMemoryDBRepository):
+    def find_chat_by_id(self, chat_id):
+        raise ConnectionError('cluster unreachable')
+
+
+def test_failing_shard_is_reported_unhealthy(monkeypatch, tmp_path):
+    repository = ShardedDBRepository({'ok': _shard(), 'down': BrokenShard.standalone()}, error_threshold=2)
+    chat_id = next(f'c{i}' for i in range(100) if repository.shard_for(f'c{i}') == 'down')
+    for _ in range(2):
+        assert repository.find_chat_by_id(chat_id).error == 'cluster unreachable'
+    assert repository.check_health() == {'ok': True, 'down': False}
+    stats = repository.stats()
+    assert not stats['down']['healthy'] and stats['down']['errors'] == 3 and stats['ok']['healthy']
+
+    monkeypatch.setenv('CHAT_SHARDS', 'x=mem://1; y=mem://2')
+    monkeypatch.setenv('CHAT_SHARDS_PREVIOUS', 'x')
+    from_env = ShardedDBRepository.from_env(repository_class=InMemoryDBRepository)
+    assert from_env.ring.nodes == ('x', 'y') and from_env.shards['y'].connection_string == 'mem://2'
+    assert from_env._previous_rings[0].nodes == ('x',)
+    assert ShardedDBRepository.from_env() is from_env
+    monkeypatch.setenv('CHAT_SHARDS', 'broken')
+    with pytest.raises(ValueError):
+        ShardedDBRepository.from_env()
+
+    monkeypatch.setenv('CHAT_SHARDS_FILE', str(tmp_path / 'shards.env'))
+    (tmp_path / 'shards.env').write_text('CHAT_SHARDS=x=mem://1\n')
+    from_file = ShardedDBRepository.from_env(repository_class=InMemoryDBRepository)
+    assert from_file.config_path == str(tmp_path / 'shards.env') and from_file.ring.nodes == ('x',)
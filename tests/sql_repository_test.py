@@ -0,0 +1,91 @@
+import sqlite3
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from modelmorph.db.repository import SqlRepository, translate_parameters
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = SqlRepository(str(tmp_path / 'test.db'), pool_size=2, checkout_timeout=0.2)
+    repository.execute_query("CREATE TABLE wells (id INTEGER PRIMARY KEY, name TEXT, depth REAL)")
+    yield repository
+    repository.close()
+
+
+def test_bulk_insert_and_concurrent_queries(repository):
+    answer = repository.execute_many("INSERT INTO wells (name, depth) VALUES (?, ?)", [(f'w{i}', i * 10.0) for i in range(100)])
+    assert answer.error == "" and answer.data == [{'rowcount': 100}]
+
+    query = "SELECT name, depth FROM wells WHERE depth >= :minimum ORDER BY depth LIMIT 2"
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        answers = list(pool.map(lambda i: repository.execute_query(query, {'minimum': i * 10}), range(40)))
+
+    assert all(answer.error == "" for answer in answers)
+    assert answers[5].data == [{'name': 'w5', 'depth': 50.0}, {'name': 'w6', 'depth': 60.0}]
+    stats = repository.stats()
+    assert stats['created'] <= 2 and stats['in_use'] == 0
+    assert stats['statements']['hits'] >= 38
+
+
+def test_transaction_rolls_back_and_pool_times_out(repository):
+    with pytest.raises(RuntimeError):
+        with repository.transaction():
+            repository.execute_query("INSERT INTO wells (name) VALUES (?)", ('lost',))
+            raise RuntimeError('abort')
+    assert repository.execute_query("SELECT COUNT(*) AS n FROM wells").data == [{'n': 0}]
+
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with repository.connection():
+            held.set()
+            release.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    held.wait()
+    while repository.stats()['in_use'] < 2:
+        time.sleep(0.01)
+    assert 'No database connection free' in repository.execute_query("SELECT 1").error
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert repository.execute_query("SELECT 1 AS one").data == [{'one': 1}]
+
+
+def test_chats_and_schema(repository):
+    assert repository.find_chat_by_id(7).error == 400
+    repository.save_chat(7, {'messages': [{'role': 'user', 'content': 'hola'}]})
+    repository.save_chat(7, {'messages': [{'role': 'user', 'content': 'adiós'}]})
+    assert repository.find_chat_by_id(7).data[0] == {'_id': 7, 'messages': [{'role': 'user', 'content': 'adiós'}], 'version': 2}
+    assert repository.copy_chat(8, {'_id': 8, 'messages': [], 'version': 5}).data == [{'version': 5}]
+    assert repository.copy_chat(8, {'_id': 8, 'messages': []}).error == 409
+    assert repository.find_chat_by_id(8).data[0]['version'] == 5
+    assert repository.get_schema().data == [{'table': 'wells', 'columns': ['id', 'name', 'depth']}]
+
+
+def test_placeholders_for_format_drivers():
+    sql = "SELECT * FROM t WHERE a = ? AND b = :name AND c LIKE '50%?' AND d::text = '1'"
+    assert translate_parameters(sql, 'pyformat') == "SELECT * FROM t WHERE a = %s AND b = %(name)s AND c LIKE '50%%?' AND d::text = '1'"
+    assert translate_parameters(sql, 'qmark') is sql
+
+
+def test_repositories_of_different_databases(tmp_path):
+    first, second = SqlRepository(str(tmp_path / 'a.db')), SqlRepository(str(tmp_path / 'b.db'))
+    assert first is not second
+    first.save_chat(1, {'messages': []})
+    assert second.find_chat_by_id(1).error == 400 and first.find_chat_by_id(1).data
+
+    # A format driver only formats the query when it is given values
+    driver = types.SimpleNamespace(__name__='formatdb', paramstyle='format', Error=sqlite3.Error,
+                                   connect=lambda path: sqlite3.connect(path, check_same_thread=False))
+    repository = SqlRepository(str(tmp_path / 'c.db'), driver=driver)
+    assert repository.execute_query("SELECT '50%' AS rate").data == [{'rate': '50%'}]
+    for repository in (first, second, repository):
+        repository.close()
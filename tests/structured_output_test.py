@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+from pydantic import BaseModel, ValidationError
+
+from modelmorph import CompletionAssistant
+from modelmorph.chatbot.assistant import StructuredOutputParser, get_output_validators
+from modelmorph.chatbot.domain import Llm
+
+
+class Answer(BaseModel):
+    sql: str
+    tables: list[str]
+    confidence: float
+
+
+RESPONSE = '{"sql": "SELECT * FROM wells", "tables": ["wells"], "confidence": 0.9}'
+
+
+class FakeLlm(Llm):
+    def get_response_message(self, message, system_message, **kwargs):
+        self.system_message = system_message
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=RESPONSE))])
+
+    def get_response_chat(self, chat):
+        raise NotImplementedError
+
+    def stream_response_message(self, message, system_message, **kwargs):
+        for start in range(0, len(RESPONSE), 7):
+            yield RESPONSE[start:start + 7]
+
+
+@pytest.fixture
+def assistant():
+    assistant = CompletionAssistant(endpoint='https://example.invalid', api_key='key', api_version='2024-06-01')
+    assistant.llm = FakeLlm()
+    return assistant
+
+
+def test_validators_are_cached_per_model():
+    assert get_output_validators(Answer) is get_output_validators(Answer)
+
+
+def test_parser_yields_fields_as_they_complete():
+    parser = StructuredOutputParser(Answer)
+    partials = [p for p in (parser.feed(RESPONSE[i:i + 5]) for i in range(0, len(RESPONSE), 5)) if p]
+
+    assert partials[0].sql == 'SELECT * FROM wells' and partials[0].tables is None
+    assert partials[-1].tables == ['wells']
+    assert parser.result() == Answer(sql='SELECT * FROM wells', tables=['wells'], confidence=0.9)
+
+
+def test_generate_structured_sends_schema(assistant):
+    answer = assistant.generate_structured('wells in Texas', Answer)
+    assert answer.tables == ['wells']
+    assert '"confidence"' in assistant.llm.system_message
+
+
+def test_stream_structured_ends_with_validated_instance(assistant):
+    results = list(assistant.stream_structured('wells in Texas', Answer))
+    assert isinstance(results[-1], Answer)
+    assert all(not isinstance(result, Answer) for result in results[:-1])
+
+
+def test_invalid_response_raises():
+    parser = StructuredOutputParser(Answer)
+    parser.feed('{"sql": 1}')
+    with pytest.raises(ValidationError):
+        parser.result()
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+
+import pytest
+
+from modelmorph import tracing
+from modelmorph.chatbot.assistant import Chat
+from modelmorph.chatbot.repository import MockLlm
+from modelmorph.db.repository import InMemoryDBRepository
+from modelmorph.tracing import InMemoryExporter, JsonLinesExporter, OtlpFileExporter
+from modelmorph.tracing import exporters
+
+
+@pytest.fixture
+def exporter():
+    exporter = InMemoryExporter()
+    tracing.configure([exporter])
+    yield exporter
+    tracing.disable()
+
+
+def test_disabled_tracing_returns_the_noop_span():
+    with tracing.span('anything', key='value') as span:
+        span.set_attribute('other', 1)
+    assert span is tracing.NOOP_SPAN
+    assert tracing.current_span() is None
+
+
+def test_chat_send_stages(exporter):
+    chat = Chat('traced', MockLlm(latency=0), 'prompt', InMemoryDBRepository())
+    chat.send('hello')
+    chat.save_chat()
+
+    names = [span.name for span in exporter.spans]
+    assert names == ['chat.load', 'chat.model', 'chat.send', 'chat.save']
+    load, model, send, _ = exporter.spans
+    assert load.parent_id == model.parent_id == send.span_id
+    assert model.attributes['llm.model'] == 'mock' and model.attributes['llm.prompt_tokens'] > 0
+
+    list(chat.send_stream('again'))
+    stream = exporter.find('chat.send_stream')[0]
+    assert exporter.find('chat.model')[-1].parent_id == stream.span_id
+    assert tracing.current_span() is None
+
+
+def test_context_propagation_and_errors(exporter):
+    with tracing.span('root') as root:
+        worker = threading.Thread(target=tracing.wrap(lambda: tracing.span('in-thread').end()))
+        worker.start()
+        worker.join()
+        headers = tracing.inject()
+    with pytest.raises(ValueError):
+        with tracing.span('remote', side='callee') as remote:
+            pass
+        with tracing.get_tracer().start_span('failing', parent=tracing.extract(headers)):
+            raise ValueError('boom')
+
+    assert exporter.find('in-thread')[0].parent_id == root.span_id
+    assert remote.parent_id is None
+    failing = exporter.find('failing')[0]
+    assert (failing.trace_id, failing.parent_id) == (root.trace_id, root.span_id)
+    assert failing.error[:2] == ('ValueError', 'boom')
+
+
+def test_file_exporters_and_profiling(tmp_path):
+    tracer = tracing.configure([JsonLinesExporter(str(tmp_path / 'spans.jsonl')), OtlpFileExporter(str(tmp_path / 'spans.otlp.jsonl'))])
+    tracer.enable_profiling(str(tmp_path / 'profiles'))
+    try:
+        with tracing.span('request', tokens=3):
+            with tracing.span('step'):
+                sum(range(1000))
+    finally:
+        tracing.disable()
+
+    lines = [json.loads(line) for line in open(tmp_path / 'spans.jsonl')]
+    assert [line['name'] for line in lines] == ['step', 'request']
+    assert os.path.exists(lines[1]['attributes']['profile.path'])
+
+    otlp = [json.loads(line) for line in open(tmp_path / 'spans.otlp.jsonl')]
+    span = otlp[1]['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+    assert span['traceId'] == lines[1]['trace_id'] and 'parentSpanId' not in span
+    assert {'key': 'tokens', 'value': {'intValue': '3'}} in span['attributes']
+    assert otlp[0]['resourceSpans'][0]['scopeSpans'][0]['spans'][0]['parentSpanId'] == span['spanId']
+
+    class NoEncoding(exporters._FileExporter):
+        pass
+
+    with pytest.raises(TypeError):
+        NoEncoding(str(tmp_path / 'never.jsonl'))
+    assert not os.path.exists(tmp_path / 'never.jsonl')